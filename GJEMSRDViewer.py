@@ -1,8 +1,15 @@
 import sys
+import time
 from PyQt4 import QtGui, QtCore
 import os
 from mplwidget import MatplotlibWidget
-from rawDataImport import RawDataViewer
+from rawDataImport import RawDataViewer, LoadCancelled, plotMaxBins, ProcessingStringError, parseCalibStr, \
+    parseExclusionStr
+from epochPrefetcher import EpochPrefetcher, epochTracesNBytes
+import instrumentation
+from signalCache import SignalCache
+from smrReader import SMRReader
+from viewerSession import ViewerSession
 import quantities as qu
 
 mplPars = {
@@ -17,11 +24,22 @@ mplPars = {
            'legend.fontsize': 12,
            }
 
+# number of epochs prepared in the background after and before the one viewed, and the memory they may use
+prefetchEpochs = 2
+prefetchMaxBytes = 256 * 1024 ** 2
+
+# memory the recordings kept open in a session may hold, see viewerSession.ViewerSession
+sessionMaxBytes = 1024 ** 3
+
 
 
 class TitledText(QtGui.QGroupBox):
 
-    def __init__(self, title, parent=None):
+    def __init__(self, title, parent=None, validator=None):
+        '''
+        :param validator: callable or None. If given, the text is checked with it as it is edited and the line is
+        highlighted while validator raises rawDataImport.ProcessingStringError, whose message is shown as tool tip.
+        '''
 
         QtGui.QGroupBox.__init__(self, title, parent)
         self.line = QtGui.QLineEdit()
@@ -34,6 +52,29 @@ class TitledText(QtGui.QGroupBox):
 
         self.setLayout(hbox)
 
+        self.validator = validator
+        # ProcessingStringError of the current text, None if it is valid or empty
+        self.error = None
+        if validator is not None:
+            self.connect(self.line, QtCore.SIGNAL('textChanged(QString)'), self.validate)
+
+    def validate(self, text=None):
+
+        text = str(self.line.text())
+        self.error = None
+        if text:
+            try:
+                self.validator(text)
+            except ProcessingStringError as e:
+                self.error = e
+
+        if self.error is None:
+            self.line.setStyleSheet('')
+            self.line.setToolTip('')
+        else:
+            self.line.setStyleSheet('QLineEdit { background-color: #ffd0d0; }')
+            self.line.setToolTip(str(self.error))
+
     def setText(self, str):
         self.line.setText(str)
 
@@ -104,6 +145,164 @@ class FileSelect(PathSelect):
         self.fileType = fileType
 
 
+class SMRFileOpener(QtCore.QThread):
+    '''
+    Opens an SMR file with smrReader.SMRReader in a worker thread, i.e., reads its headers and the block index of its
+    channels, from the sidecar index if it is up to date (see smrReader.saveBlockIndex) and by walking the chain of
+    blocks through the file otherwise, which takes about 0.5s per hour of recording and writes the sidecar.
+    '''
+
+    def __init__(self, parent, smrFile):
+
+        QtCore.QThread.__init__(self, parent)
+        self.smrFile = smrFile
+        self.channels = None
+        self.error = None
+
+    def run(self):
+
+        try:
+            self.channels = SMRReader(self.smrFile).analogChannels
+        except (IOError, OSError, ValueError, IndexError, KeyError) as e:
+            self.error = str(e)
+
+
+class SMRFileSelect(FileSelect):
+    '''
+    FileSelect for SMR files that opens the selected file right away in an SMRFileOpener, so that its sidecar index is
+    ready when the file is loaded, and shows the channels and duration of the recording as tool tip.
+    '''
+
+    def __init__(self, title, parent=None):
+
+        FileSelect.__init__(self, title, 'SMR File( *.smr)', parent)
+        self.connect(self.dirPathW, QtCore.SIGNAL('editingFinished()'), self.openFile)
+
+    def setText(self, str):
+
+        FileSelect.setText(self, str)
+        self.openFile()
+
+    def openFile(self):
+
+        smrFile = str(self.dirPathW.text())
+        self.dirPathW.setToolTip('')
+        if not os.path.isfile(smrFile):
+            return
+
+        opener = SMRFileOpener(self, smrFile)
+        self.connect(opener, QtCore.SIGNAL('finished()'), lambda: self.showFileInfo(opener))
+        opener.start()
+
+    def showFileInfo(self, opener):
+
+        if opener.smrFile != str(self.dirPathW.text()):
+            # another file has been selected in the meantime
+            return
+
+        if opener.error is not None:
+            self.dirPathW.setToolTip('Could not read {}: {}'.format(opener.smrFile, opener.error))
+            return
+
+        description = ['{}: {:.1f}s to {:.1f}s at {:g}Hz'.format(x.title, x.tStart, x.tStop, x.samplingRate)
+                       for x in opener.channels]
+        self.dirPathW.setToolTip('\n'.join(['{} waveform channels'.format(len(opener.channels))] + description))
+
+
+class StageStatsPanel(QtGui.QDockWidget):
+    '''
+    Dock widget listing the stages reported to the instrumentation (see instrumentation.py) while it is shown. The
+    panel is an instrumentation sink; records from the loader thread are passed to the GUI thread with a signal.
+    '''
+
+    maxRows = 500
+
+    def __init__(self, parent=None):
+
+        QtGui.QDockWidget.__init__(self, 'Stage statistics', parent)
+        self.table = QtGui.QTableWidget(0, 4, self)
+        self.table.setHorizontalHeaderLabels(['Stage', 'Time (s)', 'Size (MB)', 'Samples'])
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.setEditTriggers(QtGui.QAbstractItemView.NoEditTriggers)
+        self.setWidget(self.table)
+        # shown and hidden only with setListening, so that it never listens while hidden
+        self.setFeatures(QtGui.QDockWidget.DockWidgetMovable | QtGui.QDockWidget.DockWidgetFloatable)
+
+        self.connect(self, QtCore.SIGNAL('stageRecorded(PyQt_PyObject)'), self.addRecord)
+
+    def __call__(self, record):
+
+        self.emit(QtCore.SIGNAL('stageRecorded(PyQt_PyObject)'), record)
+
+    def addRecord(self, record):
+
+        if self.table.rowCount() >= self.maxRows:
+            self.table.removeRow(0)
+        row = self.table.rowCount()
+        self.table.insertRow(row)
+        cells = [record['stage'], '{:.3f}'.format(record['duration']),
+                 '' if record['nBytes'] is None else '{:.1f}'.format(record['nBytes'] / 1024. ** 2),
+                 '' if record['nSamples'] is None else str(record['nSamples'])]
+        for column, text in enumerate(cells):
+            self.table.setItem(row, column, QtGui.QTableWidgetItem(text))
+        self.table.scrollToBottom()
+
+    def setListening(self, listening):
+        '''
+        Show the panel and start listening to the instrumentation, or hide it and stop
+        '''
+
+        if listening:
+            instrumentation.addSink(self)
+            self.show()
+        else:
+            instrumentation.removeSink(self)
+            self.hide()
+
+
+class RawDataLoader(QtCore.QThread):
+    '''
+    Constructs a RawDataViewer in a worker thread and, if detectSpikes is True, detects spikes with it. Emits
+    'stageDone(QString, double)' with the name and duration in s of each loading stage. Loading can be cancelled
+    with cancel(), which takes effect between stages and, in the chunked stages of streaming loads and spike
+    detection, after the current chunk. The reading of each channel in eager loads cannot be interrupted, so
+    CentralWidget loads with streaming=True.
+    '''
+
+    def __init__(self, parent, detectSpikes=False, **rawDataViewerKwargs):
+
+        QtCore.QThread.__init__(self, parent)
+        self.detectSpikes = detectSpikes
+        self.rawDataViewerKwargs = rawDataViewerKwargs
+        self.cancelRequested = False
+        self.rdi = None
+        self.error = None
+
+    def run(self):
+
+        try:
+            rdi = RawDataViewer(progressCallback=self.stageDone, **self.rawDataViewerKwargs)
+            if self.detectSpikes:
+                rdi.detectSpikes(progressCallback=self.stageDone)
+            self.rdi = rdi
+        except LoadCancelled:
+            pass
+        except Exception as e:
+            self.error = str(e)
+
+    def stageDone(self, stage, duration):
+
+        # chunks of chunked stages are reported with duration None, only to allow cancelling within the stage
+        if duration is not None:
+            self.emit(QtCore.SIGNAL('stageDone(QString, double)'), stage, duration)
+        if self.cancelRequested:
+            raise LoadCancelled()
+
+    def cancel(self):
+
+        self.cancelRequested = True
+
+
 class CentralWidget(QtGui.QWidget):
 
     def __init__(self, parent):
@@ -111,8 +310,21 @@ class CentralWidget(QtGui.QWidget):
         QtGui.QWidget.__init__(self, parent)
 
         iconsFolder = parent.iconsFolder
-
-        self.smrFileSelect = FileSelect('SMR File', 'SMR File( *.smr)')
+        self.statusBar = parent.statusBar()
+        self.loader = None
+        self.prefetcher = None
+        self.session = ViewerSession(sessionMaxBytes)
+        # session key of the recording being viewed and of the one being loaded
+        self.sessionKey = None
+        self.loaderKey = None
+
+        self.detectSpikesAction = QtGui.QAction('Detect spikes', self)
+        self.detectSpikesAction.setCheckable(True)
+        self.detectSpikesAction.setShortcut('F6')
+        self.detectSpikesAction.setStatusTip('Detect spikes in the membrane potential when loading data and mark them '
+                                             'in the plot')
+
+        self.smrFileSelect = SMRFileSelect('SMR File')
 
         fileSelectGrid = QtGui.QGridLayout()
 
@@ -125,8 +337,8 @@ class CentralWidget(QtGui.QWidget):
         startstopGrid.addWidget(self.startW, 0, 0)
         startstopGrid.addWidget(self.endW, 0, 1)
 
-        self.vCalib = TitledText("Voltage Calibration Entry")
-        self.ints2Exclude = TitledText("Intervals to Exclude Entry")
+        self.vCalib = TitledText("Voltage Calibration Entry", validator=parseCalibStr)
+        self.ints2Exclude = TitledText("Intervals to Exclude Entry", validator=parseExclusionStr)
         calibrationExclGrid = QtGui.QGridLayout()
         calibrationExclGrid.addWidget(self.vCalib, 0, 0)
         calibrationExclGrid.addWidget(self.ints2Exclude, 0, 1)
@@ -151,8 +363,21 @@ class CentralWidget(QtGui.QWidget):
 
         self.setLayout(vbox)
 
+        self.signalCache = SignalCache()
+
     def load(self):
 
+        if self.loader is not None and self.loader.isRunning():
+            self.startW.raiseInfo('Data is still being loaded. Please wait or cancel loading first.')
+            return
+
+        for field in (self.vCalib, self.ints2Exclude):
+            if field.error is not None:
+                field.line.setFocus()
+                field.line.setCursorPosition(field.error.position)
+                field.raiseInfo(str(field.error))
+                return
+
         vCalibStr = str(self.vCalib.line.text())
         if vCalibStr == '':
             vCalibStr = "20"
@@ -160,21 +385,140 @@ class CentralWidget(QtGui.QWidget):
         ints2Excl = str(self.ints2Exclude.line.text())
         if ints2Excl == '':
             ints2Excl = None
-        self.rdi = RawDataViewer(str(self.smrFileSelect.dirPathW.text()),
-                                 forceUnits=True,
-                                 voltageCalibStr=vCalibStr,
-                                 ints2Exclude=ints2Excl
-                                 )
-        tStart = min(self.rdi.vibrationSignal.t_start, self.rdi.voltageSignal.t_start)
-        if self.rdi.currentSignal is not None:
-            tStart = min(tStart, self.rdi.currentSignal.t_start)
-        tStart.units = qu.s
-
-        self.presentPlotStart = tStart
-        self.epochWidth = 20 * qu.s
+
+        smrFile = str(self.smrFileSelect.dirPathW.text())
+        self.loaderKey = None
+        if os.path.isfile(smrFile):
+            self.loaderKey = ViewerSession.key(smrFile, voltageCalibStr=vCalibStr, ints2Exclude=ints2Excl,
+                                               detectSpikes=self.detectSpikesAction.isChecked())
+            if self.loaderKey in self.session:
+                self.switchTo(self.loaderKey)
+                return
+
+        self.loader = RawDataLoader(self,
+                                    detectSpikes=self.detectSpikesAction.isChecked(),
+                                    smrFile=smrFile,
+                                    forceUnits=True,
+                                    streaming=True,
+                                    voltageCalibStr=vCalibStr,
+                                    ints2Exclude=ints2Excl,
+                                    signalCache=self.signalCache
+                                    )
+        self.stageTimings = []
+        self.connect(self.loader, QtCore.SIGNAL('stageDone(QString, double)'), self.showStage)
+        self.connect(self.loader, QtCore.SIGNAL('finished()'), self.loadFinished)
+        self.statusBar.showMessage('Loading...')
+        self.loader.start()
+
+    def cancelLoad(self):
+
+        if self.loader is not None and self.loader.isRunning():
+            self.loader.cancel()
+            self.statusBar.showMessage('Cancelling after the current chunk...')
+
+    def showStage(self, stage, duration):
+
+        self.stageTimings.append((str(stage), duration))
+        self.statusBar.showMessage('Loading... {} took {:.2f}s'.format(str(stage), duration))
+
+    def loadFinished(self):
+
+        totalTime = sum(duration for stage, duration in self.stageTimings)
+        timings = ', '.join('{} {:.2f}s'.format(stage, duration) for stage, duration in self.stageTimings)
+
+        if self.loader.error is not None:
+            self.statusBar.showMessage('Loading failed')
+            self.startW.raiseInfo('Error loading data: {}'.format(self.loader.error))
+            return
+        elif self.loader.rdi is None:
+            self.statusBar.showMessage('Loading cancelled after {:.2f}s ({})'.format(totalTime, timings))
+            return
+
+        self.statusBar.showMessage('Loaded in {:.2f}s ({})'.format(totalTime, timings))
+        if self.loaderKey is not None:
+            self.session.add(self.loaderKey, self.loader.rdi)
+        self.showViewer(self.loaderKey, self.loader.rdi, None)
+
+    def showViewer(self, key, rdi, viewState):
+        '''
+        Show a recording, at the epoch in viewState or, if viewState is None, at its first 20s
+        :param key: tuple or None, session key of the recording, see viewerSession.ViewerSession.key
+        :param rdi: rawDataImport.RawDataViewer
+        :param viewState: (presentPlotStart, epochWidth) or None
+        '''
+
+        self.saveViewState()
+        self.sessionKey = key
+        self.rdi = rdi
+
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        self.prefetcher = EpochPrefetcher(self.rdi, prefetchEpochs, prefetchMaxBytes)
+
+        if viewState is None:
+            tStart = min(self.rdi.vibrationSignal.t_start, self.rdi.voltageSignal.t_start)
+            if self.rdi.currentSignal is not None:
+                tStart = min(tStart, self.rdi.currentSignal.t_start)
+            tStart.units = qu.s
+
+            self.presentPlotStart = tStart
+            self.epochWidth = 20 * qu.s
+        else:
+            self.presentPlotStart, self.epochWidth = viewState
 
         self.draw(self.presentPlotStart, self.presentPlotStart + self.epochWidth)
 
+    def saveViewState(self):
+
+        if self.sessionKey is not None:
+            self.session.setViewState(self.sessionKey, (self.presentPlotStart, self.epochWidth))
+
+    def switchTo(self, key):
+        '''
+        Show a recording kept in the session, with the entries it was loaded with and at the epoch last viewed
+        :param key: tuple, see viewerSession.ViewerSession.key
+        '''
+
+        if self.loader is not None and self.loader.isRunning():
+            self.startW.raiseInfo('Data is still being loaded. Please wait or cancel loading first.')
+            return
+
+        # the view state of the recording being viewed may be the one returned
+        self.saveViewState()
+        entry = self.session.get(key)
+        if entry is None:
+            return
+
+        smrFile, smrFileStat, loadPars = key
+        loadPars = dict(loadPars)
+        self.smrFileSelect.setText(smrFile)
+        self.vCalib.setText(loadPars['voltageCalibStr'])
+        self.ints2Exclude.setText(loadPars['ints2Exclude'] or '')
+        self.detectSpikesAction.setChecked(loadPars['detectSpikes'])
+
+        self.showViewer(key, *entry)
+        self.statusBar.showMessage('Switched to {} ({} recordings open, {:.1f}MB)'.format(
+            os.path.basename(smrFile), len(self.session), self.session.nbytes / 1024. ** 2))
+
+    def fillSessionMenu(self, menu):
+        '''
+        List the recordings kept in the session in menu, most recently viewed first, to switch to them
+        :param menu: QtGui.QMenu
+        '''
+
+        menu.clear()
+        for key in self.session.keys():
+            smrFile, smrFileStat, loadPars = key
+            loadPars = dict(loadPars)
+            text = '{} (calibration {}, excluded {})'.format(os.path.basename(smrFile), loadPars['voltageCalibStr'],
+                                                             loadPars['ints2Exclude'] or 'none')
+            action = menu.addAction(text)
+            action.setCheckable(True)
+            action.setChecked(key == self.sessionKey)
+            self.connect(action, QtCore.SIGNAL('triggered()'), lambda key=key: self.switchTo(key))
+        if not len(self.session):
+            menu.addAction('No recordings loaded').setEnabled(False)
+
     def refresh(self):
 
         if not hasattr(self, 'rdi'):
@@ -208,11 +552,19 @@ class CentralWidget(QtGui.QWidget):
 
     def draw(self, start=None, end=None):
 
+        drawStartTime = time.time()
         if start:
             self.presentPlotStart = start
-        self.mplPlot.axes.clear()
-        self.rdi.plotVibEpoch(self.mplPlot.axes, [start, end])
-        self.mplPlot.draw()
+        maxBins = plotMaxBins(self.mplPlot.axes)
+        epochTraces = self.prefetcher.get(start, end - start, maxBins)
+        artists, limitsChanged = self.rdi.updateVibEpoch(self.mplPlot.axes, [start, end], epochTraces=epochTraces)
+        self.mplPlot.drawIncremental(artists, limitsChanged)
+        self.prefetcher.prefetch(start, end - start, maxBins)
+
+        if instrumentation.sinks:
+            instrumentation.recordStage('draw', time.time() - drawStartTime, epochTracesNBytes(epochTraces),
+                                        sum(traceTimes.shape[0] for signalAttr, traceTimes, traceValues
+                                            in epochTraces))
 
     def plotNextInterval(self):
 
@@ -272,14 +624,38 @@ class MainWindow(QtGui.QMainWindow):
 
         toolbar.addAction(refresh)
 
+        cancelLoad = QtGui.QAction(QtGui.QIcon(os.path.join(self.iconsFolder, 'cancel.png')), 'Cancel loading', self)
+        cancelLoad.setShortcut('Esc')
+        cancelLoad.setStatusTip('Cancel loading data')
+        self.connect(cancelLoad, QtCore.SIGNAL('triggered()'), self.centralW.cancelLoad)
+
+        toolbar.addAction(cancelLoad)
+
+        toolbar.addAction(self.centralW.detectSpikesAction)
+
+        self.statsPanel = StageStatsPanel(self)
+        self.addDockWidget(QtCore.Qt.BottomDockWidgetArea, self.statsPanel)
+        self.statsPanel.hide()
+
+        showStats = QtGui.QAction('Stage statistics', self)
+        showStats.setCheckable(True)
+        showStats.setShortcut('F7')
+        showStats.setStatusTip('Show the duration, size and number of samples of each loading and drawing stage')
+        self.connect(showStats, QtCore.SIGNAL('toggled(bool)'), self.statsPanel.setListening)
 
         menubar = self.menuBar()
         file = menubar.addMenu('&File')
         file.addAction(loadData)
         file.addAction(refresh)
+        file.addAction(cancelLoad)
+        file.addAction(self.centralW.detectSpikesAction)
+        file.addAction(showStats)
 
         file.addAction(exit)
 
+        session = menubar.addMenu('&Session')
+        self.connect(session, QtCore.SIGNAL('aboutToShow()'), lambda: self.centralW.fillSessionMenu(session))
+
 
 
     def resizeAndCenter(self):
@@ -306,6 +682,7 @@ class MainWindow(QtGui.QMainWindow):
 
 def main():
 
+    instrumentation.enableFromEnvironment()
     app = QtGui.QApplication(sys.argv)
     main = MainWindow()
     main.show()
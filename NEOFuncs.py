@@ -4,11 +4,112 @@ import quantities as pq
 
 #***********************************************************************************************************************
 
-def downSampleAnalogSignal(analogSignal, downSampleFactor):
+# modes of downSampleAnalogSignal
+decimationModes = ['stride', 'fir', 'minmax']
+
+# half length of the anti-aliasing filter of the 'fir' decimation mode, in sampling periods of the downsampled signal
+firHalfLength = 10
+
+
+def firDecimationTaps(downSampleFactor, halfLength=firHalfLength):
+    '''
+    Polyphase taps of a Hamming windowed sinc low pass filter with its cutoff at the Nyquist frequency of the signal
+    downsampled by downSampleFactor.
+    :param downSampleFactor: int, must be at least 1
+    :param halfLength: int, half length of the filter in downsampled sampling periods
+    :return: numpy.ndarray of shape (2 * halfLength + 1, downSampleFactor). Row q holds the taps applied to the
+    downSampleFactor samples starting q - halfLength downsampled sampling periods from an output sample.
+    '''
+
+    nTaps = (2 * halfLength + 1) * downSampleFactor
+    offsets = np.arange(nTaps) - halfLength * downSampleFactor
+    window = np.where(np.abs(offsets) <= halfLength * downSampleFactor,
+                      0.54 + 0.46 * np.cos(np.pi * offsets / float(max(1, halfLength * downSampleFactor))), 0)
+    taps = np.sinc(offsets / float(downSampleFactor)) * window
+
+    return (taps / taps.sum()).reshape((2 * halfLength + 1, downSampleFactor))
+
+#***********************************************************************************************************************
+
+def firDecimate(samples, downSampleFactor, outStartInd, outEndInd, taps):
+    '''
+    Samples outStartInd to outEndInd (excluded) of the anti-aliased decimation of samples. Output sample n is the
+    filtered signal at the index n * downSampleFactor of samples; samples beyond the ends of samples are taken to be
+    equal to the first or the last sample. Only the filtered values at the output samples are computed.
+    :param samples: 1D numpy.ndarray
+    :param downSampleFactor: int, must be at least 1
+    :param outStartInd: int
+    :param outEndInd: int
+    :param taps: output of firDecimationTaps for downSampleFactor
+    :return: numpy.ndarray of float64
+    '''
+
+    halfLength = (taps.shape[0] - 1) // 2
+    nOut = outEndInd - outStartInd
+
+    inds = np.arange((outStartInd - halfLength) * downSampleFactor, (outEndInd + halfLength) * downSampleFactor)
+    np.clip(inds, 0, samples.shape[0] - 1, out=inds)
+    blocks = samples[inds].reshape((nOut + 2 * halfLength, downSampleFactor))
+
+    # blockResponses[m, q] is the contribution of block m to the output sample m - q + halfLength
+    blockResponses = blocks.dot(taps.T)
+    out = blockResponses[:nOut, 0].copy()
+    for q in range(1, taps.shape[0]):
+        out += blockResponses[q: q + nOut, q]
+
+    return out
+
+#***********************************************************************************************************************
+
+def decimateSamples(samples, downSampleFactor, mode='stride', chunkSize=2 ** 20):
+    '''
+    Decimate samples by an integer factor
+    :param samples: 1D numpy.ndarray
+    :param downSampleFactor: int, must be at least 1
+    :param mode: str, one of decimationModes. 'stride' takes every downSampleFactor-th sample and returns a view of
+    samples. 'fir' low pass filters samples before taking every downSampleFactor-th sample, so that frequencies above
+    the new Nyquist frequency do not alias, see firDecimate. 'minmax' returns, for each downSampleFactor samples,
+    their minimum and maximum, so twice as many samples as the other modes.
+    :param chunkSize: int, approximate number of samples processed at a time by the 'fir' and 'minmax' modes
+    :return: numpy.ndarray
+    '''
+
+    assert mode in decimationModes, 'mode must be one of {}'.format(decimationModes)
+
+    if mode == 'stride':
+        return samples[::downSampleFactor]
+
+    nOut = (samples.shape[0] + downSampleFactor - 1) // downSampleFactor
+    outChunkSize = max(1, chunkSize // downSampleFactor)
+
+    if mode == 'fir':
+        out = np.empty(nOut, dtype=samples.dtype)
+        taps = firDecimationTaps(downSampleFactor)
+        for outStartInd in range(0, nOut, outChunkSize):
+            outEndInd = min(nOut, outStartInd + outChunkSize)
+            out[outStartInd: outEndInd] = firDecimate(samples, downSampleFactor, outStartInd, outEndInd, taps)
+
+    else:
+        out = np.empty(2 * nOut, dtype=samples.dtype)
+        for outStartInd in range(0, nOut, outChunkSize):
+            chunk = samples[outStartInd * downSampleFactor: (outStartInd + outChunkSize) * downSampleFactor]
+            binStarts = np.arange(0, chunk.shape[0], downSampleFactor)
+            outEndInd = outStartInd + binStarts.shape[0]
+            out[2 * outStartInd: 2 * outEndInd: 2] = np.minimum.reduceat(chunk, binStarts)
+            out[2 * outStartInd + 1: 2 * outEndInd: 2] = np.maximum.reduceat(chunk, binStarts)
+
+    return out
+
+#***********************************************************************************************************************
+
+def downSampleAnalogSignal(analogSignal, downSampleFactor, mode='stride', chunkSize=2 ** 20):
     '''
     Downsamples the input analogsignal, with the downsampled signal having the same t_start as analogsignal
     :param analogSignal: neo.analogsignal
     :param downSampleFactor: int, must be at least 1
+    :param mode: str, see decimateSamples. With 'stride', the downsampled signal shares memory with analogSignal.
+    With 'minmax', it has twice the sampling rate of the other modes.
+    :param chunkSize: int, see decimateSamples
     :return: analogSignalDown, neo.analogsignal with sampling rate = analogsignal.sampling_rate/factor
     and analogSignalDown.t_start = analogSignal.t_start
     '''
@@ -21,8 +122,10 @@ def downSampleAnalogSignal(analogSignal, downSampleFactor):
 
     else:
         newSamplingRate = analogSignal.sampling_rate / downSampleFactor
-        downSamplingIndices = range(0, analogSignal.shape[0], downSampleFactor)
-        analogSignalMagnitude = analogSignal.magnitude[downSamplingIndices]
+        if mode == 'minmax':
+            newSamplingRate = 2 * newSamplingRate
+        samples = analogSignal.magnitude.reshape((analogSignal.shape[0],))
+        analogSignalMagnitude = decimateSamples(samples, downSampleFactor, mode, chunkSize)
 
         analogSignalDown = AnalogSignal(signal=analogSignalMagnitude,
                                                 units=analogSignal.units,
@@ -34,6 +137,55 @@ def downSampleAnalogSignal(analogSignal, downSampleFactor):
 
 #***********************************************************************************************************************
 
+def quantity2Seconds(t):
+    '''
+    Float value in s of a time, which can be a quantities.Quantity or a float already in s
+    '''
+
+    if isinstance(t, pq.Quantity):
+        return float(t.rescale(pq.s).magnitude)
+    else:
+        return float(t)
+
+
+def signalTimeBase(analogSignal):
+    '''
+    Time base of a neo.AnalogSignal as plain numbers, so that time to index arithmetic needs no quantities. Units are
+    converted here, once.
+    :param analogSignal: neo.AnalogSignal
+    :return: tStart, samplingPeriod, nSamples; floats in s and int
+    '''
+
+    return (quantity2Seconds(analogSignal.t_start), quantity2Seconds(analogSignal.sampling_period),
+            analogSignal.shape[0])
+
+
+def sliceIndices(tStart, samplingPeriod, nSamples, sliceStartTime=None, sliceEndTime=None):
+    '''
+    Index range of the samples of a signal between two times, including the sample at sliceEndTime, as taken by
+    sliceAnalogSignal
+    :param tStart: float, time in s of the first sample
+    :param samplingPeriod: float, in s
+    :param nSamples: int, number of samples of the signal
+    :param sliceStartTime: float, in s, must be at least tStart. If None, the range starts at the first sample.
+    :param sliceEndTime: float, in s, must be at most the end of the signal. If None, the range ends at the last
+    sample.
+    :return: startInd, endInd; ints, endInd exclusive
+    '''
+
+    tStop = tStart + nSamples * samplingPeriod
+    if sliceStartTime is None:
+        sliceStartTime = tStart
+    if sliceEndTime is None:
+        sliceEndTime = tStop
+
+    assert sliceStartTime >= tStart, 'sliceStartTime must be >= analogSignal.t_start'
+    assert sliceEndTime <= tStop, 'sliceEndTime must be <= analogSignal.t_stop'
+
+    return int((sliceStartTime - tStart) / samplingPeriod), int((sliceEndTime - tStart) / samplingPeriod) + 1
+
+#***********************************************************************************************************************
+
 def sliceAnalogSignal(analogSignal, sliceStartTime=None, sliceEndTime=None):
     '''
     Slice a neo.analogsignal using times instead of indices
@@ -47,24 +199,59 @@ def sliceAnalogSignal(analogSignal, sliceStartTime=None, sliceEndTime=None):
 
     assert type(analogSignal) is AnalogSignal, 'analogSignal must be a neo.AnalogSignal'
 
-    if sliceStartTime is None:
-        sliceStartTime = analogSignal.t_start
+    assert sliceStartTime is None or type(sliceStartTime) is pq.Quantity, \
+        'sliceStartTime must be a quantities.Quanitity'
+    assert sliceEndTime is None or type(sliceEndTime) is pq.Quantity, 'sliceEndTime must be a quantities.Quanitity'
 
-    if sliceEndTime is None:
-        sliceEndTime = analogSignal.t_stop
+    tStart, samplingPeriod, nSamples = signalTimeBase(analogSignal)
+    sliceStartInd, sliceEndInd = sliceIndices(tStart, samplingPeriod, nSamples,
+                                              None if sliceStartTime is None else quantity2Seconds(sliceStartTime),
+                                              None if sliceEndTime is None else quantity2Seconds(sliceEndTime))
+
+    toReturn = analogSignal[sliceStartInd: sliceEndInd]
+
+    return toReturn
 
-    assert type(sliceStartTime) is pq.Quantity, 'sliceStartTime must be a quantities.Quanitity'
-    assert type(sliceEndTime) is pq.Quantity, 'sliceEndTime must be a quantities.Quanitity'
+#***********************************************************************************************************************
 
-    assert sliceStartTime >= analogSignal.t_start, 'sliceStartTime must be >= analogSignal.t_start'
-    assert sliceEndTime <= analogSignal.t_stop, 'sliceEndTime must be <= analogSignal.t_stop'
+def robustThreshold(samples, nSigmas=5.):
+    '''
+    Spike detection threshold nSigmas noise standard deviations above the median of samples. The standard deviation is
+    estimated from the median absolute deviation, so that spikes hardly affect it.
+    :param samples: 1D numpy.ndarray
+    :param nSigmas: float
+    :return: float
+    '''
 
-    sliceStartInd = int(((sliceStartTime - analogSignal.t_start) / analogSignal.sampling_period).simplified)
-    sliceEndInd = int(((sliceEndTime - analogSignal.t_start) / analogSignal.sampling_period).simplified)
+    median = np.median(samples)
+    return float(median + nSigmas * np.median(np.abs(samples - median)) / 0.6745)
 
-    toReturn = analogSignal[sliceStartInd: sliceEndInd + 1]
+#***********************************************************************************************************************
 
-    return toReturn
+def detectSpikeInds(samples, threshold, peakWindow, refractory):
+    '''
+    Indices of spike peaks in samples. A spike starts where samples cross threshold upwards, at least refractory
+    samples after the previous upward crossing, and peaks at the maximum of the peakWindow samples starting at the
+    crossing.
+    :param samples: 1D numpy.ndarray
+    :param threshold: float
+    :param peakWindow: int, at least 1
+    :param refractory: int
+    :return: crossingInds, peakInds; numpy.ndarrays of int
+    '''
+
+    above = samples >= threshold
+    crossingInds = np.flatnonzero(above[1:] & ~above[:-1]) + 1
+
+    if crossingInds.shape[0] > 1:
+        keep = np.ones(crossingInds.shape[0], dtype=bool)
+        keep[1:] = np.diff(crossingInds) >= refractory
+        crossingInds = crossingInds[keep]
+
+    windowInds = np.minimum(crossingInds[:, None] + np.arange(peakWindow)[None, :], samples.shape[0] - 1)
+    peakInds = crossingInds + np.argmax(samples[windowInds], axis=1) if crossingInds.shape[0] else crossingInds
+
+    return crossingInds, peakInds
 
 #***********************************************************************************************************************
 
@@ -105,6 +292,57 @@ def getSpikeRateIn(spikeTrain, intervalStart=None, intervalEnd=None):
 
 #***********************************************************************************************************************
 
+def getSpikeIndRangesIn(spikeTimes, intervalStarts, intervalEnds):
+    '''
+    Index ranges of the spikes in each of many time intervals, found by binary search instead of masking all spike
+    times for each interval
+    :param spikeTimes: quantities.Quantity, sorted spike times, e.g., spikeTrain.times
+    :param intervalStarts: quantities.Quantity, start times of the intervals
+    :param intervalEnds: quantities.Quantity, end times of the intervals
+    :return: startInds, endInds; numpy.ndarrays of int, the spikes in interval i, as defined in getSpikesIn, are
+    spikeTimes[startInds[i]: endInds[i]]
+    '''
+
+    spikeTimesMag = spikeTimes.magnitude
+    intervalStartsMag = intervalStarts.rescale(spikeTimes.units).magnitude
+    intervalEndsMag = intervalEnds.rescale(spikeTimes.units).magnitude
+
+    return np.searchsorted(spikeTimesMag, intervalStartsMag, side='left'), \
+        np.searchsorted(spikeTimesMag, intervalEndsMag, side='left')
+
+#***********************************************************************************************************************
+
+def getSpikeCountsIn(spikeTimes, intervalStarts, intervalEnds):
+    '''
+    Number of spikes in each of many time intervals, see getSpikeIndRangesIn
+    :return: numpy.ndarray of int
+    '''
+
+    startInds, endInds = getSpikeIndRangesIn(spikeTimes, intervalStarts, intervalEnds)
+    return endInds - startInds
+
+#***********************************************************************************************************************
+
+def getSpikeRatesIn(spikeTrain, intervalStarts, intervalEnds):
+    '''
+    Spike rates of a spike train in each of many time intervals, as in getSpikeRateIn
+    :param spikeTrain: neo.spiketrain
+    :param intervalStarts: quantities.Quantity, start times of the intervals
+    :param intervalEnds: quantities.Quantity, end times of the intervals
+    :return: numpy.ndarray of floats, spike rates in Hz
+    '''
+
+    spikeTimes = spikeTrain.times
+    if np.any(np.diff(spikeTimes.magnitude) < 0):
+        spikeTimes = np.sort(spikeTimes)
+
+    counts = getSpikeCountsIn(spikeTimes, intervalStarts, intervalEnds)
+    intervalDurations = (intervalEnds - intervalStarts).rescale(pq.s).magnitude
+
+    return counts / intervalDurations.astype(float)
+
+#***********************************************************************************************************************
+
 def simpleFloat(quant):
     '''
     Float(s) of simplified version(s) of a quantity.Quantity or an iterable of quantity.Quantity objects
@@ -120,7 +358,7 @@ def simpleFloat(quant):
 
         if quant.shape[0]:
 
-            return [float(q.simplified) for q in quant]
+            return quant.simplified.magnitude.astype(float).tolist()
 
     else:
 
@@ -129,8 +367,15 @@ def simpleFloat(quant):
 #***********************************************************************************************************************
 
 def getSpikeAmps(resp, spikeTimes):
+    '''
+    Values of a signal at the samples of spike times
+    :param resp: neo.AnalogSignal
+    :param spikeTimes: quantities.Quantity
+    :return: quantities.Quantity, in the units of resp; the samples are picked from the magnitude of resp, as
+    indexing a neo.AnalogSignal with an array of indices is not supported by all versions of neo
+    '''
 
-    spikeInds = map(int, (spikeTimes - resp.t_start) * resp.sampling_rate)
-    return resp[spikeInds]
+    spikeInds = ((spikeTimes - resp.t_start) * resp.sampling_rate).simplified.magnitude.astype(int)
+    return pq.Quantity(resp.magnitude[spikeInds], units=resp.units)
 
 #***********************************************************************************************************************
\ No newline at end of file
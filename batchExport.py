@@ -0,0 +1,247 @@
+'''
+Headless conversion of a directory of SMR files into NIX files, one per recording, without the GUI. Signals are
+cleaned of the intervals to exclude and calibrated as in the GUI, but not downsampled.
+
+Usage: python batchExport.py <SMR directory> <calibration table> <output directory> [--workers N] [--forceUnits]
+       [--redo]
+
+The calibration table is a CSV file with a header row or a JSON file, giving per SMR file name the calibration string
+of the membrane potential channel and, optionally, those of the vibration and current channels and the intervals to
+exclude:
+
+    smrFile,voltageCalibStr,vibrationCalibStr,currentCalibStr,ints2Exclude
+    140813-3Al.smr,20,,,0-5;100-maxtime
+
+    {"140813-3Al.smr": {"voltageCalibStr": "20", "ints2Exclude": "0-5;100-maxtime"}}
+
+Files are converted on a pool of worker processes. The outcome and duration of each file, and the entry of the
+calibration table it was converted with, are recorded in batchProgress.json in the output directory, so that an
+interrupted run continues with the files not yet converted when started again. Files whose entry in the calibration
+table has changed since they were converted are converted again.
+'''
+from __future__ import print_function
+import os
+import csv
+import json
+import time
+import argparse
+import multiprocessing
+import nixio as nix
+from rawDataImport import openLazySignals, reportStage, validateProcessingStrings
+from neoNIXIO import AnalogSignalWriter, nixValues
+
+# calibration strings used when the calibration table does not give one, as in rawDataImport.RawDataViewer
+defaultCalibStrings = {'vibrationCalibStr': '27.1', 'currentCalibStr': '10'}
+
+progressFileName = 'batchProgress.json'
+
+#***********************************************************************************************************************
+
+
+def readCalibTable(calibTableFile):
+    '''
+    Read the calibration and exclusion strings of SMR files from a CSV or JSON file, see the module docstring
+    :param calibTableFile: str, path of a file ending in .csv or .json
+    :return: dict, keys are SMR file names and values are dicts with the keys 'voltageCalibStr',
+    'vibrationCalibStr', 'currentCalibStr' and 'ints2Exclude'
+    '''
+
+    if calibTableFile.lower().endswith('.json'):
+        with open(calibTableFile) as fle:
+            rows = [dict(entry, smrFile=smrFile) for smrFile, entry in json.load(fle).items()]
+    elif calibTableFile.lower().endswith('.csv'):
+        with open(calibTableFile) as fle:
+            rows = list(csv.DictReader(fle))
+    else:
+        raise ValueError('Calibration table must be a .csv or a .json file, got {}'.format(calibTableFile))
+
+    calibTable = {}
+    for row in rows:
+        if not row.get('voltageCalibStr'):
+            raise ValueError('No voltageCalibStr given for {}'.format(row.get('smrFile')))
+        entry = {'voltageCalibStr': row['voltageCalibStr'],
+                 'ints2Exclude': row.get('ints2Exclude') or None}
+        for calibStrKey, defaultCalibStr in defaultCalibStrings.items():
+            entry[calibStrKey] = row.get(calibStrKey) or defaultCalibStr
+        # report improper strings before any file is converted
+        validateProcessingStrings(dict((x, entry[x]) for x in ('voltageCalibStr', 'vibrationCalibStr',
+                                                                'currentCalibStr')),
+                                  entry['ints2Exclude'])
+        calibTable[os.path.basename(row['smrFile'])] = entry
+
+    return calibTable
+
+#***********************************************************************************************************************
+
+
+def exportSMR2NIX(smrFile, nixFile, calibEntry, forceUnits=False, progressCallback=None):
+    '''
+    Read, clean and calibrate the signals of an SMR file at full resolution and write them into a new NIX file, along
+    with the strings used to process them. Signals are streamed window by window into compressed data arrays, so that
+    memory use does not depend on the length of the recording. The NIX file is only created once complete.
+    :param smrFile: str, path of the SMR file
+    :param nixFile: str, path of the NIX file to create, overwritten if it exists
+    :param calibEntry: dict, an entry of the output of readCalibTable
+    :param forceUnits: bool, whether to force the units mV, um and nA on the signals
+    :param progressCallback: callable or None, see rawDataImport.RawDataViewer
+    '''
+
+    calibStrings = dict((x, calibEntry[x]) for x in ('voltageCalibStr', 'vibrationCalibStr', 'currentCalibStr'))
+    lazySignals = openLazySignals(smrFile, calibStrings, None, calibEntry['ints2Exclude'], forceUnits)
+
+    tempFile = nixFile + '.part'
+    nixFileObj = nix.File.open(tempFile, nix.FileMode.Overwrite)
+    try:
+        blk = nixFileObj.create_block(os.path.splitext(os.path.basename(smrFile))[0], 'RawDataTraces')
+        for lazySignal in lazySignals:
+            if lazySignal is None:
+                continue
+            stageStartTime = time.time()
+            writer = AnalogSignalWriter(blk, lazySignal.name, lazySignal.units, lazySignal.sampling_period,
+                                        lazySignal.t_start, lazySignal.nSamples)
+            for outStartInd, samples, rawSamples in lazySignal.iterChunks(
+                    AnalogSignalWriter.windowSize(lazySignal.sampling_period)):
+                writer.write(samples)
+            reportStage(progressCallback, '{}: export'.format(lazySignal.name), stageStartTime,
+                        nSamples=lazySignal.nSamples)
+
+        sec = nixFileObj.create_section('ProcessingParameters', 'ProcessingParameters')
+        sec.create_property('SMRFile', nixValues([os.path.basename(smrFile)]))
+        for key in sorted(calibEntry):
+            if calibEntry[key] is not None:
+                sec.create_property(key, nixValues([str(calibEntry[key])]))
+        blk.metadata = sec
+    finally:
+        nixFileObj.close()
+
+    if os.path.isfile(nixFile):
+        os.remove(nixFile)
+    os.rename(tempFile, nixFile)
+
+#***********************************************************************************************************************
+
+
+def exportJob(job):
+    '''
+    Worker of batchExport. Errors are returned rather than raised so that one broken file does not stop the batch.
+    :param job: tuple (smrFile, nixFile, calibEntry, forceUnits), see exportSMR2NIX
+    :return: dict with the keys 'smrFile', 'nixFile', 'status' ('done' or 'failed'), 'duration' (s), 'stages' (list
+    of [stage, duration in s]), 'error', 'calibEntry' and 'forceUnits'
+    '''
+
+    smrFile, nixFile, calibEntry, forceUnits = job
+    stages = []
+    startTime = time.time()
+
+    try:
+        exportSMR2NIX(smrFile, nixFile, calibEntry, forceUnits,
+                      progressCallback=lambda stage, duration: stages.append([stage, duration]))
+        status, error = 'done', None
+    except Exception as e:
+        status, error = 'failed', '{}: {}'.format(type(e).__name__, e)
+
+    return {'smrFile': smrFile, 'nixFile': nixFile, 'status': status, 'duration': time.time() - startTime,
+            'stages': stages, 'error': error, 'calibEntry': calibEntry, 'forceUnits': forceUnits}
+
+#***********************************************************************************************************************
+
+
+def loadProgress(progressFile):
+
+    if os.path.isfile(progressFile):
+        with open(progressFile) as fle:
+            return json.load(fle)
+    return {}
+
+
+def saveProgress(progressFile, progress):
+
+    tempFile = progressFile + '.part'
+    with open(tempFile, 'w') as fle:
+        json.dump(progress, fle, indent=2, sort_keys=True)
+    if os.path.isfile(progressFile):
+        os.remove(progressFile)
+    os.rename(tempFile, progressFile)
+
+#***********************************************************************************************************************
+
+
+def batchExport(smrDir, calibTableFile, outDir, nWorkers=None, forceUnits=False, redo=False):
+    '''
+    Convert the SMR files of smrDir listed in a calibration table into NIX files in outDir, on a pool of nWorkers
+    processes. Files recorded as done in the progress file of outDir are skipped unless redo is True or they were
+    converted with another entry of the calibration table or another forceUnits.
+    :param smrDir: str, directory containing SMR files
+    :param calibTableFile: str, see readCalibTable
+    :param outDir: str, directory for the NIX files and the progress file, created if necessary
+    :param nWorkers: int, number of worker processes. If None, the number of CPUs
+    :param forceUnits: bool, see exportSMR2NIX
+    :param redo: bool, whether to convert files already converted in a previous run
+    :return: dict, progress, by SMR file name, with the values returned by exportJob
+    '''
+
+    calibTable = readCalibTable(calibTableFile)
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    progressFile = os.path.join(outDir, progressFileName)
+    progress = {} if redo else loadProgress(progressFile)
+
+    jobs = []
+    for smrFileName in sorted(os.listdir(smrDir)):
+        if not smrFileName.lower().endswith('.smr'):
+            continue
+        if smrFileName not in calibTable:
+            print('Skipping {}: not in the calibration table'.format(smrFileName))
+            continue
+        nixFile = os.path.join(outDir, os.path.splitext(smrFileName)[0] + '.h5')
+        previous = progress.get(smrFileName, {})
+        if previous.get('status') == 'done' and os.path.isfile(nixFile) \
+                and previous.get('calibEntry') == calibTable[smrFileName] \
+                and previous.get('forceUnits') == forceUnits:
+            continue
+        jobs.append((os.path.join(smrDir, smrFileName), nixFile, calibTable[smrFileName], forceUnits))
+
+    if not jobs:
+        print('Nothing to convert')
+        return progress
+
+    nWorkers = min(len(jobs), nWorkers or multiprocessing.cpu_count())
+    print('Converting {} files with {} workers'.format(len(jobs), nWorkers))
+    batchStartTime = time.time()
+
+    # a fresh process per file returns the memory of large recordings to the system
+    pool = multiprocessing.Pool(nWorkers, maxtasksperchild=1)
+    try:
+        for jobInd, result in enumerate(pool.imap_unordered(exportJob, jobs)):
+            smrFileName = os.path.basename(result['smrFile'])
+            progress[smrFileName] = result
+            saveProgress(progressFile, progress)
+            print('[{}/{}] {} {} in {:.1f}s{}'.format(jobInd + 1, len(jobs), smrFileName, result['status'],
+                                                     result['duration'],
+                                                     '' if result['error'] is None else ': ' + result['error']))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    nFailed = sum(1 for x in progress.values() if x['status'] == 'failed')
+    print('Finished in {:.1f}s, {} failed'.format(time.time() - batchStartTime, nFailed))
+
+    return progress
+
+#***********************************************************************************************************************
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Convert a directory of SMR files into NIX files')
+    parser.add_argument('smrDir', help='directory containing the SMR files')
+    parser.add_argument('calibTable', help='CSV or JSON file with the calibration strings of each SMR file')
+    parser.add_argument('outDir', help='directory for the NIX files')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes, by default the number of CPUs')
+    parser.add_argument('--forceUnits', action='store_true', help='force the units mV, um and nA on the signals')
+    parser.add_argument('--redo', action='store_true', help='convert files already converted in a previous run')
+    args = parser.parse_args()
+
+    batchExport(args.smrDir, args.calibTable, args.outDir, args.workers, args.forceUnits, args.redo)
@@ -0,0 +1,68 @@
+'''
+Compares the decimation modes of NEOFuncs.downSampleAnalogSignal with the original implementation, which indexed the
+signal with a list of indices, on a synthetic signal sampled like the membrane potential channel of the recordings.
+
+Usage: python benchmarks/decimationBenchmark.py [<duration in s>]
+'''
+from __future__ import print_function
+import os
+import sys
+import time
+import numpy as np
+import quantities as qu
+from neo import AnalogSignal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from NEOFuncs import downSampleAnalogSignal, decimationModes
+
+
+def legacyDownSample(analogSignal, downSampleFactor):
+
+    downSamplingIndices = range(0, analogSignal.shape[0], downSampleFactor)
+    analogSignalDown = AnalogSignal(signal=analogSignal.magnitude[downSamplingIndices],
+                                    units=analogSignal.units,
+                                    sampling_rate=analogSignal.sampling_rate / downSampleFactor,
+                                    t_start=analogSignal.t_start)
+    return analogSignalDown.reshape((analogSignalDown.shape[0],))
+
+
+def timeIt(func, nRepeats=3):
+
+    durations = []
+    for repeat in range(nRepeats):
+        startTime = time.time()
+        func()
+        durations.append(time.time() - startTime)
+    return min(durations)
+
+
+if __name__ == '__main__':
+
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 600.
+    samplingRate = 20000.
+    maxFreq = 700.
+    downSampleFactor = int(samplingRate / maxFreq)
+
+    times = np.arange(int(duration * samplingRate)) / samplingRate
+    # slow oscillation plus a component above the Nyquist frequency of the downsampled signal, which aliases unless
+    # it is filtered out
+    samples = (10 * np.sin(2 * np.pi * 5 * times) + np.sin(2 * np.pi * 3000 * times)).astype(np.float32)
+    analogSignal = AnalogSignal(signal=samples, units=qu.mV, sampling_rate=samplingRate * qu.Hz, t_start=0 * qu.s)
+    expected = 10 * np.sin(2 * np.pi * 5 * times[::downSampleFactor])
+
+    print('{:.0f} s at {:.0f} Hz, downsampled by {}'.format(duration, samplingRate, downSampleFactor))
+    print('{:<10}{:>12}{:>24}'.format('mode', 'time (s)', 'max alias error (mV)'))
+
+    legacyTime = timeIt(lambda: legacyDownSample(analogSignal, downSampleFactor))
+    legacyError = np.abs(legacyDownSample(analogSignal, downSampleFactor).magnitude - expected).max()
+    print('{:<10}{:>12.4f}{:>24.4f}'.format('legacy', legacyTime, legacyError))
+
+    for mode in decimationModes:
+        modeTime = timeIt(lambda: downSampleAnalogSignal(analogSignal, downSampleFactor, mode))
+        if mode == 'minmax':
+            modeError = float('nan')
+        else:
+            downSampled = downSampleAnalogSignal(analogSignal, downSampleFactor, mode).magnitude
+            # the ends of the filtered signal are affected by padding
+            modeError = np.abs(downSampled - expected)[100: -100].max()
+        print('{:<10}{:>12.4f}{:>24.4f}'.format(mode, modeTime, modeError))
@@ -0,0 +1,449 @@
+'''
+Times the stages of loading, processing, slicing, plotting and saving recordings on synthetic SMR files (see
+tests/syntheticSMR.py) of several durations, sampling rates and numbers of channels. Each stage runs in a fresh
+process, so that its peak resident memory is not hidden by that of earlier stages. Results are written to a JSON file
+and, if a baseline file is given, compared with it; stages slower or larger than the baseline by more than the
+tolerance are reported as regressions and make the exit status 1.
+
+Usage: python benchmarks/hotPathBenchmark.py [--durations 60 600 ...] [--rates 20000 50000 ...] [--channels 2 3 ...]
+       [--stages ...] [--repeats N] [--workDir DIR] [--out FILE] [--baseline FILE] [--saveBaseline FILE]
+       [--tolerance 0.25]
+
+Synthetic files are kept in the work directory and reused by later runs; a 4 h recording at 50 kHz with 3 channels
+takes about 4.3 GB.
+'''
+from __future__ import print_function
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+import quantities as qu
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tests.syntheticSMR import writeSyntheticSMR
+
+calibStrings = {'voltageCalibStr': '0-30, 20;30-maxtime, 21', 'vibrationCalibStr': '27.1', 'currentCalibStr': '10'}
+maxFreq = 700 * qu.Hz
+
+# durations of the windows sliced and plotted, as when paging through a recording in the GUI
+epochDuration = 1.
+nEpochs = 100
+nPlottedEpochs = 20
+
+#***********************************************************************************************************************
+
+
+def exclusionString(duration):
+    '''
+    Intervals to exclude for a recording of duration s: 0.5 s every 60 s
+    '''
+
+    return ';'.join('{}-{}'.format(x, x + 0.5) for x in np.arange(10., duration - 1, 60.)) or None
+
+
+def epochStarts(tStart, tStop, n):
+    '''
+    Start times, in s, of n epochs of epochDuration spread over a recording
+    '''
+
+    return np.linspace(tStart, max(tStart, tStop - epochDuration), n)
+
+
+def peakRSS():
+    '''
+    Peak resident memory of this process in bytes
+    '''
+
+    import resource
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxRSS if sys.platform == 'darwin' else maxRSS * 1024
+
+
+def measure(func, nSamples, repeats=1):
+    '''
+    Run func repeats times and measure it
+    :return: dict with the keys 'wallTime' (s, shortest run), 'peakRSS' (bytes, of the process after the runs),
+    'rssIncrease' (bytes, increase of the peak during the runs, i.e., memory func needed beyond the setup) and
+    'nSamples'
+    '''
+
+    gc.collect()
+    rssBefore = peakRSS()
+    wallTimes = []
+    for repeat in range(repeats):
+        startTime = time.time()
+        func()
+        wallTimes.append(time.time() - startTime)
+    rssAfter = peakRSS()
+
+    return {'wallTime': min(wallTimes), 'peakRSS': rssAfter, 'rssIncrease': rssAfter - rssBefore,
+            'nSamples': int(nSamples)}
+
+#***********************************************************************************************************************
+# Stages. Each takes the SMR file, the configuration and the number of repeats, does its setup untimed and returns the
+# output of measure.
+
+
+def readRawChannel(smrFile, channelIndex=0):
+
+    from smrReader import SMRReader
+    return SMRReader(smrFile).readAnalogSignal(channelIndex)
+
+
+def calibratedChannel(smrFile):
+
+    from rawDataImport import calibrateSignal
+    return calibrateSignal(readRawChannel(smrFile), calibStrings['voltageCalibStr'], 'mV', inPlace=True)
+
+
+def benchParseSpike2Data(smrFile, config, repeats):
+
+    from rawDataImport import parseSpike2Data
+    return measure(lambda: parseSpike2Data(smrFile, calibStrings, [-np.inf, np.inf],
+                                           exclusionString(config['duration'])),
+                   config['nSamples'] * config['nChannels'], repeats)
+
+
+def benchExcludeIntervals(smrFile, config, repeats):
+
+    from rawDataImport import excludeIntervals
+    rawSignal = readRawChannel(smrFile)
+    return measure(lambda: excludeIntervals(rawSignal, exclusionString(config['duration'])),
+                   rawSignal.shape[0], repeats)
+
+
+def benchCalibrateSignal(smrFile, config, repeats):
+
+    from rawDataImport import calibrateSignal
+    rawSignal = readRawChannel(smrFile)
+    return measure(lambda: calibrateSignal(rawSignal, calibStrings['voltageCalibStr'], 'mV'),
+                   rawSignal.shape[0], repeats)
+
+
+def benchDownSample(mode):
+
+    def bench(smrFile, config, repeats):
+
+        from NEOFuncs import downSampleAnalogSignal
+        signal = calibratedChannel(smrFile)
+        downSampleFactor = max(1, int(config['samplingRate'] / float(maxFreq.magnitude)))
+        return measure(lambda: downSampleAnalogSignal(signal, downSampleFactor, mode), signal.shape[0], repeats)
+
+    return bench
+
+
+def benchSliceAnalogSignal(smrFile, config, repeats):
+
+    from NEOFuncs import sliceAnalogSignal
+    signal = calibratedChannel(smrFile)
+    starts = epochStarts(float(signal.t_start.magnitude), float(signal.t_stop.magnitude), nEpochs)
+
+    def sliceEpochs():
+        for epochStart in starts:
+            sliceAnalogSignal(signal, epochStart * qu.s, (epochStart + epochDuration) * qu.s)
+
+    return measure(sliceEpochs, nEpochs * epochDuration * config['samplingRate'], repeats)
+
+
+def benchPlotVibEpoch(smrFile, config, repeats):
+
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    from rawDataImport import RawDataViewer
+
+    rdi = RawDataViewer(smrFile, calibStrings['voltageCalibStr'], maxFreq, exclusionString(config['duration']),
+                        forceUnits=True, streaming=True)
+    fig, ax = plt.subplots(figsize=(12, 6))
+    starts = epochStarts(float(rdi.voltageSignal.t_start.magnitude), float(rdi.voltageSignal.t_stop.magnitude),
+                         nPlottedEpochs)
+
+    def plotEpochs():
+        for epochStart in starts:
+            ax.clear()
+            rdi.plotVibEpoch(ax, [epochStart * qu.s, (epochStart + epochDuration) * qu.s])
+            fig.canvas.draw()
+
+    return measure(plotEpochs, nPlottedEpochs * epochDuration * float(maxFreq.magnitude), repeats)
+
+
+def benchUpdateVibEpoch(smrFile, config, repeats):
+    '''
+    Paging through consecutive epochs as in the GUI, see MatplotlibWidget.drawIncremental: the figure is redrawn only
+    when updateVibEpoch changes the y limits, otherwise the lines and the x axis are drawn onto the stored background
+    '''
+
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    from rawDataImport import RawDataViewer
+
+    rdi = RawDataViewer(smrFile, calibStrings['voltageCalibStr'], maxFreq, exclusionString(config['duration']),
+                        forceUnits=True, streaming=True)
+    fig, ax = plt.subplots(figsize=(12, 6))
+    tStart = float(rdi.voltageSignal.t_start.magnitude)
+    nFlips = min(nPlottedEpochs, int((float(rdi.voltageSignal.t_stop.magnitude) - tStart) / epochDuration))
+
+    def pageEpochs():
+        ax.clear()
+        background = None
+        for epochInd in range(nFlips):
+            epochStart = tStart + epochInd * epochDuration
+            artists, limitsChanged = rdi.updateVibEpoch(ax, [epochStart * qu.s, (epochStart + epochDuration) * qu.s])
+            for artist in artists:
+                artist.set_animated(True)
+            if limitsChanged or background is None:
+                fig.canvas.draw()
+                background = fig.canvas.copy_from_bbox(fig.bbox)
+            else:
+                fig.canvas.restore_region(background)
+            for artist in artists:
+                ax.draw_artist(artist)
+            fig.canvas.blit(fig.bbox)
+
+    return measure(pageEpochs, nFlips * epochDuration * float(maxFreq.magnitude), repeats)
+
+
+def benchLoadStreaming(smrFile, config, repeats):
+
+    from rawDataImport import RawDataViewer
+    return measure(lambda: RawDataViewer(smrFile, calibStrings['voltageCalibStr'], maxFreq,
+                                         exclusionString(config['duration']), forceUnits=True, streaming=True),
+                   config['nSamples'] * config['nChannels'], repeats)
+
+
+def benchNIXWrite(smrFile, config, repeats):
+
+    import nixio as nix
+    from neoNIXIO import addAnalogSignal2Block
+    signal = calibratedChannel(smrFile)
+    signal.name = 'MembranePotential'
+    nixDir = tempfile.mkdtemp()
+
+    def write():
+        nixFile = nix.File.open(os.path.join(nixDir, 'benchmark.h5'), nix.FileMode.Overwrite)
+        try:
+            addAnalogSignal2Block(nixFile.create_block('signals', 'benchmark'), signal)
+        finally:
+            nixFile.close()
+
+    try:
+        return measure(write, signal.shape[0], repeats)
+    finally:
+        shutil.rmtree(nixDir)
+
+
+def benchNIXRead(windowed):
+
+    def bench(smrFile, config, repeats):
+
+        import nixio as nix
+        from neoNIXIO import addAnalogSignal2Block, dataArray2AnalogSignal
+        signal = calibratedChannel(smrFile)
+        signal.name = 'MembranePotential'
+        nixDir = tempfile.mkdtemp()
+        nixFileName = os.path.join(nixDir, 'benchmark.h5')
+        nixFile = nix.File.open(nixFileName, nix.FileMode.Overwrite)
+        try:
+            addAnalogSignal2Block(nixFile.create_block('signals', 'benchmark'), signal)
+        finally:
+            nixFile.close()
+        starts = epochStarts(float(signal.t_start.magnitude), float(signal.t_stop.magnitude), nEpochs)
+        nSamples = nEpochs * epochDuration * config['samplingRate'] if windowed else signal.shape[0]
+        del signal
+
+        def read():
+            nixFile = nix.File.open(nixFileName, nix.FileMode.ReadOnly)
+            try:
+                dataArray = nixFile.blocks['signals'].data_arrays['MembranePotential']
+                if windowed:
+                    for epochStart in starts:
+                        dataArray2AnalogSignal(dataArray, epochStart * qu.s, (epochStart + epochDuration) * qu.s)
+                else:
+                    dataArray2AnalogSignal(dataArray)
+            finally:
+                nixFile.close()
+
+        try:
+            return measure(read, nSamples, repeats)
+        finally:
+            shutil.rmtree(nixDir)
+
+    return bench
+
+
+stages = OrderedDict([
+    ('parseSpike2Data', benchParseSpike2Data),
+    ('excludeIntervals', benchExcludeIntervals),
+    ('calibrateSignal', benchCalibrateSignal),
+    ('downSampleAnalogSignal stride', benchDownSample('stride')),
+    ('downSampleAnalogSignal fir', benchDownSample('fir')),
+    ('downSampleAnalogSignal minmax', benchDownSample('minmax')),
+    ('sliceAnalogSignal', benchSliceAnalogSignal),
+    ('plotVibEpoch', benchPlotVibEpoch),
+    ('updateVibEpoch', benchUpdateVibEpoch),
+    ('RawDataViewer streaming', benchLoadStreaming),
+    ('addAnalogSignal2Block', benchNIXWrite),
+    ('dataArray2AnalogSignal', benchNIXRead(windowed=False)),
+    ('dataArray2AnalogSignal windows', benchNIXRead(windowed=True)),
+])
+
+#***********************************************************************************************************************
+
+
+def runStage(job):
+    '''
+    Worker running one stage on one synthetic file. Errors are returned rather than raised, e.g., for stages that
+    need more memory than available.
+    :param job: tuple (stage name, SMR file, configuration dict, repeats)
+    :return: dict, the configuration, 'stage', 'error' and, without error, the output of measure
+    '''
+
+    stage, smrFile, config, repeats = job
+    result = dict(config, stage=stage, error=None)
+    try:
+        result.update(stages[stage](smrFile, config, repeats))
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+
+    return result
+
+
+def syntheticFile(workDir, duration, samplingRate, nChannels):
+    '''
+    Path of a synthetic SMR file in workDir, written if it does not exist yet
+    '''
+
+    smrFile = os.path.join(workDir, 'synthetic_{:g}s_{:g}Hz_{}ch.smr'.format(duration, samplingRate, nChannels))
+    if not os.path.isfile(smrFile):
+        print('Writing {}'.format(smrFile))
+        writeSyntheticSMR(smrFile + '.part', duration, samplingRate, nChannels)
+        os.rename(smrFile + '.part', smrFile)
+
+    return smrFile
+
+
+def resultKey(result):
+
+    return result['stage'], result['duration'], result['samplingRate'], result['nChannels']
+
+
+def compareWithBaseline(results, baselineResults, tolerance, minWallTime=0.05, minRSSIncrease=2 * 1024 ** 2):
+    '''
+    Stages whose wall time or memory exceeds that of the baseline by more than tolerance. Differences below
+    minWallTime and minRSSIncrease are considered noise.
+    :param results: list of dicts, output of runStage
+    :param baselineResults: list of dicts, output of runStage of an earlier run
+    :param tolerance: float, allowed relative increase
+    :return: list of (result, baseline result, str describing the regression)
+    '''
+
+    baseline = dict((resultKey(x), x) for x in baselineResults if x['error'] is None)
+    regressions = []
+    for result in results:
+        baselineResult = baseline.get(resultKey(result))
+        if baselineResult is None or result['error'] is not None:
+            continue
+        if result['wallTime'] > baselineResult['wallTime'] * (1 + tolerance) + minWallTime:
+            regressions.append((result, baselineResult, 'wall time {:.3f}s, baseline {:.3f}s'.format(
+                result['wallTime'], baselineResult['wallTime'])))
+        if result['rssIncrease'] > baselineResult['rssIncrease'] * (1 + tolerance) + minRSSIncrease:
+            regressions.append((result, baselineResult, 'memory {:.1f}MB, baseline {:.1f}MB'.format(
+                result['rssIncrease'] / 1024. ** 2, baselineResult['rssIncrease'] / 1024. ** 2)))
+
+    return regressions
+
+
+def environment():
+
+    import neo
+    import nixio
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'neo': neo.__version__, 'nixio': getattr(nixio, '__version__', None),
+            'cpus': multiprocessing.cpu_count(), 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def runBenchmarks(durations, samplingRates, channelCounts, stageNames, workDir, repeats=1):
+    '''
+    Run the stages on synthetic files of all combinations of durations, sampling rates and numbers of channels
+    :return: list of dicts, output of runStage
+    '''
+
+    if not os.path.isdir(workDir):
+        os.makedirs(workDir)
+
+    results = []
+    print('{:<32}{:>10}{:>10}{:>5}{:>12}{:>14}{:>14}'.format('stage', 'duration', 'rate', 'ch', 'time (s)',
+                                                             'peak (MB)', 'stage (MB)'))
+    for duration in durations:
+        for samplingRate in samplingRates:
+            for nChannels in channelCounts:
+                smrFile = syntheticFile(workDir, duration, samplingRate, nChannels)
+                config = {'duration': duration, 'samplingRate': samplingRate, 'nChannels': nChannels,
+                          'nSamples': int(duration * samplingRate)}
+                for stage in stageNames:
+                    # a fresh process per stage, so that peak memory is that of the stage
+                    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+                    try:
+                        result = pool.apply(runStage, ((stage, smrFile, config, repeats),))
+                        pool.close()
+                    finally:
+                        pool.terminate()
+                        pool.join()
+                    results.append(result)
+
+                    if result['error'] is None:
+                        print('{:<32}{:>10g}{:>10g}{:>5}{:>12.3f}{:>14.1f}{:>14.1f}'.format(
+                            stage, duration, samplingRate, nChannels, result['wallTime'],
+                            result['peakRSS'] / 1024. ** 2, result['rssIncrease'] / 1024. ** 2))
+                    else:
+                        print('{:<32}{:>10g}{:>10g}{:>5}  {}'.format(stage, duration, samplingRate, nChannels,
+                                                                      result['error']))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths on synthetic SMR files')
+    parser.add_argument('--durations', type=float, nargs='+', default=[60.],
+                        help='durations of the recordings in s, e.g., 60 600 3600 14400')
+    parser.add_argument('--rates', type=float, nargs='+', default=[20000.], help='sampling rates in Hz')
+    parser.add_argument('--channels', type=int, nargs='+', default=[3], choices=[2, 3], help='numbers of channels')
+    parser.add_argument('--stages', nargs='+', default=list(stages.keys()), choices=list(stages.keys()),
+                        help='stages to run, all by default')
+    parser.add_argument('--repeats', type=int, default=1, help='runs per stage, the shortest one is reported')
+    parser.add_argument('--workDir', default=os.path.join(tempfile.gettempdir(), 'GJEMSRDViewerBenchmarks'),
+                        help='directory for the synthetic SMR files')
+    parser.add_argument('--out', default='hotPathBenchmark.json', help='JSON file for the results')
+    parser.add_argument('--baseline', default=None, help='JSON file of an earlier run to compare with')
+    parser.add_argument('--saveBaseline', default=None, help='also write the results to this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative increase of wall time or memory over the baseline reported as regression')
+    args = parser.parse_args()
+
+    results = runBenchmarks(args.durations, args.rates, args.channels, args.stages, args.workDir, args.repeats)
+
+    output = {'environment': environment(), 'results': results}
+    for outFile in [args.out, args.saveBaseline]:
+        if outFile is not None:
+            with open(outFile, 'w') as fle:
+                json.dump(output, fle, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as fle:
+            regressions = compareWithBaseline(results, json.load(fle)['results'], args.tolerance)
+        for result, baselineResult, description in regressions:
+            print('Regression in {} ({:g}s, {:g}Hz, {} channels): {}'.format(
+                result['stage'], result['duration'], result['samplingRate'], result['nChannels'], description))
+        print('{} regressions against {}'.format(len(regressions), args.baseline))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,85 @@
+'''
+Compares the conversion of quantities in neoNIXIO.simpleFloat, neoNIXIO.addQuantity2section and neoNIXIO.addMultiTag
+with the original element-by-element implementations, for quantities of 10^3 to 10^6 elements.
+
+Usage: python benchmarks/nixMetadataBenchmark.py [<largest size>]
+
+The original implementations take several minutes at 10^6 elements; pass a smaller largest size for a quick run.
+'''
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+import quantities as qu
+import nixio as nix
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from neoNIXIO import simpleFloat, addQuantity2section, addMultiTag, createPosDA, qu2Val
+
+
+def legacySimpleFloat(quant):
+
+    return tuple(float(q.simplified) for q in quant)
+
+
+def legacyAddQuantity2section(sec, quant, name):
+
+    p = sec.create_property(name, [qu2Val(x) for x in quant])
+    p.unit = quant.dimensionality.string
+    return p
+
+
+def legacyAddMultiTag(name, type, positions, blk, refs):
+
+    refUnits0 = refs[0].dimensions[0].unit
+    positionsUnitsNormed = legacySimpleFloat(positions / qu.Quantity(1, units=refUnits0))
+    positionsDA = createPosDA('{}_DA'.format(name), positionsUnitsNormed, blk)
+    tag = blk.create_multi_tag(name, type, positionsDA)
+    tag.units = [str(refUnits0)]
+    for ref in refs:
+        tag.references.append(ref)
+
+
+def timeIt(func):
+
+    startTime = time.time()
+    func()
+    return time.time() - startTime
+
+
+if __name__ == '__main__':
+
+    largestSize = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10 ** 6
+    tempDir = tempfile.mkdtemp()
+
+    print('{:<10}{:<22}{:>14}{:>14}{:>10}'.format('size', 'function', 'legacy (s)', 'new (s)', 'speedup'))
+    size = 10 ** 3
+    while size <= largestSize:
+
+        positions = np.sort(np.random.uniform(0, 3600, size)) * qu.ms
+        nixFile = nix.File.open(os.path.join(tempDir, 'bench{}.h5'.format(size)), nix.FileMode.Overwrite)
+        blk = nixFile.create_block('block', 'benchmark')
+        ref = blk.create_data_array('signal', 'nix.regular_sampled', data=np.zeros(10))
+        ref.append_sampled_dimension(0.1).unit = 's'
+        sec = nixFile.create_section('section', 'benchmark')
+
+        comparisons = [
+            ('simpleFloat', lambda: legacySimpleFloat(positions), lambda: simpleFloat(positions)),
+            ('addQuantity2section', lambda: legacyAddQuantity2section(sec, positions, 'legacy'),
+             lambda: addQuantity2section(sec, positions, 'new')),
+            ('addMultiTag', lambda: legacyAddMultiTag('legacy', 'spikes', positions, blk, [ref]),
+             lambda: addMultiTag('new', 'spikes', positions, blk, [ref])),
+        ]
+        for funcName, legacyFunc, newFunc in comparisons:
+            legacyTime = timeIt(legacyFunc)
+            newTime = timeIt(newFunc)
+            print('{:<10}{:<22}{:>14.4f}{:>14.4f}{:>10.1f}'.format(size, funcName, legacyTime, newTime,
+                                                                   legacyTime / max(newTime, 1e-9)))
+
+        nixFile.close()
+        size *= 10
+
+    shutil.rmtree(tempDir)
@@ -0,0 +1,159 @@
+import threading
+from collections import OrderedDict
+import quantities as qu
+
+#***********************************************************************************************************************
+
+
+def epochTracesNBytes(epochTraces):
+    '''
+    Memory held by the output of RawDataViewer.getEpochTraces
+    '''
+
+    return sum(times.nbytes + values.nbytes for signalAttr, times, values in epochTraces)
+
+#***********************************************************************************************************************
+
+
+class EpochPrefetcher(object):
+    '''
+    Prepares, in a background thread, the traces (see RawDataViewer.getEpochTraces) of the epochs around the one
+    being viewed, so that paging with Next and Previous does not have to wait for slicing.
+    '''
+
+    def __init__(self, rdi, nEpochs=2, maxBytes=256 * 1024 ** 2):
+        '''
+        :param rdi: rawDataImport.RawDataViewer
+        :param nEpochs: int, number of epochs to prepare after and before the epoch being viewed
+        :param maxBytes: int, bound on the memory held by prepared traces
+        '''
+
+        self.rdi = rdi
+        self.nEpochs = nEpochs
+        self.maxBytes = maxBytes
+
+        # prepared traces, by epoch key
+        self.epochTraces = OrderedDict()
+        # epochs still to be prepared, as (key, epochTimes, maxBins), nearest first
+        self.pending = []
+        # keys of the epochs around the one being viewed
+        self.wantedKeys = set()
+        # key of the epoch being prepared by the background thread, if any
+        self.inFlightKey = None
+        self.condition = threading.Condition()
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def epochKey(epochStart, epochWidth, maxBins):
+
+        return (round(float(epochStart.rescale(qu.s).magnitude), 9),
+                round(float(epochWidth.rescale(qu.s).magnitude), 9),
+                maxBins)
+
+    def get(self, epochStart, epochWidth, maxBins):
+        '''
+        Traces of an epoch, prepared in the background if available, else computed right away and kept if they fit in
+        maxBytes. If the background thread is preparing the epoch, it is waited for instead.
+        :param epochStart: quantities.Quantity
+        :param epochWidth: quantities.Quantity
+        :param maxBins: int or None, see RawDataViewer.epochTrace
+        :return: list of (signal attribute, times, values), see RawDataViewer.getEpochTraces
+        '''
+
+        key = self.epochKey(epochStart, epochWidth, maxBins)
+        with self.condition:
+            while self.inFlightKey == key:
+                self.condition.wait()
+            epochTraces = self.epochTraces.get(key)
+
+        if epochTraces is None:
+            epochTraces = self.rdi.getEpochTraces([epochStart, epochStart + epochWidth], maxBins)
+            with self.condition:
+                self.keep(key, epochTraces)
+
+        return epochTraces
+
+    def keep(self, key, epochTraces):
+        '''
+        Keep the traces of an epoch if they fit in maxBytes with those already kept. Must be called with
+        self.condition acquired.
+        :return: bool, whether the traces were kept
+        '''
+
+        usedBytes = sum(epochTracesNBytes(x) for x in self.epochTraces.values())
+        if usedBytes + epochTracesNBytes(epochTraces) <= self.maxBytes:
+            self.epochTraces[key] = epochTraces
+            return True
+        else:
+            return False
+
+    def prefetch(self, epochStart, epochWidth, maxBins):
+        '''
+        Schedule the preparation of the nEpochs epochs after and before the epoch starting at epochStart. Traces of
+        epochs further away are dropped.
+        :param epochStart: quantities.Quantity
+        :param epochWidth: quantities.Quantity
+        :param maxBins: int or None, see RawDataViewer.epochTrace
+        '''
+
+        signalStart = self.rdi.voltageSignal.t_start
+        signalStop = self.rdi.voltageSignal.t_stop
+
+        wanted = [(self.epochKey(epochStart, epochWidth, maxBins), [epochStart, epochStart + epochWidth], maxBins)]
+        for distance in range(1, self.nEpochs + 1):
+            for direction in (1, -1):
+                neighbourStart = epochStart + direction * distance * epochWidth
+                if neighbourStart >= signalStart and neighbourStart + epochWidth <= signalStop:
+                    wanted.append((self.epochKey(neighbourStart, epochWidth, maxBins),
+                                   [neighbourStart, neighbourStart + epochWidth], maxBins))
+
+        with self.condition:
+            self.wantedKeys = set(key for key, epochTimes, bins in wanted)
+            for key in list(self.epochTraces.keys()):
+                if key not in self.wantedKeys:
+                    del self.epochTraces[key]
+            self.pending = [x for x in wanted if x[0] not in self.epochTraces]
+            self.condition.notify_all()
+
+    def work(self):
+
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                key, epochTimes, maxBins = self.pending.pop(0)
+                if key in self.epochTraces:
+                    continue
+                self.inFlightKey = key
+
+            try:
+                epochTraces = self.rdi.getEpochTraces(epochTimes, maxBins)
+            except Exception:
+                # left to get, which computes the epoch again in the GUI thread and raises the error there
+                epochTraces = None
+
+            with self.condition:
+                # wakes up get calls waiting for this epoch
+                self.inFlightKey = None
+                self.condition.notify_all()
+                if epochTraces is None or key not in self.wantedKeys:
+                    continue
+                if not self.keep(key, epochTraces):
+                    self.pending = []
+
+    def stop(self):
+        '''
+        Stop the background thread
+        '''
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+#***********************************************************************************************************************
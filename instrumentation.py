@@ -0,0 +1,156 @@
+'''
+Opt-in instrumentation of the stages of loading and drawing recordings. Stages are reported, with their duration, the
+bytes of the arrays they produced and the number of samples they processed, to the sinks added with addSink, e.g., a
+log, a JSON lines file or the statistics panel of the GUI. Without sinks, which is the default, reporting a stage
+returns right away, so that the hooks can stay in place in production.
+
+Instrumentation can also be enabled by setting the environment variable GJEMSRDVIEWER_INSTRUMENTATION to the path of
+a JSON lines file, or to 'log' to log stages with the logging module, and calling enableFromEnvironment.
+'''
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+# callables called as sink(record) for each stage, see recordStage
+sinks = []
+
+environmentVariable = 'GJEMSRDVIEWER_INSTRUMENTATION'
+
+#***********************************************************************************************************************
+
+
+def addSink(sink):
+    '''
+    Start reporting stages to sink
+    :param sink: callable, called as sink(record) with the dict record of each stage, see recordStage. Can be called
+    from worker threads.
+    '''
+
+    if sink not in sinks:
+        sinks.append(sink)
+
+
+def removeSink(sink):
+
+    if sink in sinks:
+        sinks.remove(sink)
+
+
+def enabled():
+    '''
+    Whether any sink is listening, i.e., whether stages have to be measured at all
+    '''
+
+    return bool(sinks)
+
+
+def peakRSS():
+    '''
+    Peak resident memory of this process in bytes, or None where it is not available
+    '''
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxRSS if sys.platform == 'darwin' else maxRSS * 1024
+
+
+def arraysNBytes(*arrays):
+    '''
+    Total size of numpy arrays, e.g., neo.AnalogSignals; None entries are skipped
+    '''
+
+    return sum(x.nbytes for x in arrays if x is not None)
+
+
+def recordStage(stage, duration, nBytes=None, nSamples=None):
+    '''
+    Report a finished stage to all sinks. Does nothing if there is no sink.
+    :param stage: str, name of the stage, e.g., 'MembranePotential: calibrate'
+    :param duration: float, in s
+    :param nBytes: int or None, bytes of the arrays produced by the stage
+    :param nSamples: int or None, number of samples processed by the stage
+    '''
+
+    if not sinks:
+        return
+
+    record = {'stage': stage, 'duration': duration, 'nBytes': nBytes, 'nSamples': nSamples,
+              'peakRSS': peakRSS(), 'time': time.time(), 'thread': threading.current_thread().name}
+    for sink in list(sinks):
+        sink(record)
+
+#***********************************************************************************************************************
+
+
+class LogSink(object):
+    '''
+    Logs each stage with the logging module
+    '''
+
+    def __init__(self, logger=None, level=logging.INFO):
+
+        self.logger = logger if logger is not None else logging.getLogger('GJEMSRDViewer.instrumentation')
+        self.level = level
+
+    def __call__(self, record):
+
+        self.logger.log(self.level, '%s took %.3fs (%s bytes, %s samples)', record['stage'], record['duration'],
+                        record['nBytes'], record['nSamples'])
+
+
+class JSONLinesSink(object):
+    '''
+    Appends each stage as a line of JSON to a file
+    '''
+
+    def __init__(self, path):
+
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+
+        line = json.dumps(record, sort_keys=True)
+        with self.lock:
+            with open(self.path, 'a') as fle:
+                fle.write(line + '\n')
+
+
+class MemorySink(object):
+    '''
+    Keeps the last maxRecords stages in memory, e.g., for tests or for summaries
+    '''
+
+    def __init__(self, maxRecords=1000):
+
+        self.records = deque(maxlen=maxRecords)
+
+    def __call__(self, record):
+
+        self.records.append(record)
+
+#***********************************************************************************************************************
+
+
+def enableFromEnvironment():
+    '''
+    Add a sink as configured by the environment variable GJEMSRDVIEWER_INSTRUMENTATION, if set, see the module
+    docstring
+    :return: the sink added, or None
+    '''
+
+    target = os.environ.get(environmentVariable)
+    if not target:
+        return None
+
+    sink = LogSink() if target == 'log' else JSONLinesSink(target)
+    addSink(sink)
+    return sink
@@ -0,0 +1,201 @@
+import re
+import numpy as np
+import quantities as qu
+from neo import AnalogSignal
+from NEOFuncs import quantity2Seconds
+
+#***********************************************************************************************************************
+
+
+def minMaxEnvelope(samples, binSize):
+    '''
+    Minimum and maximum of consecutive bins of samples. The last bin may be shorter than binSize.
+    :param samples: 1D numpy.ndarray
+    :param binSize: int, number of samples per bin, must be at least 1
+    :return: mins, maxs, numpy.ndarrays of size ceil(samples.shape[0] / binSize)
+    '''
+
+    assert binSize >= 1, 'binSize must be atleast 1'
+
+    if not samples.shape[0]:
+        return samples[:0].copy(), samples[:0].copy()
+
+    binStarts = np.arange(0, samples.shape[0], binSize)
+    return np.minimum.reduceat(samples, binStarts), np.maximum.reduceat(samples, binStarts)
+
+#***********************************************************************************************************************
+
+
+def interleaveEnvelope(binTimes, mins, maxs):
+    '''
+    Points to plot for a min/max envelope as a single line: a vertical stroke from min to max at the start of each
+    bin, i.e., two points per bin.
+    :param binTimes: numpy.ndarray, start times of the bins
+    :param mins: numpy.ndarray, minima of the bins
+    :param maxs: numpy.ndarray, maxima of the bins
+    :return: times, values, numpy.ndarrays of size 2 * mins.shape[0]
+    '''
+
+    times = np.repeat(binTimes, 2)
+    values = np.empty(2 * mins.shape[0], dtype=np.result_type(mins, maxs))
+    values[0::2] = mins
+    values[1::2] = maxs
+
+    return times, values
+
+#***********************************************************************************************************************
+
+
+class MinMaxPyramid(object):
+    '''
+    Min/max envelopes of a signal at several decimation levels, built once. Level 0 has bins of baseBinSize samples
+    and every further level has levelFactor times larger bins, up to a level with at most minBins bins. Any time
+    window can then be drawn with a bounded number of points without hiding peaks.
+    '''
+
+    def __init__(self, analogSignal, baseBinSize, levelFactor=4, minBins=256):
+        '''
+        :param analogSignal: neo.AnalogSignal, at full resolution
+        :param baseBinSize: int, number of samples per bin of level 0
+        :param levelFactor: int, ratio of the bin sizes of consecutive levels
+        :param minBins: int, levels are added until one has at most these many bins
+        '''
+
+        assert levelFactor >= 2, 'levelFactor must be atleast 2'
+
+        samples = analogSignal.magnitude.reshape((analogSignal.shape[0],))
+        self.units = analogSignal.units
+        self.tStart = float(analogSignal.t_start.simplified)
+        self.samplingPeriod = float(analogSignal.sampling_period.simplified)
+
+        mins, maxs = minMaxEnvelope(samples, max(1, baseBinSize))
+        self.buildLevels(mins, maxs, max(1, baseBinSize), levelFactor, minBins)
+
+    def buildLevels(self, mins, maxs, baseBinSize, levelFactor, minBins):
+
+        self.binSizes = [baseBinSize]
+        self.levels = [(mins, maxs)]
+        while mins.shape[0] > minBins:
+            binStarts = np.arange(0, mins.shape[0], levelFactor)
+            mins = np.minimum.reduceat(mins, binStarts)
+            maxs = np.maximum.reduceat(maxs, binStarts)
+            self.binSizes.append(self.binSizes[-1] * levelFactor)
+            self.levels.append((mins, maxs))
+
+    @classmethod
+    def fromBaseLevel(cls, mins, maxs, baseBinSize, tStart, samplingPeriod, units, levelFactor=4, minBins=256):
+        '''
+        Build a pyramid from an already computed level 0, e.g., one computed chunk by chunk while streaming a signal
+        :param mins: numpy.ndarray, minima of bins of baseBinSize samples
+        :param maxs: numpy.ndarray, maxima of bins of baseBinSize samples
+        :param baseBinSize: int, number of samples per bin of level 0
+        :param tStart: float, time in s of the first sample of the first bin
+        :param samplingPeriod: float, sampling period in s of the signal at full resolution
+        :param units: quantities.Quantity, units of the signal
+        :param levelFactor: int, see MinMaxPyramid.__init__
+        :param minBins: int, see MinMaxPyramid.__init__
+        :return: MinMaxPyramid
+        '''
+
+        pyramid = cls.__new__(cls)
+        pyramid.units = units
+        pyramid.tStart = tStart
+        pyramid.samplingPeriod = samplingPeriod
+        pyramid.buildLevels(mins, maxs, baseBinSize, levelFactor, minBins)
+
+        return pyramid
+
+    @classmethod
+    def fromAnalogSignals(cls, analogSignals, name):
+        '''
+        Rebuild a pyramid from the signals created by MinMaxPyramid.toAnalogSignals
+        :param analogSignals: dict of neo.AnalogSignal by name, may contain other signals too
+        :param name: str, name passed to toAnalogSignals
+        :return: MinMaxPyramid, or None if analogSignals does not contain the pyramid
+        '''
+
+        namePattern = re.compile(r'^{}_pyramid(\d+)_min$'.format(re.escape(name)))
+        binSizes = sorted(int(namePattern.match(x).group(1)) for x in analogSignals if namePattern.match(x))
+        if not binSizes:
+            return None
+
+        pyramid = cls.__new__(cls)
+        pyramid.binSizes = binSizes
+        pyramid.levels = []
+        for binSize in binSizes:
+            minSignal = analogSignals['{}_pyramid{}_min'.format(name, binSize)]
+            maxSignal = analogSignals['{}_pyramid{}_max'.format(name, binSize)]
+            pyramid.levels.append((minSignal.magnitude.reshape((minSignal.shape[0],)),
+                                   maxSignal.magnitude.reshape((maxSignal.shape[0],))))
+
+        pyramid.units = minSignal.units
+        pyramid.tStart = float(minSignal.t_start.simplified)
+        pyramid.samplingPeriod = float(minSignal.sampling_period.simplified) / binSizes[-1]
+
+        return pyramid
+
+    def toAnalogSignals(self, name):
+        '''
+        Express the levels of the pyramid as neo.AnalogSignals, e.g., for writing them to a NIX file with
+        neoNIXIO.addAnalogSignal2Block
+        :param name: str, prefix of the names of the signals
+        :return: list of neo.AnalogSignal, two per level
+        '''
+
+        analogSignals = []
+        for binSize, (mins, maxs) in zip(self.binSizes, self.levels):
+            for extreme, values in (('min', mins), ('max', maxs)):
+                analogSignal = AnalogSignal(signal=values,
+                                            units=self.units,
+                                            sampling_period=self.samplingPeriod * binSize * qu.s,
+                                            t_start=self.tStart * qu.s)
+                analogSignal.name = '{}_pyramid{}_{}'.format(name, binSize, extreme)
+                analogSignals.append(analogSignal)
+
+        return analogSignals
+
+    @property
+    def nbytes(self):
+        return sum(mins.nbytes + maxs.nbytes for mins, maxs in self.levels)
+
+    def chooseLevel(self, startTime, endTime, maxBins):
+        '''
+        Index of the finest level with at most maxBins bins between startTime and endTime, or of the coarsest level
+        if none has so few.
+        :param startTime: float, in s
+        :param endTime: float, in s
+        :param maxBins: int
+        :return: int
+        '''
+
+        nSamples = (endTime - startTime) / self.samplingPeriod
+        for level, binSize in enumerate(self.binSizes):
+            if nSamples / binSize <= maxBins:
+                return level
+        return len(self.binSizes) - 1
+
+    def envelope(self, startTime, endTime, maxBins):
+        '''
+        Min/max envelope between two times at the level that gives at most maxBins bins
+        :param startTime: quantities.Quantity or float in s
+        :param endTime: quantities.Quantity or float in s
+        :param maxBins: int, typically the width of the plot in pixels
+        :return: times, values, quantities.Quantity arrays with 2 points per bin, see interleaveEnvelope
+        '''
+
+        startTime = quantity2Seconds(startTime)
+        endTime = quantity2Seconds(endTime)
+
+        level = self.chooseLevel(startTime, endTime, maxBins)
+        mins, maxs = self.levels[level]
+        binPeriod = self.samplingPeriod * self.binSizes[level]
+
+        startBin = min(max(0, int(np.floor((startTime - self.tStart) / binPeriod))), mins.shape[0])
+        endBin = min(max(startBin, int(np.ceil((endTime - self.tStart) / binPeriod))), mins.shape[0])
+
+        times, values = interleaveEnvelope(self.tStart + np.arange(startBin, endBin) * binPeriod,
+                                           mins[startBin: endBin], maxs[startBin: endBin])
+
+        return times * qu.s, values * self.units
+
+#***********************************************************************************************************************
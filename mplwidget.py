@@ -31,6 +31,10 @@ class MatplotlibWidget(FigureCanvas):
 
             self.compute_initial_figure()
 
+            # background of the figure without the animated artists, see drawIncremental
+            self.background = None
+            self.animatedArtists = []
+
             FigureCanvas.__init__(self, self.fig)
             self.setParent(parent)
 
@@ -39,6 +43,8 @@ class MatplotlibWidget(FigureCanvas):
                                        QtGui.QSizePolicy.Expanding)
             FigureCanvas.updateGeometry(self)
 
+            self.mpl_connect('draw_event', self.onDraw)
+
     def sizeHint(self):
         w = self.fig.get_figwidth()
         h = self.fig.get_figheight()
@@ -47,6 +53,39 @@ class MatplotlibWidget(FigureCanvas):
     def minimumSizeHint(self):
         return QtCore.QSize(10, 10)
 
+    def onDraw(self, event):
+        '''
+        After every full draw, store the background of the figure and draw the animated artists on top of it. The whole
+        figure is stored, as animated artists, e.g., the x axis with its tick labels, can lie outside the axes.
+        '''
+
+        self.background = self.copy_from_bbox(self.fig.bbox)
+        self.animatedArtists = [x for x in self.animatedArtists
+                                if x.axes is self.axes and x in self.axes.get_children()]
+        for artist in self.animatedArtists:
+            self.axes.draw_artist(artist)
+
+    def drawIncremental(self, artists, limitsChanged=True):
+        '''
+        Draw the figure, redrawing only artists if possible. When limitsChanged is False, the stored background of the
+        figure is restored and only artists are drawn and blitted onto it. Otherwise the whole figure is redrawn with
+        artists excluded from the background.
+        :param artists: list of matplotlib artists of self.axes that change between draws
+        :param limitsChanged: bool, whether anything other than artists, e.g., the axes limits, has changed
+        '''
+
+        for artist in artists:
+            artist.set_animated(True)
+        self.animatedArtists = list(artists)
+
+        if limitsChanged or self.background is None:
+            self.draw()
+        else:
+            self.restore_region(self.background)
+            for artist in self.animatedArtists:
+                self.axes.draw_artist(artist)
+            self.blit(self.fig.bbox)
+
     def compute_initial_figure(self):
         t = np.arange(0.0, 3.0, 0.01)
         s = np.sin(2*np.pi*t)
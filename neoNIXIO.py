@@ -6,22 +6,43 @@ import neo
 import quantities as qu
 import numpy as np
 
-qu2Val = lambda x: nix.Value(float(x))
+qu2Val = lambda x: nixValues([float(x)])[0]
 quUnitStr = lambda x: x.dimensionality.string
 
+# nixio 1.5 removed the pycore module and exports the dimension classes itself
+SampledDimension = nix.SampledDimension if hasattr(nix, 'SampledDimension') else nix.pycore.SampledDimension
+
 #***********************************************************************************************************************
 
-def addAnalogSignal2Block(blk, analogSignal):
+
+def nixValues(values):
+    '''
+    Values for creating a metadata property. nixio before 1.5 needs each wrapped in nix.Value; later versions have
+    no nix.Value and take the values as they are.
+    :param values: iterable of floats, ints or strs
+    :return: list
+    '''
+
+    if hasattr(nix, 'Value'):
+        return [nix.Value(x) for x in values]
+    else:
+        return list(values)
+
+#***********************************************************************************************************************
+
+def addAnalogSignal2Block(blk, analogSignal, compression=nix.Compression.Auto):
     '''
     Create a new data array in the block blk and add the data in analogSignal to it
     :param blk: nix.block
     :param analogSignal: neo.analogsignal
+    :param compression: nix.Compression, compression of the data array
     :return: data, nix.data_array, the newly added data_array
     '''
 
     assert hasattr(analogSignal, 'name'), 'Analog signal has no name'
 
-    data = blk.create_data_array(analogSignal.name, 'nix.regular_sampled', data=analogSignal.magnitude)
+    data = blk.create_data_array(analogSignal.name, 'nix.regular_sampled', data=analogSignal.magnitude,
+                                 compression=compression)
 
     data.unit = quUnitStr(analogSignal)
     data.label = analogSignal.name
@@ -37,23 +58,122 @@ def addAnalogSignal2Block(blk, analogSignal):
 
 #***********************************************************************************************************************
 
-def dataArray2AnalogSignal(dataArray):
+# duration of the pieces in which AnalogSignalWriter users are expected to write and later read signals
+writeWindowDuration = 20 * qu.s
+
+
+class AnalogSignalWriter(object):
+    '''
+    Writes a regularly sampled signal into a new data array of a block piece by piece, e.g., as the pieces come out
+    of a processing pipeline, so that the signal never has to be in memory as a whole. The data array has the same
+    layout as those created by addAnalogSignal2Block.
+    '''
+
+    def __init__(self, blk, name, units, samplingPeriod, tStart, nSamples=None, dtype=np.float32,
+                 compression=nix.Compression.DeflateNormal):
+        '''
+        :param blk: nix.block
+        :param name: str, name of the data array
+        :param units: quantities.Quantity, units of the samples
+        :param samplingPeriod: quantities.Quantity
+        :param tStart: quantities.Quantity, time of the first sample
+        :param nSamples: int or None, total number of samples, if known. The data array is then created at its final
+        size, so that HDF5 chooses chunks suited to the whole signal instead of those of an empty array growing with
+        each write, which are much smaller and make windowed reads touch many more chunks. nixio does not let chunk
+        shapes be chosen directly.
+        :param dtype: numpy.dtype of the samples
+        :param compression: nix.Compression, compression of the data array
+        '''
+
+        self.nSamples = nSamples
+        self.nWritten = 0
+
+        shape = (0 if nSamples is None else nSamples,)
+        self.dataArray = blk.create_data_array(name, 'nix.regular_sampled', dtype=dtype, shape=shape,
+                                               compression=compression)
+        self.dataArray.unit = quUnitStr(units)
+        self.dataArray.label = name
+
+        samplingPeriod = samplingPeriod.simplified
+        t = self.dataArray.append_sampled_dimension(float(samplingPeriod))
+        t.label = 'time'
+        t.unit = quUnitStr(samplingPeriod)
+        t.offset = float(tStart.simplified)
+
+    @staticmethod
+    def windowSize(samplingPeriod, windowDuration=writeWindowDuration):
+        '''
+        Number of samples to write at a time so that writes line up with the windows later read
+        :param samplingPeriod: quantities.Quantity
+        :param windowDuration: quantities.Quantity
+        :return: int
+        '''
+
+        return max(1, int(float((windowDuration / samplingPeriod).simplified)))
+
+    def write(self, samples):
+        '''
+        Write the next piece of the signal
+        :param samples: 1D numpy.ndarray
+        '''
+
+        if self.nSamples is None:
+            self.dataArray.append(samples)
+        else:
+            assert self.nWritten + samples.shape[0] <= self.nSamples, 'more samples written than announced'
+            self.dataArray[self.nWritten: self.nWritten + samples.shape[0]] = samples
+        self.nWritten += samples.shape[0]
+
+#***********************************************************************************************************************
+
+def sampledDimensionInds(dim, nSamples, startTime=None, endTime=None):
+    '''
+    Index bounds of the samples of a data array with a sampled dimension between two times, with the same semantics
+    as NEOFuncs.sliceAnalogSignal, i.e., the sample at endTime is included.
+    :param dim: nix.SampledDimension, the first dimension of the data array
+    :param nSamples: int, number of samples of the data array
+    :param startTime: quantities.Quantity or None, if None, from the first sample
+    :param endTime: quantities.Quantity or None, if None, till the last sample
+    :return: startInd, endInd; ints, the window is [startInd, endInd)
+    '''
+
+    dimUnit = qu.Quantity(1, units=dim.unit)
+    startInd = 0
+    endInd = nSamples
+
+    if startTime is not None:
+        startInd = int((float((startTime / dimUnit).simplified) - dim.offset) / dim.sampling_interval)
+        startInd = min(max(0, startInd), nSamples)
+    if endTime is not None:
+        endInd = int((float((endTime / dimUnit).simplified) - dim.offset) / dim.sampling_interval) + 1
+        endInd = min(max(startInd, endInd), nSamples)
+
+    return startInd, endInd
+
+#***********************************************************************************************************************
+
+def dataArray2AnalogSignal(dataArray, startTime=None, endTime=None):
     '''
     Converts a nix data_array into a neo analogsignal of shape (<size of data array>,)
     and having unit equivalent to the unit of the first sampled dimension of the data array.
+    Only the samples between startTime and endTime are read from file.
     :param dataArray: nix.data_array
+    :param startTime: quantities.Quantity or None, see sampledDimensionInds
+    :param endTime: quantities.Quantity or None, see sampledDimensionInds
     :return: neo.analogsignal
     '''
 
     assert len(dataArray.dimensions) == 1, 'Only one dimensional arrays are supported'
     dim = dataArray.dimensions[0]
-    assert isinstance(dim, nix.pycore.SampledDimension), 'Only Sampled Dimensions' \
-                                                         'are supported'
+    assert isinstance(dim, SampledDimension), 'Only Sampled Dimensions' \
+                                              'are supported'
+
+    startInd, endInd = sampledDimensionInds(dim, dataArray.shape[0], startTime, endTime)
 
-    t_start = qu.Quantity(dim.offset, units=dim.unit)
+    t_start = qu.Quantity(dim.offset + startInd * dim.sampling_interval, units=dim.unit)
     samplingPeriod = qu.Quantity(dim.sampling_interval, units=dim.unit)
 
-    analogSignal = neo.AnalogSignal(signal=dataArray[:],
+    analogSignal = neo.AnalogSignal(signal=dataArray[startInd: endInd],
                                     units=dataArray.unit,
                                     sampling_period=samplingPeriod,
                                     t_start=t_start)
@@ -95,7 +215,8 @@ def addQuantity2section(sec, quant, name):
         #not an empty 1D array
         if quant.shape[0]:
 
-            p = sec.create_property(name, [qu2Val(x) for x in quant])
+            # one conversion of the whole array instead of one Quantity per element
+            p = sec.create_property(name, nixValues(quant.magnitude.astype(float).tolist()))
 
         else:
             raise(ValueError('Quantity passed must be either scalar or 1 dimensional'))
@@ -155,10 +276,11 @@ def tag2AnalogSignal(tag, refInd):
     dim = ref.dimensions[0]
     offset = dim.offset
     ts = dim.sampling_interval
-    nSamples = ref[:].shape[0]
+    nSamples = ref.shape[0]
 
-    startInd = max(0, int(np.floor((tag.position[0] - offset) / ts)))
+    startInd = min(max(0, int(np.floor((tag.position[0] - offset) / ts))), nSamples)
     endInd = min(startInd + int(np.floor(tag.extent[0] / ts)) + 1, nSamples)
+    # only the hyperslab of the tag is read from file
     trace = ref[startInd:endInd]
 
     analogSignal = neo.AnalogSignal(signal=trace,
@@ -174,6 +296,92 @@ def tag2AnalogSignal(tag, refInd):
 
 #***********************************************************************************************************************
 
+def multiTag2Snippets(multiTag, refInd, snippetDuration=None, out=None, maxGapSamples=None,
+                      maxReadSamples=2 ** 24):
+    '''
+    Snippets of the reference at index refInd of a nix.multi_tag at all its positions, as the rows of one 2D array.
+    Positions are processed in the order of their start so that overlapping or nearby snippets are covered by a
+    single read of the reference; the number of reads is the number of groups of nearby snippets, not the number of
+    positions. Each snippet starts at the sample of its position, as in tag2AnalogSignal. Samples of snippets that
+    lie beyond the ends of the reference are NaN.
+    :param multiTag: nix.multi_tag
+    :param refInd: int, index of the reference among those of multiTag
+    :param snippetDuration: quantities.Quantity, duration of all snippets. If None, the longest extent of multiTag.
+    :param out: numpy.ndarray or None, array of floats of shape (number of positions, number of samples per
+    snippet) to fill, e.g., a numpy.memmap for more snippets than fit in memory. If None, one is allocated.
+    :param maxGapSamples: int or None, snippets separated by at most these many samples are read together. If None,
+    the number of samples per snippet.
+    :param maxReadSamples: int, bound on the number of samples per read and on the number of snippet samples
+    gathered from one read, i.e., on the temporary arrays of a group of heavily overlapping snippets, except when a
+    single snippet is longer
+    :return: snippets, snippetStartTimes; snippets is out, in the units of the reference, one row per position in
+    the order of the positions of multiTag, and snippetStartTimes is a quantities.Quantity with the time of the first
+    sample of each snippet
+    '''
+
+    ref = multiTag.references[refInd]
+    dim = ref.dimensions[0]
+    ts = dim.sampling_interval
+    nSamples = ref.shape[0]
+
+    tagUnits = qu.Quantity(1, units=multiTag.units[0] if multiTag.units else dim.unit)
+    dimUnits = qu.Quantity(1, units=dim.unit)
+    tag2DimFactor = float((tagUnits / dimUnits).simplified)
+
+    positions = np.asarray(multiTag.positions[:], dtype=np.float64).reshape((-1,)) * tag2DimFactor
+    if snippetDuration is None:
+        assert multiTag.extents is not None, 'snippetDuration is needed for a multi_tag without extents'
+        maxExtent = np.asarray(multiTag.extents[:], dtype=np.float64).max() * tag2DimFactor
+    else:
+        maxExtent = float((snippetDuration / dimUnits).simplified)
+    snippetSamples = int(np.floor(maxExtent / ts)) + 1
+    if maxGapSamples is None:
+        maxGapSamples = snippetSamples
+
+    if out is None:
+        out = np.empty((positions.shape[0], snippetSamples), dtype=np.result_type(ref.dtype, np.float32))
+    assert out.shape == (positions.shape[0], snippetSamples), \
+        'out must have shape {}'.format((positions.shape[0], snippetSamples))
+
+    startInds = np.floor((positions - dim.offset) / ts).astype(np.int64)
+    order = np.argsort(startInds, kind='mergesort')
+    sortedStarts = startInds[order]
+    snippetOffsets = np.arange(snippetSamples)
+
+    groupFirst = 0
+    while groupFirst < order.shape[0]:
+
+        # extend the group while the next snippet starts close enough to the end of the group and both the read and
+        # the snippets gathered from it stay small
+        readStart = sortedStarts[groupFirst]
+        readEnd = readStart + snippetSamples
+        groupEnd = groupFirst + 1
+        while groupEnd < order.shape[0] and sortedStarts[groupEnd] <= readEnd + maxGapSamples \
+                and sortedStarts[groupEnd] + snippetSamples - readStart <= maxReadSamples \
+                and (groupEnd + 1 - groupFirst) * snippetSamples <= maxReadSamples:
+            readEnd = sortedStarts[groupEnd] + snippetSamples
+            groupEnd += 1
+
+        clippedStart = min(max(0, readStart), nSamples)
+        clippedEnd = min(max(clippedStart, readEnd), nSamples)
+        block = np.asarray(ref[clippedStart: clippedEnd]).reshape((-1,))
+
+        rows = order[groupFirst: groupEnd]
+        inds = sortedStarts[groupFirst: groupEnd, None] + snippetOffsets[None, :]
+        valid = (inds >= clippedStart) & (inds < clippedEnd)
+        if block.shape[0]:
+            out[rows] = np.where(valid, block[np.clip(inds - clippedStart, 0, block.shape[0] - 1)], np.nan)
+        else:
+            out[rows] = np.nan
+
+        groupFirst = groupEnd
+
+    snippetStartTimes = qu.Quantity(dim.offset + startInds * ts, units=dim.unit)
+
+    return out, snippetStartTimes
+
+#***********************************************************************************************************************
+
 def getTagPosExt(tag):
 
     position = tag.position[0] * qu.Quantity(1, units=tag.units[0])
@@ -225,7 +433,8 @@ def addMultiTag(name, type, positions, blk, refs, metadata=None, extents=None):
         assert len(ref.dimensions) == 1, 'Only 1D refs are supported for now.'
         assert ref.dimensions[0].unit == refUnits0, 'refs must have same time units'
 
-    positionsUnitsNormed = simpleFloat(positions / qu.Quantity(1, units=refUnits0))
+    positionsUnitsNormed = np.asarray((positions / qu.Quantity(1, units=refUnits0)).simplified.magnitude,
+                                      dtype=np.float64).reshape((-1,))
     positionsDA = createPosDA('{}_DA'.format(name), positionsUnitsNormed, blk)
     tag = blk.create_multi_tag(name, type, positionsDA)
     tag.units = [str(refUnits0)]
@@ -285,7 +494,7 @@ def simpleFloat(quant):
 
         if quant.shape[0]:
 
-            return tuple(float(q.simplified) for q in quant)
+            return tuple(quant.simplified.magnitude.astype(float).tolist())
 
         else:
 
@@ -1,132 +1,458 @@
-from neo import Spike2IO, AnalogSignal
+import neo
+from neo import AnalogSignal, SpikeTrain
 import os
+import re
 from neoNIXIO import addQuantity2section, addAnalogSignal2Block
-from NEOFuncs import downSampleAnalogSignal, sliceAnalogSignal
+from NEOFuncs import downSampleAnalogSignal, sliceAnalogSignal, firDecimationTaps, firDecimate, firHalfLength, \
+    robustThreshold, detectSpikeInds, getSpikesIn, quantity2Seconds, signalTimeBase, sliceIndices
+from smrReader import SMRReader
+import instrumentation
+from minMaxPyramid import MinMaxPyramid, minMaxEnvelope, interleaveEnvelope
 import nixio as nix
 import numpy as np
 import json
+import time
+import tempfile
+import multiprocessing
 import quantities as qu
 
+# keyword arguments making AnalogSignal wrap an array without copying it: neo before 0.14 copies unless given
+# copy=False, later versions never copy and reject the argument
+noCopyKwargs = {'copy': False} if tuple(int(x) for x in re.findall(r'\d+', neo.__version__)[:2]) < (0, 14) else {}
+
 
 # **********************************************************************************************************************
 
 
-def parseStartStopStr(startStopStr):
+class LoadCancelled(Exception):
+    '''
+    Raised by a progress callback to abort loading
+    '''
+    pass
 
-    startTimeStr, endTimeStr = startStopStr.split("-")
-    try:
-        if endTimeStr in ['maxtime', 'max time', 'Max Time']:
-            endTime = None
-        else:
-            endTime = float(endTimeStr)
+# **********************************************************************************************************************
+
+
+def reportStage(progressCallback, stage, stageStartTime, nBytes=None, nSamples=None):
+    '''
+    Report the duration of a finished loading stage to progressCallback, if any, and to the instrumentation sinks, if
+    any. progressCallback is called as progressCallback(stage, duration in s) and can abort loading by raising
+    LoadCancelled. Chunked stages also call it after each chunk, see reportChunk.
+    :param progressCallback: callable or None
+    :param stage: str, name of the stage
+    :param stageStartTime: float, time.time() at the start of the stage
+    :param nBytes: int or None, bytes of the arrays produced by the stage, only passed on to instrumentation
+    :param nSamples: int or None, number of samples processed by the stage, only passed on to instrumentation
+    '''
+
+    if progressCallback is not None or instrumentation.sinks:
+        reportDuration(progressCallback, stage, time.time() - stageStartTime, nBytes, nSamples)
+
+
+def reportDuration(progressCallback, stage, duration, nBytes=None, nSamples=None):
+    '''
+    Like reportStage, for a stage whose duration was measured elsewhere, e.g., in a worker process
+    '''
+
+    if instrumentation.sinks:
+        instrumentation.recordStage(fullStageName(progressCallback, stage), duration, nBytes, nSamples)
+    if progressCallback is not None:
+        progressCallback(stage, duration)
+
+
+def reportChunk(progressCallback, stage):
+    '''
+    Report that a chunk of a chunked stage is done to progressCallback, if any, as progressCallback(stage, None), so
+    that loading can be aborted within the stage by raising LoadCancelled. Callbacks showing stage durations should
+    ignore these calls.
+    :param progressCallback: callable or None
+    :param stage: str, name of the stage
+    '''
+
+    if progressCallback is not None:
+        progressCallback(stage, None)
+
+# **********************************************************************************************************************
+
+
+class StagePrefix(object):
+    '''
+    Progress callback reporting stages to another one, which can be None, as '<prefix>: <stage>', see prefixStages
+    '''
+
+    def __init__(self, progressCallback, prefix):
+
+        self.progressCallback = progressCallback
+        self.prefix = prefix
+
+    def __call__(self, stage, duration):
+
+        if self.progressCallback is not None:
+            self.progressCallback('{}: {}'.format(self.prefix, stage), duration)
+
+
+def fullStageName(progressCallback, stage):
+    '''
+    Name of a stage reported to progressCallback, with the prefixes added by prefixStages
+    '''
+
+    while isinstance(progressCallback, StagePrefix):
+        stage = '{}: {}'.format(progressCallback.prefix, stage)
+        progressCallback = progressCallback.progressCallback
+    return stage
+
+
+def prefixStages(progressCallback, prefix):
+    '''
+    Wrap progressCallback so that stage names are reported as '<prefix>: <stage>'. The prefix is kept for the
+    instrumentation sinks, if any, even if progressCallback is None.
+    '''
+
+    if progressCallback is None and not instrumentation.sinks:
+        return None
+    else:
+        return StagePrefix(progressCallback, prefix)
+
+# **********************************************************************************************************************
+
+
+class ProcessingStringError(ValueError):
+    '''
+    Raised for an improper calibration string or string of intervals to exclude, with the position in the string
+    where it stops conforming to the grammar
+    '''
+
+    def __init__(self, kind, string, position, expected):
+        '''
+        :param kind: str, e.g., 'calibration string'
+        :param string: str, the string parsed
+        :param position: int, index in string of the first character that could not be parsed
+        :param expected: str, description of what was expected at position
+        '''
+
+        ValueError.__init__(self, "Improper {} '{}': expected {} at character {}".format(
+            kind, string, expected, position + 1))
+        self.kind = kind
+        self.string = string
+        self.position = position
+        self.expected = expected
+
+# **********************************************************************************************************************
+
+
+numberPattern = re.compile(r'\s*((\d+\.?\d*|\.\d+)([eE][+-]?\d+)?)')
+gainPattern = re.compile(r'\s*([+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?)')
+secondsPattern = re.compile(r'\s*(sec|s)(?![A-Za-z])')
+maxTimePattern = re.compile(r'\s*(maxtime|max time|Max Time)')
+
+
+class ProcessingStringParser(object):
+    '''
+    Recursive descent parser of calibration strings and strings of intervals to exclude:
 
+        exclusionString := interval (';' interval)*
+        calibString     := calibSegment ((';' | ':') calibSegment)*
+        calibSegment    := gain | interval ',' gain
+        interval        := time '-' (time | 'maxtime' | 'max time' | 'Max Time')
+        time            := number ['s' | 'sec']
 
-        startTime = float(startTimeStr)
+    Times are in s and whitespace is allowed between tokens. Use parseCalibStr and parseExclusionStr, which memoize
+    the parsed strings.
+    '''
+
+    def __init__(self, string, kind):
+
+        self.string = string
+        self.kind = kind
+        self.position = 0
+
+    def error(self, expected, position=None):
+
+        raise ProcessingStringError(self.kind, self.string, self.position if position is None else position,
+                                    expected)
+
+    def match(self, pattern):
+
+        match = pattern.match(self.string, self.position)
+        if match is not None:
+            self.position = match.end()
+        return match
+
+    def skipSpace(self):
+
+        while self.position < len(self.string) and self.string[self.position].isspace():
+            self.position += 1
+
+    def literal(self, chars):
+
+        self.skipSpace()
+        if self.position < len(self.string) and self.string[self.position] in chars:
+            self.position += 1
+            return True
+        return False
+
+    def atEnd(self):
+
+        self.skipSpace()
+        return self.position == len(self.string)
+
+    def time(self, allowMaxTime):
+
+        if allowMaxTime and self.match(maxTimePattern):
+            return None
+        match = self.match(numberPattern)
+        if match is None:
+            self.error("a time in s or 'maxtime'" if allowMaxTime else 'a time in s')
+        self.match(secondsPattern)
+        return float(match.group(1))
+
+    def interval(self):
+
+        self.skipSpace()
+        intervalPosition = self.position
+        startTime = self.time(allowMaxTime=False)
+        if not self.literal('-'):
+            self.error("'-'")
+        endTime = self.time(allowMaxTime=True)
+        if endTime is not None and endTime < startTime:
+            self.error('an interval ending after it starts', intervalPosition)
         return startTime, endTime
-    except Exception as e:
-        raise ValueError('Improper Recording period string {}'.format(startStopStr))
+
+    def gain(self):
+
+        match = self.match(gainPattern)
+        if match is None:
+            self.error('a calibration value')
+        return float(match.group(1))
+
+    def calibSegment(self):
+
+        segmentPosition = self.position
+        # a lone gain is followed by a separator or the end, the start time of an interval by 's', 'sec' or '-'
+        gainMatch = self.match(gainPattern)
+        if gainMatch is not None and (self.atEnd() or self.string[self.position] in ';:'):
+            return None, None, float(gainMatch.group(1))
+
+        self.position = segmentPosition
+        self.skipSpace()
+        if numberPattern.match(self.string, self.position) is None:
+            self.error('a calibration value or an interval')
+        startTime, endTime = self.interval()
+        if not self.literal(','):
+            self.error("','")
+        return startTime, endTime, self.gain()
+
+    def sequence(self, item, separators):
+
+        items = [item()]
+        while not self.atEnd():
+            if not self.literal(separators):
+                self.error(' or '.join("'{}'".format(x) for x in separators))
+            items.append(item())
+        return tuple(items)
+
+    def calibString(self):
+
+        return self.sequence(self.calibSegment, ';:')
+
+    def exclusionString(self):
+
+        return self.sequence(self.interval, ';')
 
 # **********************************************************************************************************************
 
-def parseInts2ExcludeStr(int2ExcludeStr, int2ExcludeUnitStr, recordingStartTime, recordingStopTime):
 
-    try:
-        if int2ExcludeStr.find(";") < 0:
+# parsed strings and units by string, shared by all signals and loads
+parsedStrings = {}
+maxParsedStrings = 1024
 
-            int2Ex_StartTime, int2Ex_EndTime = parseStartStopStr(int2ExcludeStr)
 
-            int2Ex_StartTime *= qu.Quantity(1, units=int2ExcludeUnitStr)
-            int2Ex_EndTime *= qu.Quantity(1, units=int2ExcludeUnitStr)
+def memoizedParse(kind, string, parse):
 
-            return [(max(int2Ex_StartTime, recordingStartTime), min(int2Ex_EndTime, recordingStopTime))]
+    key = (kind, string)
+    parsed = parsedStrings.get(key)
+    if parsed is None:
+        if len(parsedStrings) >= maxParsedStrings:
+            parsedStrings.clear()
+        parsed = parse()
+        parsedStrings[key] = parsed
+    return parsed
 
-        else:
-            ints2ExcludeStrs = int2ExcludeStr.split(";")
-            toReturn = []
-            for i in ints2ExcludeStrs:
-                int2Ex_StartTime, int2Ex_EndTime = parseStartStopStr(i)
 
-                int2Ex_StartTime *= qu.Quantity(1, units=int2ExcludeUnitStr)
-                int2Ex_EndTime *= qu.Quantity(1, units=int2ExcludeUnitStr)
+def parseCalibStr(calibString):
+    '''
+    Parse and validate a calibration string, e.g., '20' or '0-100, 20;100-maxtime, 25'
+    :param calibString: str, segments separated by ';' or ':'
+    :return: tuple of (start time in s, end time in s, gain) per segment, all floats. Start and end times are None
+    for a segment covering the whole signal and the end time is None for segments up to the end of the signal.
+    :raises ProcessingStringError: if calibString is improper
+    '''
 
-                toReturn.append((max(int2Ex_StartTime, recordingStartTime), min(int2Ex_EndTime, recordingStopTime)))
+    return memoizedParse('calibration string', calibString,
+                         lambda: ProcessingStringParser(calibString, 'calibration string').calibString())
 
-        return toReturn
 
-    except Exception as e:
-        print("Error:{}".format(str(e)))
-        raise(ValueError("Improper 'Intervals to Exclude' {} string!".format(int2ExcludeStr)))
+def parseExclusionStr(ints2ExcludeStr):
+    '''
+    Parse and validate a string of intervals to exclude, e.g., '0-5;100-maxtime'
+    :param ints2ExcludeStr: str, intervals separated by ';'
+    :return: tuple of (start time in s, end time in s) per interval, floats. The end time is None for intervals up
+    to the end of the signal.
+    :raises ProcessingStringError: if ints2ExcludeStr is improper
+    '''
 
+    return memoizedParse('intervals to exclude', ints2ExcludeStr,
+                         lambda: ProcessingStringParser(ints2ExcludeStr, 'intervals to exclude').exclusionString())
 
-def parseCalibString(calibString, unitStr):
 
-    if calibString.find(',') < 0:
-        calibValQ = qu.Quantity(float(calibString), units=unitStr)
-        return calibValQ, None, None
-    else:
-        timeIntervalStr, calibVal = calibString.split(", ")
-        calibValQ = qu.Quantity(float(calibVal), units=unitStr)
+def calibUnits(calibUnitStr):
+    '''
+    Units of the calibration values, memoized
+    :param calibUnitStr: str, e.g., 'mV'
+    :return: quantities.Quantity
+    '''
 
-        startTimeStr, endTimeStr = timeIntervalStr.split("-")
+    return memoizedParse('units', calibUnitStr, lambda: qu.Quantity(1., units=calibUnitStr).units)
 
-        if endTimeStr.endswith('s'):
-            endTimeStr = endTimeStr.rstrip('s')
-        elif endTimeStr.endswith('sec'):
-            endTimeStr = endTimeStr.rstrip('sec')
 
-        try:
-            if endTimeStr in ['maxtime', 'max time', 'Max Time']:
-                endTime = None
-            else:
-                endTime = float(endTimeStr) * qu.s
+def validateProcessingStrings(calibStrings, ints2ExcludeStr=None):
+    '''
+    Parse all the strings used to process the signals of a file, so that improper ones are reported before any signal
+    is read
+    :param calibStrings: dict of calibration strings, values can be None for channels not used
+    :param ints2ExcludeStr: str or None, intervals to exclude
+    :raises ProcessingStringError: for the first improper string
+    '''
+
+    for calibString in calibStrings.values():
+        if calibString is not None:
+            parseCalibStr(calibString)
+    if ints2ExcludeStr is not None:
+        parseExclusionStr(ints2ExcludeStr)
+
+# **********************************************************************************************************************
+
 
-            if startTimeStr.endswith('sec'):
-                startTimeStr = startTimeStr.rstrip('sec')
-            startTime = float(startTimeStr) * qu.s
+def parseStartStopStr(startStopStr):
 
-            return calibValQ, startTime, endTime
-        except Exception as e:
-            raise ValueError('Improper calibration string {}'.format(calibString))
+    (startTime, endTime), = ProcessingStringParser(startStopStr, 'recording period string').exclusionString()
+    return startTime, endTime
 
 # **********************************************************************************************************************
 
-def calibrateSignal(inputSignal, calibString, calibUnitStr, forceUnits=None):
+def parseInts2ExcludeStr(int2ExcludeStr, int2ExcludeUnitStr, recordingStartTime, recordingStopTime):
 
-    if calibString.find(';') > 0:
-        calibStrings = calibString.split(';')
-    elif calibString.find(':') > 0:
-        calibStrings = calibString.split(':')
-    elif all([x.isdigit() or x == '.' for x in calibString]):
-        calibStrings = [calibString]
-    else:
-        raise(ValueError("Improper Calibration string {}".format(calibString)))
+    unit = qu.Quantity(1, units=int2ExcludeUnitStr)
+    return [(max(startTime * unit, recordingStartTime),
+             recordingStopTime if endTime is None else min(endTime * unit, recordingStopTime))
+            for startTime, endTime in parseExclusionStr(int2ExcludeStr)]
 
-    ipSignalMag = inputSignal.magnitude.copy()
-    ipSigUnits = inputSignal.units
 
-    for calibString in calibStrings:
+def parseCalibString(calibString, unitStr):
 
-        calib, startTime, endTime = parseCalibString(calibString, calibUnitStr)
+    (calib, startTime, endTime), = [(qu.Quantity(gain, units=unitStr),
+                                     None if startTime is None else startTime * qu.s,
+                                     None if endTime is None else endTime * qu.s)
+                                    for startTime, endTime, gain in ProcessingStringParser(
+                                        calibString, 'calibration string').calibString()]
+    return calib, startTime, endTime
 
-        if endTime is None:
-            endTime = inputSignal.t_stop
+# **********************************************************************************************************************
 
-        if startTime is None:
-            startTime = inputSignal.t_start
+class CalibrationPlan(object):
+    '''
+    A calibration string compiled, for a signal with given start time, sampling rate and number of samples, into
+    sample index ranges with constant gain. Calibration segments can overlap, in which case their gains multiply.
+    The plan can be applied in place to a whole signal or to consecutive chunks of a streamed signal.
+    '''
+
+    def __init__(self, calibString, calibUnitStr, tStart, samplingRate, nSamples):
+        '''
+        :param calibString: str, calibration string, segments separated by ';' or ':'
+        :param calibUnitStr: str, unit of the calibration values
+        :param tStart: float, time of the first sample in s
+        :param samplingRate: float, in Hz
+        :param nSamples: int, number of samples of the signal
+        '''
+
+        startInds = []
+        endInds = []
+        gains = []
+        for startTime, endTime, gain in parseCalibStr(calibString):
+            startInds.append(0 if startTime is None else int((startTime - tStart) * samplingRate))
+            endInds.append(nSamples if endTime is None else int((endTime - tStart) * samplingRate))
+            gains.append(gain)
+
+        self.units = calibUnits(calibUnitStr)
+        self.nSamples = nSamples
+        self.startInds = np.clip(startInds, 0, nSamples).astype(np.int64)
+        self.endInds = np.clip(endInds, 0, nSamples).astype(np.int64)
+        self.gains = np.array(gains, dtype=np.float64)
+
+        # the signal split at every segment boundary into pieces of constant gain; pieceInds[i]:pieceInds[i + 1] has
+        # the product of the gains of all segments covering it
+        self.pieceInds = np.unique(np.concatenate(([0, nSamples], self.startInds, self.endInds)))
+        pieceStarts = self.pieceInds[:-1]
+        covered = (self.startInds[:, None] <= pieceStarts[None, :]) & (self.endInds[:, None] > pieceStarts[None, :])
+        self.pieceGains = np.where(covered, self.gains[:, None], 1.0).prod(axis=0)
+
+    def gainVector(self, startInd=0, endInd=None):
+        '''
+        Gain of each sample with index in [startInd, endInd)
+        :return: numpy.ndarray of float64
+        '''
+
+        endInd = self.nSamples if endInd is None else endInd
+        pieceLengths = np.diff(np.clip(self.pieceInds, startInd, endInd))
+        return np.repeat(self.pieceGains, pieceLengths)
+
+    def apply(self, samples, firstInd=0):
+        '''
+        Multiply, in place, samples with their gains
+        :param samples: numpy.ndarray, consecutive samples of the signal along the first axis
+        :param firstInd: int, index of samples[0] in the signal
+        '''
+
+        lastInd = firstInd + samples.shape[0]
+        firstPiece = max(0, int(np.searchsorted(self.pieceInds, firstInd, side='right')) - 1)
+        lastPiece = int(np.searchsorted(self.pieceInds, lastInd, side='left'))
+
+        for pieceInd in range(firstPiece, min(lastPiece, self.pieceGains.shape[0])):
+            gain = self.pieceGains[pieceInd]
+            lo = max(int(self.pieceInds[pieceInd]), firstInd)
+            hi = min(int(self.pieceInds[pieceInd + 1]), lastInd)
+            if gain != 1 and lo < hi:
+                samples[lo - firstInd: hi - firstInd] *= gain
 
-        startIndex = int((startTime - inputSignal.t_start) * inputSignal.sampling_rate)
+# **********************************************************************************************************************
 
-        endIndex = int((endTime - inputSignal.t_start) * inputSignal.sampling_rate)
+def calibrateSignal(inputSignal, calibString, calibUnitStr, forceUnits=None, inPlace=False):
+    '''
+    Calibrate a signal according to a calibration string
+    :param inputSignal: neo.AnalogSignal
+    :param calibString: str, calibration string, segments separated by ';' or ':'
+    :param calibUnitStr: str, unit of the calibration values
+    :param forceUnits: quantities.Quantity, units of the calibrated signal. If None, those of calibUnitStr
+    :param inPlace: bool, if True, the samples of inputSignal are calibrated in place and shared by the returned
+    signal, avoiding a copy of the whole signal
+    :return: neo.AnalogSignal
+    '''
+
+    calibPlan = CalibrationPlan(calibString, calibUnitStr, float(inputSignal.t_start.simplified),
+                                float(inputSignal.sampling_rate.simplified), inputSignal.shape[0])
+
+    ipSignalMag = inputSignal.magnitude if inPlace else inputSignal.magnitude.copy()
+    ipSigUnits = inputSignal.units
 
-        ipSignalMag[startIndex: endIndex] *= calib.magnitude
+    calibPlan.apply(ipSignalMag)
 
     if forceUnits is not None:
         ipSigUnits = forceUnits
     else:
         if ipSigUnits == qu.Quantity(1):
-            ipSigUnits = calib.units
+            ipSigUnits = calibPlan.units
 
-        elif ipSigUnits != calib.units:
+        elif ipSigUnits != calibPlan.units:
             raise(Exception('CalibStrings given don\'t have the same units'))
 
 
@@ -143,53 +469,157 @@ def calibrateSignal(inputSignal, calibString, calibUnitStr, forceUnits=None):
 # **********************************************************************************************************************
 
 
-def excludeIntervals(inputSignal, ints2ExcludeStr=None):
+class ExclusionPlan(object):
+    '''
+    Intervals to exclude compiled, for a signal with given start time, sampling rate and number of samples, into
+    sample index ranges to be replaced by straight lines between the samples at their ends. Overlapping intervals are
+    merged and intervals outside the signal are dropped. Like CalibrationPlan, the plan can be applied in place to a
+    whole signal or to consecutive chunks of a streamed signal, all ranges at once.
+    '''
+
+    def __init__(self, ints2ExcludeStr, tStart, samplingRate, nSamples):
+        '''
+        :param ints2ExcludeStr: str, intervals to exclude in s, as used for excludeIntervals
+        :param tStart: float, time of the first sample in s
+        :param samplingRate: float, in Hz
+        :param nSamples: int, number of samples of the signal
+        '''
+
+        tStop = tStart + nSamples / float(samplingRate)
+        ints2Exclude = parseExclusionStr(ints2ExcludeStr)
+        intStarts = np.array([startTime for startTime, endTime in ints2Exclude], dtype=np.float64)
+        intEnds = np.array([tStop if endTime is None else endTime for startTime, endTime in ints2Exclude],
+                           dtype=np.float64)
+
+        # end indices are inclusive
+        stInds = np.clip(((intStarts - tStart) * samplingRate).astype(np.int64), 0, nSamples - 1)
+        endInds = np.clip(((intEnds - tStart) * samplingRate).astype(np.int64), 0, nSamples - 1)
+        inRange = (intStarts <= intEnds) & (intEnds >= tStart) & (intStarts < tStop)
+        stInds = stInds[inRange]
+        endInds = endInds[inRange]
+
+        # merge overlapping intervals, so that no interval is interpolated from a sample inside another one
+        order = np.argsort(stInds, kind='mergesort')
+        stInds = stInds[order]
+        endInds = np.maximum.accumulate(endInds[order]) if endInds.shape[0] else endInds
+        newInterval = np.ones(stInds.shape[0], dtype=bool)
+        newInterval[1:] = stInds[1:] > endInds[:-1]
+        lastOfInterval = np.ones(stInds.shape[0], dtype=bool)
+        lastOfInterval[:-1] = newInterval[1:]
+
+        self.nSamples = nSamples
+        self.stInds = stInds[newInterval]
+        self.endInds = endInds[lastOfInterval]
+
+        # samples at the ends of the intervals, before exclusion, see setEdgeValues
+        self.leftValues = None
+        self.rightValues = None
+
+    def setEdgeValues(self, leftValues, rightValues):
+        '''
+        Set the samples at the ends of the intervals, needed when the plan is applied to chunks of a signal
+        :param leftValues: numpy.ndarray, samples at stInds
+        :param rightValues: numpy.ndarray, samples at endInds
+        '''
+
+        self.leftValues = np.asarray(leftValues, dtype=np.float64)
+        self.rightValues = np.asarray(rightValues, dtype=np.float64)
+
+    def apply(self, samples, firstInd=0):
+        '''
+        Replace, in place, the samples in the intervals by straight lines between the samples at their ends
+        :param samples: 1D numpy.ndarray, consecutive samples of the signal. If setEdgeValues has not been called,
+        the whole signal, from which the edge values are then taken.
+        :param firstInd: int, index of samples[0] in the signal
+        '''
+
+        if self.leftValues is None:
+            assert firstInd == 0 and samples.shape[0] == self.nSamples, \
+                'setEdgeValues must be called before applying an ExclusionPlan to chunks'
+            self.setEdgeValues(samples[self.stInds], samples[self.endInds])
+
+        lastInd = firstInd + samples.shape[0]
+        overlapping = (self.stInds < lastInd) & (self.endInds >= firstInd)
+        stInds = self.stInds[overlapping]
+        lo = np.maximum(stInds, firstInd)
+        hi = np.minimum(self.endInds[overlapping] + 1, lastInd)
+        if not lo.shape[0]:
+            return
+
+        slopes = (self.rightValues[overlapping] - self.leftValues[overlapping]) \
+            / np.maximum(self.endInds[overlapping] - stInds, 1)
+
+        # indices of all the samples to replace, interval after interval
+        lengths = hi - lo
+        rangeStarts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        inds = np.arange(lengths.sum()) - rangeStarts + np.repeat(lo, lengths)
+
+        samples[inds - firstInd] = np.repeat(self.leftValues[overlapping], lengths) \
+            + np.repeat(slopes, lengths) * (inds - np.repeat(stInds, lengths))
+
+# **********************************************************************************************************************
+
+def excludeIntervals(inputSignal, ints2ExcludeStr=None, inPlace=False):
+    '''
+    Replace the samples of a signal in intervals to exclude by straight lines between the samples at their ends
+    :param inputSignal: neo.AnalogSignal
+    :param ints2ExcludeStr: str, intervals to exclude in s, separated by ';'. If None, inputSignal is returned.
+    :param inPlace: bool, if True, the samples of inputSignal are replaced in place, avoiding a copy of the signal
+    :return: neo.AnalogSignal
+    '''
 
     if ints2ExcludeStr is None:
         return inputSignal
     else:
-        ints2Exclude = parseInts2ExcludeStr(ints2ExcludeStr, 's',
-                                            inputSignal.t_start, inputSignal.t_stop)
-        outputSignal = inputSignal.copy()
-        for stTime, endTime in ints2Exclude:
-            stInd = int((stTime - inputSignal.t_start) * inputSignal.sampling_rate)
-            endInd = int((endTime - inputSignal.t_start) * inputSignal.sampling_rate)
-
-            leftValue = inputSignal[stInd]
-            rightValue = inputSignal[endInd]
-            slope = (rightValue - leftValue) / (endInd - stInd)
-            replacementSignal = leftValue + slope * np.arange(endInd - stInd + 1)
-            replacementSignal = replacementSignal.reshape((replacementSignal.shape[0], 1))
-            outputSignal[stInd: endInd + 1] = replacementSignal
+        exclusionPlan = ExclusionPlan(ints2ExcludeStr, float(inputSignal.t_start.simplified),
+                                      float(inputSignal.sampling_rate.simplified), inputSignal.shape[0])
+        outputSignal = inputSignal if inPlace else inputSignal.copy()
+        exclusionPlan.apply(outputSignal.magnitude.reshape((outputSignal.shape[0],)))
         return outputSignal
 
 
 
 # **********************************************************************************************************************
 
-def readSignal(rawSignal, calibStrings, calibUnitStr, timeWindow, forceUnits=None, ints2Exclude=None):
+def readSignal(rawSignal, calibStrings, calibUnitStr, timeWindow, forceUnits=None, ints2Exclude=None,
+               progressCallback=None, inPlace=False):
 
-    intsExcludedSignal = excludeIntervals(rawSignal, ints2Exclude)
-    calibSignal = calibrateSignal(intsExcludedSignal, calibStrings, calibUnitStr, forceUnits)
+    stageStartTime = time.time()
+    intsExcludedSignal = excludeIntervals(rawSignal, ints2Exclude, inPlace=inPlace)
+    reportStage(progressCallback, 'exclude', stageStartTime, intsExcludedSignal.nbytes, rawSignal.shape[0])
 
-    startInd = int((timeWindow[0] - calibSignal.t_start) * calibSignal.sampling_rate.magnitude)
-    endInd = int((timeWindow[1] - calibSignal.t_start) * calibSignal.sampling_rate.magnitude)
+    stageStartTime = time.time()
+    # excludeIntervals returns a copy unless there is nothing to exclude or inPlace is True
+    calibSignal = calibrateSignal(intsExcludedSignal, calibStrings, calibUnitStr, forceUnits,
+                                  inPlace=inPlace or ints2Exclude is not None)
+    reportStage(progressCallback, 'calibrate', stageStartTime, calibSignal.nbytes, rawSignal.shape[0])
+
+    tStart = quantity2Seconds(calibSignal.t_start)
+    samplingRate = float(calibSignal.sampling_rate.magnitude)
+    startInd = int((quantity2Seconds(timeWindow[0]) - tStart) * samplingRate)
+    endInd = int((quantity2Seconds(timeWindow[1]) - tStart) * samplingRate)
 
     return calibSignal[startInd: endInd + 1]
 
 # **********************************************************************************************************************
 
-def parseSpike2Data(smrFile, calibStrings, startStop=None, ints2ExcludeStr=None, forceUnits=False):
+def parseSpike2Data(smrFile, calibStrings, startStop=None, ints2ExcludeStr=None, forceUnits=False,
+                    progressCallback=None):
 
-    spike2Reader = Spike2IO(smrFile)
-    dataBlock = spike2Reader.read()[0]
-    entireVoltageSignal = dataBlock.segments[0].analogsignals[0]
+    # channels are read from the memory map of the file one at a time, right before they are processed, so that at
+    # most one raw channel is held in memory besides the processed signals
+    reader = SMRReader(smrFile)
+    channels = reader.analogChannels
 
-    entireVibrationSignal = dataBlock.segments[0].analogsignals[1]
+    def readChannel(channelIndex, signalName):
+        stageStartTime = time.time()
+        rawSignal = reader.readAnalogSignal(channelIndex)
+        reportStage(prefixStages(progressCallback, signalName), 'read', stageStartTime, rawSignal.nbytes,
+                    rawSignal.shape[0])
+        return rawSignal
 
-    entireCurrentSignal = None
-    if len(dataBlock.segments[0].analogsignals) > 2 and calibStrings['currentCalibStr'] is not None:
-        entireCurrentSignal = dataBlock.segments[0].analogsignals[2]
+    readCurrent = len(channels) > 2 and calibStrings['currentCalibStr'] is not None
+    if readCurrent:
         currentCalibs = calibStrings['currentCalibStr']
         currentCalibUnitStr = 'nA'
 
@@ -204,15 +634,11 @@ def parseSpike2Data(smrFile, calibStrings, startStop=None, ints2ExcludeStr=None,
         recordingEndTime = np.inf
 
     else:
-        recordingStartTime = startStop[0] * qu.s
-        recordingEndTime = startStop[1] * qu.s
+        recordingStartTime = startStop[0]
+        recordingEndTime = startStop[1]
 
-    recordingStartTime = max(recordingStartTime,
-                             entireVibrationSignal.t_start,
-                             entireVoltageSignal.t_start)
-    recordingEndTime = min(recordingEndTime,
-                           entireVibrationSignal.t_stop,
-                           entireVoltageSignal.t_stop)
+    recordingStartTime = max(recordingStartTime, channels[1].tStart, channels[0].tStart) * qu.s
+    recordingEndTime = min(recordingEndTime, channels[1].tStop, channels[0].tStop) * qu.s
 
     if forceUnits:
         voltForceUnits = qu.mV
@@ -221,83 +647,907 @@ def parseSpike2Data(smrFile, calibStrings, startStop=None, ints2ExcludeStr=None,
     else:
         voltForceUnits = vibForceUnits = currForceUnits = None
 
-    voltageSignal = readSignal(entireVoltageSignal, voltageCalibs, voltageCalibUnitStr,
-                               [recordingStartTime, recordingEndTime], voltForceUnits, ints2ExcludeStr)
+    voltageSignal = readSignal(readChannel(0, 'MembranePotential'), voltageCalibs, voltageCalibUnitStr,
+                               [recordingStartTime, recordingEndTime], voltForceUnits, ints2ExcludeStr,
+                               prefixStages(progressCallback, 'MembranePotential'), inPlace=True)
     voltageSignal.name = 'MembranePotential'
 
-    vibrationSignal = readSignal(entireVibrationSignal, vibrationCalibs, vibrationCalibUnitStr,
-                                 [recordingStartTime, recordingEndTime], vibForceUnits, ints2ExcludeStr)
+    vibrationSignal = readSignal(readChannel(1, 'VibrationStimulus'), vibrationCalibs, vibrationCalibUnitStr,
+                                 [recordingStartTime, recordingEndTime], vibForceUnits, ints2ExcludeStr,
+                                 prefixStages(progressCallback, 'VibrationStimulus'), inPlace=True)
     vibrationSignal.name = 'VibrationStimulus'
 
     currentSignal = None
 
-    if len(dataBlock.segments[0].analogsignals) > 2 and calibStrings['currentCalibStr'] is not None:
-        currentSignal = readSignal(entireCurrentSignal, currentCalibs, currentCalibUnitStr,
+    if readCurrent:
+        currentSignal = readSignal(readChannel(2, 'CurrentInput'), currentCalibs, currentCalibUnitStr,
                                    [recordingStartTime, recordingEndTime],
-                                   currForceUnits)
+                                   currForceUnits, progressCallback=prefixStages(progressCallback, 'CurrentInput'),
+                                   inPlace=True)
         currentSignal.name = 'CurrentInput'
 
     return voltageSignal, vibrationSignal, currentSignal
 
 # **********************************************************************************************************************
 
+def plotMaxBins(ax):
+    '''
+    Number of envelope bins for drawing signals on ax with about 2 points per pixel
+    :param ax: matplotlib.axes.Axes
+    :return: int
+    '''
+
+    return max(1, int(ax.get_window_extent().width))
+
+# **********************************************************************************************************************
+
+
+def epochYLims(epochTraces):
+    '''
+    Y limits for plotting epoch traces: at least [-50, 20], extended to include all values
+    :param epochTraces: list of (signal attribute, times, values), see RawDataViewer.getEpochTraces
+    :return: list of two floats
+    '''
+
+    ylims = [-50, 20]
+    for signalAttr, traceTimes, traceValues in epochTraces:
+        if not traceValues.shape[0]:
+            continue
+        ylims[0] = min(ylims[0], traceValues.min().magnitude)
+        ylims[1] = max(ylims[1], traceValues.max().magnitude)
+
+    return ylims
+
+# **********************************************************************************************************************
+
+
+class LazyAnalogSignal(object):
+    '''
+    Stands in for the downsampled neo.AnalogSignal of one channel of an SMR file. Only the header information is
+    held in memory; the samples covering a time window are read from the file, cleaned of the intervals to exclude,
+    calibrated and downsampled when the window is requested with timeSlice.
+    '''
+
+    def __init__(self, reader, channelIndex, name, calibString, calibUnitStr, startTime, endTime, downSampleFactor,
+                 forceUnits=None, ints2ExcludeStr=None, decimationMode='stride'):
+        '''
+        :param reader: smrReader.SMRReader
+        :param channelIndex: int, index of the channel among the waveform channels of reader
+        :param name: str, name given to the signals returned by timeSlice
+        :param calibString: str, calibration string, as used for calibrateSignal
+        :param calibUnitStr: str, unit of the calibration values
+        :param startTime: float, in s, start of the recording period
+        :param endTime: float, in s, end of the recording period
+        :param downSampleFactor: int, must be at least 1
+        :param forceUnits: quantities.Quantity, units of the calibrated signal. If None, those of calibUnitStr
+        :param ints2ExcludeStr: str, intervals to exclude, as used for excludeIntervals
+        :param decimationMode: str, 'stride' or 'fir', see NEOFuncs.decimateSamples. Min/max envelopes are provided
+        by envelopeSlice and stream instead of a 'minmax' mode.
+        '''
+
+        assert downSampleFactor >= 1, 'downsample factor must be atleast 1'
+        assert decimationMode in ('stride', 'fir'), 'decimationMode must be one of "stride" and "fir"'
+
+        self.reader = reader
+        self.channelIndex = channelIndex
+        self.channel = reader.analogChannels[channelIndex]
+        self.name = name
+        self.downSampleFactor = downSampleFactor
+        self.decimationMode = decimationMode
+        self.firTaps = firDecimationTaps(downSampleFactor) if decimationMode == 'fir' else None
+        self.units = forceUnits if forceUnits is not None else qu.Quantity(1, units=calibUnitStr).units
+
+        nRawSamples = self.channel.nSamples
+        self.firstRawInd = max(0, self.channel.time2Index(startTime))
+        lastRawInd = min(nRawSamples - 1, self.channel.time2Index(endTime))
+        self.nSamples = max(0, (lastRawInd - self.firstRawInd) // downSampleFactor + 1)
+        self.rawEndInd = lastRawInd + 1
+
+        self.calibPlan = CalibrationPlan(calibString, calibUnitStr, self.channel.tStart, self.channel.samplingRate,
+                                         nRawSamples)
+
+        self.exclusionPlan = None
+        if ints2ExcludeStr is not None:
+            self.exclusionPlan = ExclusionPlan(ints2ExcludeStr, self.channel.tStart, self.channel.samplingRate,
+                                               nRawSamples)
+            # the samples at the ends of the intervals are needed before any chunk is cleaned
+            self.exclusionPlan.setEdgeValues(
+                [reader.readSamples(channelIndex, x, x + 1)[0] for x in self.exclusionPlan.stInds],
+                [reader.readSamples(channelIndex, x, x + 1)[0] for x in self.exclusionPlan.endInds])
+
+    @property
+    def sampling_period(self):
+        return self.channel.samplingPeriod * self.downSampleFactor * qu.s
+
+    @property
+    def sampling_rate(self):
+        return (1.0 / self.sampling_period).rescale(qu.Hz)
+
+    @property
+    def t_start(self):
+        return (self.channel.tStart + self.firstRawInd * self.channel.samplingPeriod) * qu.s
+
+    @property
+    def t_stop(self):
+        return self.t_start + self.nSamples * self.sampling_period
+
+    def timeBase(self):
+        '''
+        Time base of the downsampled signal as plain numbers, see NEOFuncs.signalTimeBase
+        :return: tStart, samplingPeriod, nSamples; floats in s and int
+        '''
+
+        return (self.channel.tStart + self.firstRawInd * self.channel.samplingPeriod,
+                self.channel.samplingPeriod * self.downSampleFactor, self.nSamples)
+
+    def cleanRawWindow(self, window, windowStartInd):
+        '''
+        Apply, in place, the exclusion of intervals and the calibration to a window of raw samples
+        :param window: numpy.ndarray, raw samples
+        :param windowStartInd: int, raw index of the first sample of window
+        '''
+
+        if self.exclusionPlan is not None:
+            self.exclusionPlan.apply(window, windowStartInd)
+
+        self.calibPlan.apply(window, windowStartInd)
+
+    def readDecimated(self, rawStartInd, rawEndInd):
+        '''
+        Read, clean, calibrate and decimate the raw samples in [rawStartInd, rawEndInd). With the 'fir' decimation
+        mode, the samples around the window needed by the filter are read as well.
+        :param rawStartInd: int, raw index on the downsampling grid, i.e., firstRawInd plus a multiple of
+        downSampleFactor
+        :param rawEndInd: int
+        :return: decimated, window; numpy.ndarrays of the decimated samples and of the cleaned raw samples
+        '''
+
+        margin = firHalfLength * self.downSampleFactor if self.decimationMode == 'fir' else 0
+        readStartInd = max(self.firstRawInd, rawStartInd - margin)
+        readEndInd = min(self.rawEndInd, rawEndInd + margin)
+        readWindow = self.reader.readSamples(self.channelIndex, readStartInd, readEndInd)
+        self.cleanRawWindow(readWindow, readStartInd)
+        window = readWindow[rawStartInd - readStartInd: rawEndInd - readStartInd]
+
+        if self.decimationMode == 'fir':
+            outStartInd = (rawStartInd - readStartInd) // self.downSampleFactor
+            nOut = (window.shape[0] + self.downSampleFactor - 1) // self.downSampleFactor
+            decimated = firDecimate(readWindow, self.downSampleFactor, outStartInd, outStartInd + nOut,
+                                    self.firTaps).astype(np.float32)
+        else:
+            decimated = window[::self.downSampleFactor]
+
+        return decimated, window
+
+    def iterChunks(self, chunkSize=2 ** 20):
+        '''
+        Read, clean, calibrate and downsample the whole recording period chunk by chunk
+        :param chunkSize: int, approximate number of raw samples per chunk
+        :return: generator of (index of the first downsampled sample, downsampled samples, cleaned raw samples)
+        '''
+
+        # chunks start on the downsampling grid so that each one contributes whole downsampled sampling periods
+        chunkSize = max(1, chunkSize // self.downSampleFactor) * self.downSampleFactor
+        rawEndInd = self.firstRawInd + self.nSamples * self.downSampleFactor
+
+        for chunkStartInd in range(self.firstRawInd, rawEndInd, chunkSize):
+            downSampled, chunk = self.readDecimated(chunkStartInd, min(chunkStartInd + chunkSize, rawEndInd))
+            yield (chunkStartInd - self.firstRawInd) // self.downSampleFactor, downSampled, chunk
+
+    def stream(self, out=None, envelopeOut=None, chunkSize=2 ** 20, progressCallback=None):
+        '''
+        Read, clean, calibrate and downsample the whole recording period in a single pass over chunks of raw samples,
+        writing straight into the output buffers. Peak memory is one chunk plus the outputs.
+        :param out: numpy.ndarray of shape (nSamples,), buffer for the downsampled samples. Allocated if None.
+        :param envelopeOut: tuple of two numpy.ndarrays of shape (nSamples,) or None. If given, the minimum and maximum
+        of the raw samples in each downsampled sampling period are written into them.
+        :param chunkSize: int, approximate number of raw samples per chunk
+        :param progressCallback: callable or None, called as progressCallback('stream', None) after each chunk, see
+        reportChunk, and as progressCallback('stream', duration in s) after the pass
+        :return: out
+        '''
+
+        stageStartTime = time.time()
+        if out is None:
+            out = np.empty(self.nSamples, dtype=np.float32)
+
+        for outStartInd, downSampled, chunk in self.iterChunks(chunkSize):
+            out[outStartInd: outStartInd + downSampled.shape[0]] = downSampled
+
+            if envelopeOut is not None:
+                chunkMins, chunkMaxs = minMaxEnvelope(chunk, self.downSampleFactor)
+                envelopeOut[0][outStartInd: outStartInd + chunkMins.shape[0]] = chunkMins
+                envelopeOut[1][outStartInd: outStartInd + chunkMaxs.shape[0]] = chunkMaxs
+
+            reportChunk(progressCallback, 'stream')
+
+        reportStage(progressCallback, 'stream', stageStartTime,
+                    out.nbytes + (0 if envelopeOut is None else instrumentation.arraysNBytes(*envelopeOut)),
+                    self.nSamples * self.downSampleFactor)
+        return out
+
+    def wrap(self, samples):
+        '''
+        Wrap the output of stream, without copying, as a neo.AnalogSignal
+        :param samples: numpy.ndarray of shape (nSamples,)
+        :return: neo.AnalogSignal
+        '''
+
+        analogSignal = AnalogSignal(signal=samples,
+                                    units=self.units,
+                                    sampling_period=self.sampling_period,
+                                    t_start=self.t_start,
+                                    **noCopyKwargs)
+        analogSignal.name = self.name
+        return analogSignal.reshape((analogSignal.shape[0],))
+
+    def timeSlice(self, sliceStartTime, sliceEndTime):
+        '''
+        Read the downsampled signal between two times, with the same semantics as NEOFuncs.sliceAnalogSignal
+        :param sliceStartTime: quantities.Quantity
+        :param sliceEndTime: quantities.Quantity
+        :return: neo.AnalogSignal
+        '''
+
+        sliceTStart, downSampled = self.sliceSamples(quantity2Seconds(sliceStartTime),
+                                                     quantity2Seconds(sliceEndTime))
+
+        analogSignal = AnalogSignal(signal=downSampled,
+                                    units=self.units,
+                                    sampling_period=self.sampling_period,
+                                    t_start=sliceTStart * qu.s)
+        analogSignal.name = self.name
+        return analogSignal.reshape((analogSignal.shape[0],))
+
+    def sliceSamples(self, sliceStartTime, sliceEndTime):
+        '''
+        Samples of timeSlice without wrapping them into a neo.AnalogSignal
+        :param sliceStartTime: float, in s
+        :param sliceEndTime: float, in s
+        :return: sliceTStart, samples; time in s of the first sample and numpy.ndarray of the downsampled samples
+        '''
+
+        tStart, samplingPeriod, nSamples = self.timeBase()
+        startInd = max(0, int((sliceStartTime - tStart) / samplingPeriod))
+        endInd = min(nSamples - 1, int((sliceEndTime - tStart) / samplingPeriod))
+        endInd = max(startInd - 1, endInd)
+
+        rawStartInd = self.firstRawInd + startInd * self.downSampleFactor
+        rawEndInd = self.firstRawInd + endInd * self.downSampleFactor + 1
+        downSampled, window = self.readDecimated(rawStartInd, rawEndInd)
+
+        return self.channel.tStart + rawStartInd * self.channel.samplingPeriod, downSampled
+
+    def envelopeSlice(self, sliceStartTime, sliceEndTime, maxBins, chunkSize=2 ** 20):
+        '''
+        Min/max envelope of the signal at full resolution between two times, with at most maxBins bins. The window is
+        read from file in chunks of about chunkSize samples.
+        :param sliceStartTime: quantities.Quantity
+        :param sliceEndTime: quantities.Quantity
+        :param maxBins: int
+        :param chunkSize: int
+        :return: times, values, quantities.Quantity arrays, see minMaxPyramid.interleaveEnvelope
+        '''
+
+        rawStartInd = max(self.firstRawInd, self.channel.time2Index(quantity2Seconds(sliceStartTime)))
+        rawEndInd = min(self.firstRawInd + self.nSamples * self.downSampleFactor,
+                        self.channel.time2Index(quantity2Seconds(sliceEndTime)) + 1)
+        binSize = max(1, int(np.ceil(float(rawEndInd - rawStartInd) / maxBins)))
+        chunkSize = max(1, chunkSize // binSize) * binSize
+
+        mins = []
+        maxs = []
+        for chunkStartInd in range(rawStartInd, rawEndInd, chunkSize):
+            chunk = self.reader.readSamples(self.channelIndex, chunkStartInd, min(chunkStartInd + chunkSize, rawEndInd))
+            self.cleanRawWindow(chunk, chunkStartInd)
+            chunkMins, chunkMaxs = minMaxEnvelope(chunk, binSize)
+            mins.append(chunkMins)
+            maxs.append(chunkMaxs)
+
+        mins = np.concatenate(mins) if mins else np.zeros(0)
+        maxs = np.concatenate(maxs) if maxs else np.zeros(0)
+        binTimes = self.channel.tStart + (rawStartInd + np.arange(mins.shape[0]) * binSize) * self.channel.samplingPeriod
+        times, values = interleaveEnvelope(binTimes, mins, maxs)
+
+        return times * qu.s, values * self.units
+
+# **********************************************************************************************************************
+
+def streamToMemmaps(job):
+    '''
+    Worker of RawDataViewer.initParallel. Streams a channel into memory-mapped files, so that the processed samples
+    are shared with the parent process through the page cache instead of being pickled back.
+    :param job: tuple (LazyAnalogSignal, paths of the existing files for the samples, minima and maxima)
+    :return: float, duration in s
+    '''
+
+    lazySignal, (samplesPath, minsPath, maxsPath) = job
+    # the parent reports the stage; sinks inherited by a forked worker must not see it twice
+    del instrumentation.sinks[:]
+    stageStartTime = time.time()
+
+    outs = [np.memmap(path, dtype=np.float32, mode='r+', shape=(lazySignal.nSamples,))
+            for path in (samplesPath, minsPath, maxsPath)]
+    lazySignal.stream(outs[0], (outs[1], outs[2]))
+    for out in outs:
+        out.flush()
+
+    return time.time() - stageStartTime
+
+# **********************************************************************************************************************
+
+def openLazySignals(smrFile, calibStrings, maxFreq=None, ints2Exclude=None, forceUnits=False,
+                    decimationMode='stride'):
+    '''
+    LazyAnalogSignals of the membrane potential, vibration stimulus and current input channels of an SMR file over
+    the recording period common to the first two channels, as in parseSpike2Data. Only headers are read.
+    :param smrFile: str, path of the SMR file
+    :param calibStrings: dict with the keys 'voltageCalibStr', 'vibrationCalibStr' and 'currentCalibStr'
+    :param maxFreq: quantities.Quantity, signals are downsampled to at least this sampling rate. If None, they are not
+    downsampled.
+    :param ints2Exclude: str, intervals to exclude. None to exclude no interval
+    :param forceUnits: bool, whether to force the units mV, um and nA on the signals
+    :param decimationMode: str, see LazyAnalogSignal
+    :return: voltageSignal, vibrationSignal, currentSignal; LazyAnalogSignals, currentSignal being None if there is
+    no current channel or calibStrings['currentCalibStr'] is None
+    '''
+
+    reader = SMRReader(smrFile)
+    channels = reader.analogChannels[:3]
+
+    signalSamplingRates = [x.samplingRate for x in channels]
+    assert (np.abs(np.diff(signalSamplingRates)) < 1).all(), \
+        'Signals do not have same sampling rate\n{}'.format(signalSamplingRates)
+
+    recordingStartTime = max(channels[0].tStart, channels[1].tStart)
+    recordingEndTime = min(channels[0].tStop, channels[1].tStop)
+
+    if maxFreq is None:
+        downSampleFactors = [1] * len(channels)
+    else:
+        maxFreqHz = float(maxFreq.rescale(qu.Hz).magnitude)
+        downSampleFactors = [int(x.samplingRate / maxFreqHz) for x in channels]
+
+    if forceUnits:
+        voltForceUnits = qu.mV
+        vibForceUnits = qu.um
+        currForceUnits = qu.nA
+    else:
+        voltForceUnits = vibForceUnits = currForceUnits = None
+
+    voltageSignal = LazyAnalogSignal(reader, 0, 'MembranePotential', calibStrings['voltageCalibStr'], 'mV',
+                                     recordingStartTime, recordingEndTime, downSampleFactors[0],
+                                     voltForceUnits, ints2Exclude, decimationMode=decimationMode)
+    vibrationSignal = LazyAnalogSignal(reader, 1, 'VibrationStimulus', calibStrings['vibrationCalibStr'], 'um',
+                                       recordingStartTime, recordingEndTime, downSampleFactors[1],
+                                       vibForceUnits, ints2Exclude, decimationMode=decimationMode)
+
+    currentSignal = None
+    if len(channels) > 2 and calibStrings['currentCalibStr'] is not None:
+        currentSignal = LazyAnalogSignal(reader, 2, 'CurrentInput', calibStrings['currentCalibStr'], 'nA',
+                                         recordingStartTime, recordingEndTime, downSampleFactors[2],
+                                         currForceUnits, decimationMode=decimationMode)
+
+    return voltageSignal, vibrationSignal, currentSignal
+
+# **********************************************************************************************************************
+
+def detectSpikes(lazySignal, threshold=None, nSigmas=5., peakWindowDuration=2 * qu.ms,
+                 refractoryDuration=2 * qu.ms, thresholdWindowDuration=10 * qu.s, chunkSize=2 ** 20,
+                 progressCallback=None):
+    '''
+    Detect spikes over the whole recording period of a LazyAnalogSignal, normally one at full resolution (see
+    openLazySignals), with NEOFuncs.detectSpikeInds. The signal is read chunk by chunk and searched for spikes in
+    consecutive windows of thresholdWindowDuration; the last window takes the samples left over, so that it is between
+    one and two thresholdWindowDurations long. Spikes whose peak window straddles two windows are detected with the
+    second one. Windows do not depend on chunkSize and neither do the spikes detected.
+    :param lazySignal: LazyAnalogSignal
+    :param threshold: quantities.Quantity or None. If None, the threshold of each window is
+    NEOFuncs.robustThreshold of the window, which follows slow drifts of the baseline.
+    :param nSigmas: float, see NEOFuncs.robustThreshold. Not used if threshold is given.
+    :param peakWindowDuration: quantities.Quantity, spike peaks are searched for this long after threshold crossings
+    :param refractoryDuration: quantities.Quantity, minimum time between threshold crossings of separate spikes
+    :param thresholdWindowDuration: quantities.Quantity, length of the windows searched for spikes
+    :param chunkSize: int, approximate number of samples per chunk read
+    :param progressCallback: callable or None, called as progressCallback('detect spikes', None) after each chunk,
+    see reportChunk, and as progressCallback('detect spikes', duration in s) at the end
+    :return: neo.SpikeTrain with the times of the spike peaks
+    '''
+
+    stageStartTime = time.time()
+    samplingPeriod = quantity2Seconds(lazySignal.sampling_period)
+    peakWindow = max(1, int(quantity2Seconds(peakWindowDuration) / samplingPeriod))
+    refractory = int(quantity2Seconds(refractoryDuration) / samplingPeriod)
+    thresholdWindow = max(1, int(quantity2Seconds(thresholdWindowDuration) / samplingPeriod))
+    if threshold is not None:
+        fixedThreshold = float(threshold.rescale(lazySignal.units).magnitude)
+
+    def iterWindows():
+        # windows of thresholdWindow samples, the last one with the samples left over, made of chunks of any size
+        pending = np.zeros(0, dtype=np.float32)
+        for outStartInd, samples, rawSamples in lazySignal.iterChunks(chunkSize):
+            reportChunk(progressCallback, 'detect spikes')
+            pending = np.concatenate((pending, samples))
+            while pending.shape[0] >= 2 * thresholdWindow:
+                yield pending[:thresholdWindow]
+                pending = pending[thresholdWindow:]
+        if pending.shape[0]:
+            yield pending
+
+    peakInds = []
+    lastCrossingInd = -refractory
+    # samples at the end of the previous window whose crossings still need the following samples, preceded by one
+    # sample so that a crossing at the first of them can be seen
+    carried = np.zeros(0, dtype=np.float32)
+
+    def detectIn(samples, samplesStartInd, nCounted, windowThreshold):
+
+        crossingInds, samplesPeakInds = detectSpikeInds(samples, windowThreshold, peakWindow, refractory)
+        counted = (crossingInds < nCounted) & (crossingInds + samplesStartInd - lastCrossingInd >= refractory)
+        if counted.any():
+            peakInds.append(samplesPeakInds[counted] + samplesStartInd)
+        return crossingInds[counted][-1] + samplesStartInd if counted.any() else lastCrossingInd
+
+    windowStartInd = 0
+    windowThreshold = None
+    for window in iterWindows():
+        windowThreshold = robustThreshold(window, nSigmas) if threshold is None else fixedThreshold
+        samples = np.concatenate((carried, window))
+        samplesStartInd = windowStartInd - carried.shape[0]
+        nCounted = max(0, samples.shape[0] - peakWindow)
+        lastCrossingInd = detectIn(samples, samplesStartInd, nCounted, windowThreshold)
+        carried = samples[max(0, nCounted - 1):]
+        windowStartInd += window.shape[0]
+
+    if carried.shape[0]:
+        detectIn(carried, lazySignal.nSamples - carried.shape[0], carried.shape[0], windowThreshold)
+
+    peakInds = np.concatenate(peakInds) if peakInds else np.zeros(0, dtype=np.int64)
+    spikeTrain = SpikeTrain(times=quantity2Seconds(lazySignal.t_start) + peakInds * samplingPeriod,
+                            units=qu.s,
+                            t_start=lazySignal.t_start,
+                            t_stop=lazySignal.t_stop)
+
+    reportStage(progressCallback, 'detect spikes', stageStartTime, spikeTrain.nbytes, lazySignal.nSamples)
+    return spikeTrain
+
+# **********************************************************************************************************************
+
+
+def inMemoryNBytes(array):
+    '''
+    Bytes of a numpy array, e.g., a neo.AnalogSignal, held in memory. Arrays viewing a numpy.memmap, e.g., the
+    outputs of streamToMemmaps, count as 0, since the OS can drop their pages and read them from file again.
+    :param array: numpy.ndarray
+    :return: int
+    '''
+
+    base = array
+    while base is not None:
+        if isinstance(base, np.memmap):
+            return 0
+        base = getattr(base, 'base', None)
+
+    return array.nbytes
+
+# **********************************************************************************************************************
+
+# signal attributes of RawDataViewer, in the order of the channels in SMR files
+viewerSignalAttrs = ['voltageSignal', 'vibrationSignal', 'currentSignal']
+
+# names of the signals of RawDataViewer, by attribute
+viewerSignalNames = {'voltageSignal': 'MembranePotential',
+                     'vibrationSignal': 'VibrationStimulus',
+                     'currentSignal': 'CurrentInput'}
+
+# colors and legend labels of the signals of RawDataViewer in plotVibEpoch, by attribute
+epochTraceStyles = {'voltageSignal': ('b', 'Membrane potential (mV)'),
+                    'vibrationSignal': ('r', 'Vibration Input to Antenna (um)'),
+                    'currentSignal': ('g', 'Current input through electrode (nA)')}
+
 class RawDataViewer(object):
 
-    def __init__(self, smrFile, voltageCalibStr, maxFreq=700*qu.Hz, ints2Exclude=None, forceUnits=False):
+    def __init__(self, smrFile, voltageCalibStr, maxFreq=700*qu.Hz, ints2Exclude=None, forceUnits=False,
+                 lazy=False, signalCache=None, progressCallback=None, streaming=False, parallel=False,
+                 decimationMode='stride'):
+        '''
+        :param smrFile: str, path of the SMR file
+        :param voltageCalibStr: str, calibration string of the membrane potential channel
+        :param maxFreq: quantities.Quantity, signals are downsampled to at least this sampling rate
+        :param ints2Exclude: str, intervals to exclude. None to exclude no interval
+        :param forceUnits: bool, whether to force the units mV, um and nA on the signals
+        :param lazy: bool, if True, only the headers of smrFile are read at initialization and the signals are read
+        window by window as they are plotted. Memory use and load time then depend on the size of the windows
+        plotted and not on the length of the file.
+        :param signalCache: signalCache.SignalCache. If given, processed signals are loaded from it when smrFile has
+        been processed before with the same parameters, skipping the parsing of smrFile, and stored in it otherwise.
+        Not used if lazy is True.
+        :param progressCallback: callable or None. Called as progressCallback(stage, duration in s) at the end of each
+        loading stage and, in the chunked stages of streaming loads, as progressCallback(stage, None) after each
+        chunk. Loading can be aborted by raising LoadCancelled from it. Eager loads read each channel whole and can
+        only be aborted between stages.
+        :param streaming: bool, if True, each channel is read in chunks that are cleaned, calibrated and downsampled
+        in a single pass, so that peak memory is about one chunk plus the downsampled signals instead of several
+        copies of the channel at full resolution. Not used if lazy is True.
+        :param parallel: bool, if True, channels are streamed as with streaming=True, but concurrently on a pool of
+        processes, one per channel. The outputs are memory-mapped temporary files shared with the worker processes.
+        Not used if lazy is True.
+        :param decimationMode: str, how signals are downsampled, one of NEOFuncs.decimationModes. 'fir' removes the
+        frequencies above maxFreq / 2 before downsampling instead of letting them alias. 'minmax' is only supported
+        when neither lazy, streaming nor parallel is True, which provide min/max envelopes anyway.
+        '''
+
+        initStartTime = time.time()
 
         calibStrings = {}
         calibStrings['voltageCalibStr'] = voltageCalibStr
         calibStrings['vibrationCalibStr'] = '27.1'
         calibStrings['currentCalibStr'] = '10'
+        validateProcessingStrings(calibStrings, ints2Exclude)
+
+        # MinMaxPyramid of signals, by attribute name. Lazily loaded signals compute their envelopes on the fly.
+        self.pyramids = {}
+        # matplotlib.lines.Line2D of each signal, by attribute name, reused by updateVibEpoch
+        self.epochLines = {}
+        # (signal, (tStart, samplingPeriod, nSamples, units)) by attribute name, see timeBase
+        self.timeBases = {}
+        self.decimationMode = decimationMode
+        # spikes detected by detectSpikes, overlaid by plotVibEpoch
+        self.spikeTrain = None
+
+        # kept for detectSpikes, which reads the membrane potential again at full resolution
+        self.smrFile = smrFile
+        self.calibStrings = calibStrings
+        self.ints2Exclude = ints2Exclude
+        self.forceUnits = forceUnits
+        self.signalCache = signalCache
+        self.cacheKey = None
+
+        if parallel:
+            initProcessed = self.initParallel
+        elif streaming:
+            initProcessed = self.initStreaming
+        else:
+            initProcessed = self.initEager
+
+        if lazy:
+            stageStartTime = time.time()
+            self.initLazy(smrFile, calibStrings, maxFreq, ints2Exclude, forceUnits)
+            reportStage(progressCallback, 'read headers', stageStartTime)
+        elif signalCache is None:
+            initProcessed(smrFile, calibStrings, maxFreq, ints2Exclude, forceUnits, progressCallback)
+        else:
+            stageStartTime = time.time()
+            cacheKey = signalCache.key(smrFile, calibStrings=calibStrings, ints2Exclude=ints2Exclude,
+                                       maxFreq=float(maxFreq.rescale(qu.Hz).magnitude), forceUnits=forceUnits,
+                                       decimationMode=decimationMode)
+            cachedSignals = signalCache.load(cacheKey)
+            self.cacheKey = cacheKey
+            reportStage(progressCallback, 'cache lookup', stageStartTime)
+            if cachedSignals is None:
+                initProcessed(smrFile, calibStrings, maxFreq, ints2Exclude, forceUnits, progressCallback)
+                stageStartTime = time.time()
+                signalCache.store(cacheKey, self.processedSignals())
+                reportStage(progressCallback, 'cache store', stageStartTime)
+            else:
+                self.initFromCache(cachedSignals)
+
+        # the whole load, only for instrumentation since progressCallback gets the stages
+        if instrumentation.sinks:
+            instrumentation.recordStage('load', time.time() - initStartTime, self.nbytes)
+
+    def initEager(self, smrFile, calibStrings, maxFreq, ints2Exclude, forceUnits, progressCallback=None):
 
-        signals = parseSpike2Data(smrFile, calibStrings, [-np.inf, np.inf], ints2Exclude, forceUnits)
+        signals = parseSpike2Data(smrFile, calibStrings, [-np.inf, np.inf], ints2Exclude, forceUnits,
+                                  progressCallback)
 
         signalSamplingRates = [x.sampling_rate for x in signals if x is not None]
         assert (np.diff(signalSamplingRates) < 1 * qu.Hz).all(), \
             'Signals do not have same sampling rate\n{}'.format(reduce(lambda x, y: x + '\n' + y, map(repr, signals)))
 
-        self.voltageSignal = downSampleAnalogSignal(signals[0], int(signals[0].sampling_rate / maxFreq))
-        self.vibrationSignal = downSampleAnalogSignal(signals[1], int(signals[1].sampling_rate / maxFreq))
+        for signalAttr, signal in zip(viewerSignalAttrs, signals):
 
+            if signal is None:
+                setattr(self, signalAttr, None)
+                continue
 
-        if signals[2] is not None:
-            self.currentSignal = downSampleAnalogSignal(signals[2], int(signals[2].sampling_rate / maxFreq))
-        else:
-            self.currentSignal = None
+            signalName = viewerSignalNames[signalAttr]
+            downSampleFactor = int(signal.sampling_rate / maxFreq)
+
+            stageStartTime = time.time()
+            downSampledSignal = downSampleAnalogSignal(signal, downSampleFactor, self.decimationMode)
+            if self.decimationMode == 'stride' and downSampleFactor > 1:
+                # a strided view would keep the signal at full resolution in memory
+                downSampledSignal = downSampledSignal.copy()
+            downSampledSignal.name = signalName
+            setattr(self, signalAttr, downSampledSignal)
+            reportStage(progressCallback, '{}: downsample'.format(signalName), stageStartTime,
+                        downSampledSignal.nbytes, signal.shape[0])
+
+            # envelopes are built from the signals at full resolution so that decimation does not hide spikes
+            stageStartTime = time.time()
+            self.pyramids[signalAttr] = MinMaxPyramid(signal, downSampleFactor)
+            reportStage(progressCallback, '{}: envelope'.format(signalName), stageStartTime,
+                        self.pyramids[signalAttr].nbytes, signal.shape[0])
+
+    def initStreaming(self, smrFile, calibStrings, maxFreq, ints2Exclude, forceUnits, progressCallback=None):
+
+        self.initLazy(smrFile, calibStrings, maxFreq, ints2Exclude, forceUnits)
+
+        for signalAttr in viewerSignalAttrs:
+            lazySignal = getattr(self, signalAttr)
+            if lazySignal is None:
+                continue
+
+            samples = np.empty(lazySignal.nSamples, dtype=np.float32)
+            envelope = (np.empty_like(samples), np.empty_like(samples))
+            lazySignal.stream(samples, envelope,
+                              progressCallback=prefixStages(progressCallback, viewerSignalNames[signalAttr]))
 
-    def plotVibEpoch(self, ax, epochTimes, signal=None, points=False):
+            setattr(self, signalAttr, lazySignal.wrap(samples))
+            self.pyramids[signalAttr] = MinMaxPyramid.fromBaseLevel(envelope[0], envelope[1],
+                                                                    lazySignal.downSampleFactor,
+                                                                    quantity2Seconds(lazySignal.t_start),
+                                                                    lazySignal.channel.samplingPeriod,
+                                                                    lazySignal.units)
+
+    def initParallel(self, smrFile, calibStrings, maxFreq, ints2Exclude, forceUnits, progressCallback=None):
+
+        self.initLazy(smrFile, calibStrings, maxFreq, ints2Exclude, forceUnits)
+        lazySignals = [(x, getattr(self, x)) for x in viewerSignalAttrs if getattr(self, x) is not None]
+
+        memmapDir = tempfile.mkdtemp(prefix='GJEMSRDViewer')
+        jobs = []
+        try:
+            for signalAttr, lazySignal in lazySignals:
+                if not lazySignal.nSamples:
+                    # empty files cannot be mapped, and there is nothing to stream
+                    jobs.append((lazySignal, None))
+                    continue
+                paths = [os.path.join(memmapDir, '{}_{}.f32'.format(signalAttr, x))
+                         for x in ('samples', 'mins', 'maxs')]
+                jobs.append((lazySignal, paths))
+                for path in paths:
+                    np.memmap(path, dtype=np.float32, mode='w+', shape=(lazySignal.nSamples,)).flush()
+
+            streamJobs = [x for x in jobs if x[1] is not None]
+            if streamJobs:
+                pool = multiprocessing.Pool(min(len(streamJobs), multiprocessing.cpu_count()))
+                try:
+                    for (lazySignal, paths), duration in zip(streamJobs, pool.imap(streamToMemmaps, streamJobs)):
+                        reportDuration(progressCallback, '{}: stream'.format(lazySignal.name), duration,
+                                       3 * lazySignal.nSamples * np.dtype(np.float32).itemsize,
+                                       lazySignal.nSamples * lazySignal.downSampleFactor)
+                    pool.close()
+                finally:
+                    pool.terminate()
+                    pool.join()
+
+            for (signalAttr, lazySignal), (job, paths) in zip(lazySignals, jobs):
+                if paths is None:
+                    samples, mins, maxs = [np.empty(0, dtype=np.float32) for x in range(3)]
+                else:
+                    samples, mins, maxs = [np.memmap(path, dtype=np.float32, mode='r', shape=(lazySignal.nSamples,))
+                                           for path in paths]
+                setattr(self, signalAttr, lazySignal.wrap(samples))
+                self.pyramids[signalAttr] = MinMaxPyramid.fromBaseLevel(mins, maxs, lazySignal.downSampleFactor,
+                                                                        quantity2Seconds(lazySignal.t_start),
+                                                                        lazySignal.channel.samplingPeriod,
+                                                                        lazySignal.units)
+        finally:
+            # also when loading was cancelled or a worker failed. The mappings stay valid after the files are unlinked
+            # where the OS allows it; elsewhere they are left in the temporary directory
+            for job, paths in jobs:
+                for path in paths or []:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            try:
+                os.rmdir(memmapDir)
+            except OSError:
+                pass
+
+    def initFromCache(self, cachedSignals):
+
+        for signalAttr, signalName in viewerSignalNames.items():
+            setattr(self, signalAttr, cachedSignals.get(signalName))
+            pyramid = MinMaxPyramid.fromAnalogSignals(cachedSignals, signalName)
+            if pyramid is not None:
+                self.pyramids[signalAttr] = pyramid
+
+    def processedSignals(self):
+        '''
+        The downsampled signals of this viewer and the levels of their envelope pyramids
+        :return: list of neo.AnalogSignal
+        '''
+
+        analogSignals = []
+        for signalAttr, signalName in viewerSignalNames.items():
+            if getattr(self, signalAttr) is not None:
+                analogSignals.append(getattr(self, signalAttr))
+            if signalAttr in self.pyramids:
+                analogSignals.extend(self.pyramids[signalAttr].toAnalogSignals(signalName))
+
+        return analogSignals
+
+    @property
+    def nbytes(self):
+        '''
+        Memory held by the signals of this viewer, their envelope pyramids and the detected spikes, in bytes. Signals
+        loaded lazily hold no samples and arrays mapped from files, e.g., those of viewers loaded with parallel=True,
+        are not counted either (see inMemoryNBytes), although the OS keeps the pages read of both in its file cache.
+        '''
+
+        nBytes = sum(inMemoryNBytes(mins) + inMemoryNBytes(maxs)
+                     for pyramid in self.pyramids.values() for mins, maxs in pyramid.levels)
+        for signalAttr in viewerSignalAttrs:
+            signal = getattr(self, signalAttr)
+            if signal is not None and not isinstance(signal, LazyAnalogSignal):
+                nBytes += inMemoryNBytes(signal)
+        if self.spikeTrain is not None:
+            nBytes += self.spikeTrain.nbytes
+
+        return nBytes
+
+    def initLazy(self, smrFile, calibStrings, maxFreq, ints2Exclude, forceUnits):
+
+        self.voltageSignal, self.vibrationSignal, self.currentSignal = \
+            openLazySignals(smrFile, calibStrings, maxFreq, ints2Exclude, forceUnits, self.decimationMode)
+
+    def detectSpikes(self, threshold=None, nSigmas=5., progressCallback=None):
+        '''
+        Detect spikes in the membrane potential at full resolution, i.e., before downsampling, with
+        rawDataImport.detectSpikes and keep them to be overlaid by plotVibEpoch. If this viewer was loaded through a
+        signal cache, the spike train is stored with the processed signals, so that spikes are detected only once per
+        calibration and detection parameters.
+        :param threshold: quantities.Quantity or None, see rawDataImport.detectSpikes
+        :param nSigmas: float, see rawDataImport.detectSpikes
+        :param progressCallback: callable or None, see RawDataViewer.__init__
+        :return: neo.SpikeTrain
+        '''
+
+        if threshold is None:
+            spikeTrainName = 'MembranePotential_spikes_{}sigmas'.format(nSigmas)
+        else:
+            spikeTrainName = 'MembranePotential_spikes_{}{}'.format(float(threshold.magnitude),
+                                                                    threshold.dimensionality.string)
+
+        spikeTrain = None
+        if self.cacheKey is not None:
+            stageStartTime = time.time()
+            spikeTrain = self.signalCache.loadSpikeTrain(self.cacheKey, spikeTrainName, self.voltageSignal.t_start,
+                                                         self.voltageSignal.t_stop)
+            reportStage(progressCallback, 'spikes cache lookup', stageStartTime)
+
+        if spikeTrain is None:
+            voltageSignal = openLazySignals(self.smrFile, self.calibStrings, None, self.ints2Exclude,
+                                            self.forceUnits)[0]
+            spikeTrain = detectSpikes(voltageSignal, threshold, nSigmas,
+                                      progressCallback=prefixStages(progressCallback, 'MembranePotential'))
+            spikeTrain.name = spikeTrainName
+            if self.cacheKey is not None:
+                stageStartTime = time.time()
+                self.signalCache.storeSpikeTrain(self.cacheKey, spikeTrain, 'MembranePotential')
+                reportStage(progressCallback, 'spikes cache store', stageStartTime)
+
+        self.spikeTrain = spikeTrain
+        return spikeTrain
+
+    def timeBase(self, signalName):
+        '''
+        Time base of one of the signals of this viewer as plain numbers, converted from quantities only the first
+        time it is asked for, so that paging through epochs does index arithmetic on floats
+        :param signalName: str, one of 'voltageSignal', 'vibrationSignal' and 'currentSignal'
+        :return: tStart, samplingPeriod, nSamples, units; floats in s, int and quantities.Quantity
+        '''
+
+        signal = getattr(self, signalName)
+        cached = self.timeBases.get(signalName)
+        if cached is None or cached[0] is not signal:
+            if isinstance(signal, LazyAnalogSignal):
+                timeBase = signal.timeBase() + (signal.units,)
+            else:
+                timeBase = signalTimeBase(signal) + (signal.units,)
+            cached = (signal, timeBase)
+            self.timeBases[signalName] = cached
+
+        return cached[1]
+
+    def epochTrace(self, signalName, epochStart, epochEnd, maxBins=None):
+        '''
+        Times and values to plot for one of the signals of this viewer between two times. If the window contains more
+        than 2 * maxBins samples, the min/max envelope of the signal with at most maxBins bins is returned instead of
+        the samples, so that drawing takes the same time for any window while keeping peaks visible.
+        :param signalName: str, one of 'voltageSignal', 'vibrationSignal' and 'currentSignal'
+        :param epochStart: quantities.Quantity or float in s
+        :param epochEnd: quantities.Quantity or float in s
+        :param maxBins: int or None. If None, the samples are always returned
+        :return: times, values, quantities.Quantity arrays
+        '''
+
+        signal = getattr(self, signalName)
+        tStart, samplingPeriod, nSamples, units = self.timeBase(signalName)
+        epochStart = quantity2Seconds(epochStart)
+        epochEnd = quantity2Seconds(epochEnd)
+
+        if maxBins is not None and (epochEnd - epochStart) / samplingPeriod > 2 * maxBins:
+            if signalName in self.pyramids:
+                return self.pyramids[signalName].envelope(epochStart, epochEnd, maxBins)
+            elif isinstance(signal, LazyAnalogSignal):
+                return signal.envelopeSlice(epochStart, epochEnd, maxBins)
+
+        if isinstance(signal, LazyAnalogSignal):
+            sliceTStart, samples = signal.sliceSamples(epochStart, epochEnd)
+        else:
+            startInd, endInd = sliceIndices(tStart, samplingPeriod, nSamples, epochStart, epochEnd)
+            sliceTStart = tStart + startInd * samplingPeriod
+            samples = signal.magnitude[startInd: endInd]
+        samples = samples.reshape((samples.shape[0],))
+        times = sliceTStart + np.arange(samples.shape[0]) * samplingPeriod
+
+        return times * qu.s, samples * units
+
+    def getEpochTraces(self, epochTimes, maxBins=None):
+        '''
+        Times and values to plot for each signal of this viewer that overlaps with an epoch. Does not touch any
+        matplotlib object, so that it can be run in a background thread.
+        :param epochTimes: list of two quantities.Quantity, start and end of the epoch
+        :param maxBins: int or None, see epochTrace
+        :return: list of (signal attribute, times, values), followed by ('spikeTrain', spike times, marker levels) if
+        spikes have been detected with detectSpikes
+        '''
+
+        epochStart = quantity2Seconds(epochTimes[0])
+        epochEnd = quantity2Seconds(epochTimes[1])
+
+        epochTraces = []
+        for signalAttr in viewerSignalAttrs:
+            if getattr(self, signalAttr) is None:
+                continue
+            tStart, samplingPeriod, nSamples, units = self.timeBase(signalAttr)
+            tStop = tStart + nSamples * samplingPeriod
+            if not (tStart >= epochEnd or tStop <= epochStart):
+                modifiedEpochStart = max(tStart, epochStart)
+                modifiedEpochEnd = min(tStop, epochEnd)
+                traceTimes, traceValues = self.epochTrace(signalAttr, modifiedEpochStart, modifiedEpochEnd, maxBins)
+                epochTraces.append((signalAttr, traceTimes, traceValues))
+
+        voltageTraces = [x for x in epochTraces if x[0] == 'voltageSignal' and x[2].shape[0]]
+        if self.spikeTrain is not None and voltageTraces:
+            # a row of markers at the level of the highest point of the membrane potential
+            voltageValues = voltageTraces[0][2]
+            spikeTimes = getSpikesIn(self.spikeTrain.times, epochTimes[0], epochTimes[1])
+            epochTraces.append(('spikeTrain', spikeTimes,
+                                np.full(spikeTimes.shape[0], float(voltageValues.max().magnitude)) * voltageValues.units))
+
+        return epochTraces
+
+    def plotVibEpoch(self, ax, epochTimes, signal=None, points=False, epochTraces=None):
+        '''
+        Plot the signals of this viewer in an epoch
+        :param ax: matplotlib.axes.Axes
+        :param epochTimes: list of two quantities.Quantity, start and end of the epoch
+        :param signal: neo.AnalogSignal, an external signal to plot as well
+        :param points: bool, whether to mark the samples
+        :param epochTraces: output of getEpochTraces for epochTimes, if already available, e.g., from an
+        EpochPrefetcher
+        '''
 
         marker = '*' if points else 'None'
 
-        ylims = [-50, 20]
-        if not (self.voltageSignal.t_start >= epochTimes[1] or self.voltageSignal.t_stop <= epochTimes[0]):
-            modifiedEpochStart = max(self.voltageSignal.t_start, epochTimes[0])
-            modifiedEpochEnd = min(self.voltageSignal.t_stop, epochTimes[1])
-
-            epochVoltSignal = sliceAnalogSignal(self.voltageSignal, modifiedEpochStart, modifiedEpochEnd)
-            ax.plot(epochVoltSignal.times, epochVoltSignal, ls='-', color='b', marker=marker,
-                    label='Membrane potential (mV)')
-            ylims[0] = min(ylims[0], epochVoltSignal.min().magnitude)
-            ylims[1] = max(ylims[1], epochVoltSignal.max().magnitude)
-
-        if not (self.vibrationSignal.t_start >= epochTimes[1] or self.vibrationSignal.t_stop <= epochTimes[0]):
-            modifiedEpochStart = max(self.vibrationSignal.t_start, epochTimes[0])
-            modifiedEpochEnd = min(self.vibrationSignal.t_stop, epochTimes[1])
-            epochVibSignal = sliceAnalogSignal(self.vibrationSignal, modifiedEpochStart, modifiedEpochEnd)
-            ax.plot(epochVibSignal.times, epochVibSignal, ls='-', color='r', marker=marker,
-                    label='Vibration Input to Antenna (um)')
-            ylims[0] = min(ylims[0], epochVibSignal.min().magnitude)
-            ylims[1] = max(ylims[1], epochVibSignal.max().magnitude)
-
-        if self.currentSignal is not None:
-            if not (self.currentSignal.t_start >= epochTimes[1] or self.currentSignal.t_stop <= epochTimes[0]):
-                modifiedEpochStart = max(self.currentSignal.t_start, epochTimes[0])
-                modifiedEpochEnd = min(self.currentSignal.t_stop, epochTimes[1])
-                epochCurSignal = sliceAnalogSignal(self.currentSignal, modifiedEpochStart, modifiedEpochEnd)
-                ax.plot(epochCurSignal.times, epochCurSignal, ls='-', color='g', marker=marker,
-                        label='Current input through electrode (nA)')
-                ylims[0] = min(ylims[0], epochCurSignal.min().magnitude)
-                ylims[1] = max(ylims[1], epochCurSignal.max().magnitude)
+        if epochTraces is None:
+            # about 2 points per pixel of the plot; individual samples are needed when they are marked
+            maxBins = None if points else plotMaxBins(ax)
+            epochTraces = self.getEpochTraces(epochTimes, maxBins)
+
+        ylims = epochYLims(epochTraces)
+        for signalAttr, traceTimes, traceValues in epochTraces:
+            if signalAttr == 'spikeTrain':
+                ax.plot(traceTimes, traceValues, ls='None', color='k', marker='v', label='Detected spikes')
+                continue
+            color, label = epochTraceStyles[signalAttr]
+            ax.plot(traceTimes, traceValues, ls='-', color=color, marker=marker, label=label)
 
         if signal is not None:
 
@@ -306,9 +1556,55 @@ class RawDataViewer(object):
                     label='External Signal')
 
         ax.legend(ncol=2, loc='best')
-        ax.set_xlabel('Time ({})'.format(self.voltageSignal.times.units.dimensionality.string))
+        ax.set_xlabel('Time ({})'.format(self.voltageSignal.t_start.units.dimensionality.string))
         ax.set_ylim(*ylims)
 
+    def updateVibEpoch(self, ax, epochTimes, epochTraces=None):
+        '''
+        Incremental version of plotVibEpoch for paging through a recording. The first call, and any call after ax has
+        been cleared, plots with plotVibEpoch. Later calls only update the data of the line of each signal and the
+        axes limits, leaving the axes, y ticks and legend in place. The x axis, whose ticks change with every epoch,
+        is returned with the lines so that it can be redrawn with them. The y limits are kept while they fit the
+        epoch: they grow when values of the epoch are beyond them and are fitted to the epoch again when its values
+        span less than half of them, e.g., after an epoch with a large artifact.
+        :param ax: matplotlib.axes.Axes
+        :param epochTimes: list of two quantities.Quantity, start and end of the epoch
+        :param epochTraces: output of getEpochTraces for epochTimes, if already available
+        :return: artists, yLimitsChanged; artists is the list of the matplotlib.lines.Line2D of the signals followed by
+        the x axis of ax and yLimitsChanged is a bool indicating whether the y limits were changed, i.e., whether the
+        background has to be redrawn.
+        '''
+
+        if epochTraces is None:
+            epochTraces = self.getEpochTraces(epochTimes, plotMaxBins(ax))
+
+        if any(self.epochLines.get(signalAttr) not in ax.lines for signalAttr, traceTimes, traceValues in epochTraces):
+            ax.clear()
+            self.plotVibEpoch(ax, epochTimes, epochTraces=epochTraces)
+            self.epochLines = dict((signalAttr, line) for (signalAttr, traceTimes, traceValues), line
+                                   in zip(epochTraces, ax.lines))
+            return list(self.epochLines.values()) + [ax.xaxis], True
+
+        oldYLims = ax.get_ylim()
+
+        for signalAttr, line in self.epochLines.items():
+            line.set_data([], [])
+        for signalAttr, traceTimes, traceValues in epochTraces:
+            self.epochLines[signalAttr].set_data(traceTimes.magnitude, traceValues.magnitude)
+
+        ax.relim()
+        ax.autoscale_view(scaley=False)
+
+        ylims = epochYLims(epochTraces)
+        if ylims[0] < oldYLims[0] or ylims[1] > oldYLims[1]:
+            # with a margin, so that the limits do not grow again for every slightly larger value
+            margin = 0.05 * (max(ylims[1], oldYLims[1]) - min(ylims[0], oldYLims[0]))
+            ax.set_ylim(min(ylims[0] - margin, oldYLims[0]), max(ylims[1] + margin, oldYLims[1]))
+        elif ylims[1] - ylims[0] < 0.5 * (oldYLims[1] - oldYLims[0]):
+            ax.set_ylim(*ylims)
+
+        return list(self.epochLines.values()) + [ax.xaxis], ax.get_ylim() != oldYLims
+
     # ******************************************************************************************************************
 # **********************************************************************************************************************
 
@@ -0,0 +1,192 @@
+import os
+import json
+import hashlib
+import nixio as nix
+from neoNIXIO import addAnalogSignal2Block, dataArray2AnalogSignal, addMultiTag, multiTag2SpikeTrain
+
+# bump when the processing pipeline changes in a way that invalidates existing cache entries
+cacheVersion = 1
+
+defaultCacheDir = os.path.join(os.path.expanduser('~'), '.GJEMSRDViewer', 'signalCache')
+
+#***********************************************************************************************************************
+
+
+class SignalCache(object):
+    '''
+    Directory of NIX files holding processed (interval-excluded, calibrated and downsampled) signals of SMR files,
+    keyed by the content of the SMR file and the processing parameters. The total size of the entries is kept below
+    maxBytes by removing the least recently used entries.
+    '''
+
+    def __init__(self, cacheDir=defaultCacheDir, maxBytes=2 * 1024 ** 3):
+        '''
+        :param cacheDir: str, directory for the cache entries, created if necessary
+        :param maxBytes: int, bound on the total size of the cache entries
+        '''
+
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+        # content hashes of SMR files by path, reused as long as their size and modification time do not change
+        self.hashIndexFile = os.path.join(cacheDir, 'contentHashes.json')
+
+    def contentHash(self, smrFile, blockSize=2 ** 20):
+        '''
+        SHA1 of the content of smrFile.
+        :param smrFile: str, path of the file
+        :param blockSize: int, number of bytes hashed at a time
+        :return: str, hex digest
+        '''
+
+        smrFile = os.path.abspath(smrFile)
+        stat = os.stat(smrFile)
+        hashIndex = {}
+        if os.path.isfile(self.hashIndexFile):
+            with open(self.hashIndexFile) as fle:
+                hashIndex = json.load(fle)
+
+        if smrFile in hashIndex and hashIndex[smrFile][:2] == [stat.st_size, stat.st_mtime]:
+            return hashIndex[smrFile][2]
+
+        sha1 = hashlib.sha1()
+        with open(smrFile, 'rb') as fle:
+            block = fle.read(blockSize)
+            while block:
+                sha1.update(block)
+                block = fle.read(blockSize)
+
+        hashIndex[smrFile] = [stat.st_size, stat.st_mtime, sha1.hexdigest()]
+        with open(self.hashIndexFile, 'w') as fle:
+            json.dump(hashIndex, fle)
+
+        return sha1.hexdigest()
+
+    def key(self, smrFile, **processingPars):
+        '''
+        Cache key of the signals of smrFile processed with processingPars
+        :param smrFile: str, path of the SMR file
+        :param processingPars: JSON serializable values, e.g., calibration strings, intervals to exclude and maxFreq
+        :return: str
+        '''
+
+        keyItems = [cacheVersion, self.contentHash(smrFile), sorted(processingPars.items())]
+        return hashlib.sha1(json.dumps(keyItems, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def entryPath(self, key):
+
+        return os.path.join(self.cacheDir, '{}.h5'.format(key))
+
+    def load(self, key):
+        '''
+        Load the signals of a cache entry and mark the entry as used
+        :param key: str, see SignalCache.key
+        :return: dict of neo.AnalogSignal by name, or None if there is no such entry
+        '''
+
+        entryPath = self.entryPath(key)
+        if not os.path.isfile(entryPath):
+            return None
+
+        nixFile = nix.File.open(entryPath, nix.FileMode.ReadOnly)
+        try:
+            analogSignals = dict((dataArray.name, dataArray2AnalogSignal(dataArray))
+                                 for dataArray in nixFile.blocks['signals'].data_arrays
+                                 if dataArray.type == 'nix.regular_sampled')
+        finally:
+            nixFile.close()
+
+        os.utime(entryPath, None)
+        return analogSignals
+
+    def store(self, key, analogSignals):
+        '''
+        Write signals to a new cache entry and evict entries if the cache has grown beyond maxBytes
+        :param key: str, see SignalCache.key
+        :param analogSignals: iterable of neo.AnalogSignal, each with a unique name
+        '''
+
+        entryPath = self.entryPath(key)
+        tempPath = entryPath + '.part'
+
+        nixFile = nix.File.open(tempPath, nix.FileMode.Overwrite)
+        try:
+            blk = nixFile.create_block('signals', 'processedSignals')
+            for analogSignal in analogSignals:
+                addAnalogSignal2Block(blk, analogSignal)
+        finally:
+            nixFile.close()
+
+        if os.path.isfile(entryPath):
+            os.remove(entryPath)
+        os.rename(tempPath, entryPath)
+
+        self.evict(keep=entryPath)
+
+    def loadSpikeTrain(self, key, name, tStart, tStop):
+        '''
+        Load a spike train stored with SignalCache.storeSpikeTrain
+        :param key: str, see SignalCache.key
+        :param name: str, name of the spike train
+        :param tStart: quantities.Quantity, start of the spike train
+        :param tStop: quantities.Quantity, stop of the spike train
+        :return: neo.SpikeTrain, or None if there is no such entry or spike train
+        '''
+
+        entryPath = self.entryPath(key)
+        if not os.path.isfile(entryPath):
+            return None
+
+        nixFile = nix.File.open(entryPath, nix.FileMode.ReadOnly)
+        try:
+            try:
+                multiTag = nixFile.blocks['signals'].multi_tags[name]
+            except KeyError:
+                return None
+            spikeTrain = multiTag2SpikeTrain(multiTag, tStart, tStop)
+            spikeTrain.name = name
+        finally:
+            nixFile.close()
+
+        os.utime(entryPath, None)
+        return spikeTrain
+
+    def storeSpikeTrain(self, key, spikeTrain, refName):
+        '''
+        Add a spike train, as a multi_tag on one of its signals, to an existing cache entry
+        :param key: str, see SignalCache.key
+        :param spikeTrain: neo.SpikeTrain, with a name unique in the entry
+        :param refName: str, name of the signal of the entry the spike train was detected in
+        '''
+
+        entryPath = self.entryPath(key)
+        if not os.path.isfile(entryPath):
+            return
+
+        nixFile = nix.File.open(entryPath, nix.FileMode.ReadWrite)
+        try:
+            blk = nixFile.blocks['signals']
+            addMultiTag(spikeTrain.name, 'spikeTrain', spikeTrain.times, blk, [blk.data_arrays[refName]])
+        finally:
+            nixFile.close()
+
+    def evict(self, keep=None):
+        '''
+        Remove least recently used entries until the total size of entries is at most maxBytes
+        :param keep: str, path of an entry that must not be removed
+        '''
+
+        entries = [os.path.join(self.cacheDir, x) for x in os.listdir(self.cacheDir) if x.endswith('.h5')]
+        entries.sort(key=os.path.getmtime)
+        totalSize = sum(os.path.getsize(x) for x in entries)
+
+        for entry in entries:
+            if totalSize <= self.maxBytes:
+                break
+            if entry != keep:
+                totalSize -= os.path.getsize(entry)
+                os.remove(entry)
+
+#***********************************************************************************************************************
@@ -0,0 +1,404 @@
+import os
+import uuid
+import zipfile
+import hashlib
+import numpy as np
+import quantities as qu
+from neo import AnalogSignal
+
+# Layouts of the on-disk structures of CED Son (Spike2 .smr) files. They follow those used by neo.io.Spike2IO so that
+# both readers agree on sampling rates, start times and scaling.
+
+fileHeaderDtype = np.dtype([
+    ('system_id', '<i2'),
+    ('copyright', 'S10'),
+    ('creator', 'S8'),
+    ('us_per_time', '<i2'),
+    ('time_per_adc', '<i2'),
+    ('filestate', '<i2'),
+    ('first_data', '<i4'),
+    ('channels', '<i2'),
+    ('chan_size', '<i2'),
+    ('extra_data', '<i2'),
+    ('buffersize', '<i2'),
+    ('os_format', '<i2'),
+    ('max_ftime', '<i4'),
+    ('dtime_base', '<f8'),
+    ('datetime_detail', 'u1'),
+    ('datetime_year', '<i2'),
+])
+
+channelHeaderDtype = np.dtype([
+    ('del_size', '<i2'),
+    ('next_del_block', '<i4'),
+    ('firstblock', '<i4'),
+    ('lastblock', '<i4'),
+    ('blocks', '<i2'),
+    ('n_extra', '<i2'),
+    ('pre_trig', '<i2'),
+    ('free0', '<i2'),
+    ('py_sz', '<i2'),
+    ('max_data', '<i2'),
+    ('comment', 'S72'),
+    ('max_chan_time', '<i4'),
+    ('l_chan_dvd', '<i4'),
+    ('phy_chan', '<i2'),
+    ('title', 'S10'),
+    ('ideal_rate', '<f4'),
+    ('kind', 'u1'),
+    ('unused1', 'i1'),
+    # the following four fields are only meaningful for waveform channels (kinds 1 and 9)
+    ('scale', '<f4'),
+    ('offset', '<f4'),
+    ('unit', 'S6'),
+    ('divide', '<i2'),
+])
+
+blockHeaderDtype = np.dtype([
+    ('pred_block', '<i4'),
+    ('succ_block', '<i4'),
+    ('start_time', '<i4'),
+    ('end_time', '<i4'),
+    ('channel_num', '<i2'),
+    ('items', '<i2'),
+])
+
+channelHeadersStart = 512
+channelHeaderSize = 140
+
+# Adc channels store int16 samples, RealWave channels float32 samples
+waveformKinds = {1: np.dtype('<i2'), 9: np.dtype('<f4')}
+
+# bump when the layout of the sidecar block indices changes
+blockIndexVersion = 1
+
+defaultIndexDir = os.path.join(os.path.expanduser('~'), '.GJEMSRDViewer', 'blockIndex')
+
+#***********************************************************************************************************************
+
+
+def pascalString2Str(raw):
+    '''
+    Decode a pascal string (first byte is the length) as stored in SMR headers
+    :param raw: bytes
+    :return: str
+    '''
+
+    length = bytearray(raw[:1])[0] if len(raw) else 0
+    return str(raw[1: length + 1].decode('iso-8859-1'))
+
+#***********************************************************************************************************************
+
+
+def blockIndexPath(smrFile, indexDir):
+    '''
+    Path of the sidecar block index of an SMR file. It is named after the file and a hash of its absolute path, so
+    that SMR files of the same name in different folders can share indexDir.
+    :param smrFile: str, path of the SMR file
+    :param indexDir: str, directory of the sidecar, e.g., defaultIndexDir or the folder of the SMR file
+    :return: str
+    '''
+
+    smrFile = os.path.abspath(smrFile)
+    pathHash = hashlib.sha1(smrFile.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(indexDir, '{}.{}.blockIndex.npz'.format(os.path.basename(smrFile), pathHash))
+
+
+def fileStat(smrFile):
+    '''
+    Size and modification time of a file, by which sidecar block indices are recognized as stale
+    :param smrFile: str
+    :return: list of two floats
+    '''
+
+    stat = os.stat(smrFile)
+    return [float(stat.st_size), float(stat.st_mtime)]
+
+
+def loadBlockIndex(smrFile, indexDir, smrFileStat):
+    '''
+    Load the sidecar block index of an SMR file, see saveBlockIndex
+    :param smrFile: str, path of the SMR file
+    :param indexDir: str, directory of the sidecar
+    :param smrFileStat: list, fileStat(smrFile)
+    :return: dict of (blockStartInds, blockOffsets, blockStartTimes) by channel number, see SMRChannel. Empty if
+    there is no sidecar, if it is stale, i.e., the size or modification time of the SMR file have changed since it
+    was written, or if it cannot be read.
+    '''
+
+    indexPath = blockIndexPath(smrFile, indexDir)
+    if not os.path.isfile(indexPath):
+        return {}
+
+    try:
+        sidecar = np.load(indexPath)
+        try:
+            if int(sidecar['version']) != blockIndexVersion or sidecar['fileStat'].tolist() != smrFileStat:
+                return {}
+            return dict((int(x), (sidecar['blockStartInds{}'.format(x)], sidecar['blockOffsets{}'.format(x)],
+                                  sidecar['blockStartTimes{}'.format(x)]))
+                        for x in sidecar['channels'])
+        finally:
+            sidecar.close()
+    except (IOError, OSError, ValueError, KeyError, zipfile.BadZipfile):
+        return {}
+
+
+def saveBlockIndex(smrFile, indexDir, smrFileStat, channels):
+    '''
+    Write the block indices of the waveform channels of an SMR file to a sidecar, an uncompressed npz file with, per
+    channel, the sample index at which each block starts, the file offset of its samples and its start time, sorted
+    by time. Failing to write the sidecar is not an error, as it only speeds up opening the SMR file again.
+    :param smrFile: str, path of the SMR file
+    :param indexDir: str, directory of the sidecar, created if necessary
+    :param smrFileStat: list, fileStat(smrFile) from before the blocks were indexed
+    :param channels: list of SMRChannel
+    '''
+
+    arrays = {'version': np.array(blockIndexVersion), 'fileStat': np.array(smrFileStat),
+              'channels': np.array([x.number for x in channels], dtype=np.int64)}
+    for channel in channels:
+        arrays['blockStartInds{}'.format(channel.number)] = channel.blockStartInds
+        arrays['blockOffsets{}'.format(channel.number)] = channel.blockOffsets
+        arrays['blockStartTimes{}'.format(channel.number)] = channel.blockStartTimes
+
+    indexPath = blockIndexPath(smrFile, indexDir)
+    # readers of the same file in several threads or processes may write the sidecar at the same time
+    tempPath = '{}.{}.part'.format(indexPath, uuid.uuid4().hex)
+    try:
+        if not os.path.isdir(indexDir):
+            os.makedirs(indexDir)
+        with open(tempPath, 'wb') as fle:
+            np.savez(fle, **arrays)
+        try:
+            os.rename(tempPath, indexPath)
+        except OSError:
+            # on Windows, files cannot be renamed onto existing ones
+            os.remove(indexPath)
+            os.rename(tempPath, indexPath)
+    except (IOError, OSError):
+        pass
+    finally:
+        if os.path.isfile(tempPath):
+            try:
+                os.remove(tempPath)
+            except OSError:
+                pass
+
+#***********************************************************************************************************************
+
+
+class SMRChannel(object):
+    '''
+    Header information and block index of one waveform channel of an SMR file. The samples of all the blocks of the
+    channel are treated as one continuous signal.
+    '''
+
+    def __init__(self, number, channelHeader, fileHeader):
+
+        self.number = number
+        self.kind = int(channelHeader['kind'])
+        self.title = pascalString2Str(channelHeader['title'])
+        self.unit = pascalString2Str(channelHeader['unit'])
+        self.dtype = waveformKinds[self.kind]
+        self.scale = float(channelHeader['scale'])
+        self.offset = float(channelHeader['offset'])
+
+        if fileHeader['system_id'] < 6:
+            self.samplingPeriod = float(channelHeader['divide'] * fileHeader['us_per_time']
+                                        * fileHeader['time_per_adc']) * 1e-6
+            self.timeBase = float(fileHeader['us_per_time']) * 1e-6
+        else:
+            self.samplingPeriod = float(channelHeader['l_chan_dvd'] * fileHeader['us_per_time']
+                                        * fileHeader['dtime_base'])
+            self.timeBase = float(fileHeader['us_per_time'] * fileHeader['dtime_base'])
+
+        self.firstBlock = int(channelHeader['firstblock'])
+
+        # filled by SMRReader.indexBlocks
+        self.blockStartInds = np.zeros(1, dtype=np.int64)
+        self.blockOffsets = np.zeros(0, dtype=np.int64)
+        self.blockStartTimes = np.zeros(0, dtype=np.float64)
+
+    @property
+    def nSamples(self):
+        return int(self.blockStartInds[-1])
+
+    @property
+    def tStart(self):
+        '''
+        :return: float, time of the first sample in s
+        '''
+        return float(self.blockStartTimes[0]) if self.blockStartTimes.shape[0] else 0.0
+
+    @property
+    def tStop(self):
+        '''
+        :return: float, time in s just after the last sample, like neo.AnalogSignal.t_stop
+        '''
+        return self.tStart + self.nSamples * self.samplingPeriod
+
+    @property
+    def samplingRate(self):
+        return 1.0 / self.samplingPeriod
+
+    def time2Index(self, t):
+        '''
+        Index of the sample at time t
+        :param t: float, time in s
+        :return: int
+        '''
+        return int((t - self.tStart) / self.samplingPeriod)
+
+#***********************************************************************************************************************
+
+
+class SMRReader(object):
+    '''
+    Reads the headers of an SMR file and an index of the data blocks of its waveform channels, without loading any
+    samples. Samples are then read on demand for arbitrary index or time windows from a read-only memory map of the
+    file, so that readers of the same file, also in other processes, share the page cache instead of each holding a
+    private copy of the samples.
+    '''
+
+    def __init__(self, smrFile, indexDir=defaultIndexDir):
+        '''
+        :param smrFile: str, path of the SMR file
+        :param indexDir: str, directory of the sidecar block index of the file, see saveBlockIndex. The block index
+        is loaded from the sidecar if it is up to date and written to it otherwise. If None, the blocks are always
+        indexed by walking their chain through the file.
+        '''
+
+        self.smrFile = smrFile
+        # numpy.memmap of the whole file, see mappedFile
+        self.fileMap = None
+
+        smrFileStat = fileStat(smrFile)
+        blockIndex = {} if indexDir is None else loadBlockIndex(smrFile, indexDir, smrFileStat)
+        indexChanged = False
+
+        with open(smrFile, 'rb') as fid:
+            self.fileHeader = np.fromfile(fid, dtype=fileHeaderDtype, count=1)[0]
+            self.analogChannels = []
+            for chanInd in range(int(self.fileHeader['channels'])):
+                fid.seek(channelHeadersStart + channelHeaderSize * chanInd)
+                channelHeader = np.fromfile(fid, dtype=channelHeaderDtype, count=1)[0]
+                if channelHeader['kind'] in waveformKinds and channelHeader['blocks'] != 0:
+                    channel = SMRChannel(chanInd, channelHeader, self.fileHeader)
+                    if chanInd in blockIndex:
+                        channel.blockStartInds, channel.blockOffsets, channel.blockStartTimes = blockIndex[chanInd]
+                    else:
+                        self.indexBlocks(fid, channel)
+                        indexChanged = True
+                    self.analogChannels.append(channel)
+
+        if indexDir is not None and indexChanged:
+            saveBlockIndex(smrFile, indexDir, smrFileStat, self.analogChannels)
+
+    def indexBlocks(self, fid, channel):
+        '''
+        Walk the chain of data blocks of channel and record the sample index, file offset and start time of each.
+        :param fid: file object of the SMR file opened in binary mode
+        :param channel: SMRChannel
+        '''
+
+        items = []
+        offsets = []
+        startTicks = []
+        blockPos = channel.firstBlock
+        while blockPos > 0:
+            fid.seek(blockPos)
+            blockHeader = np.fromfile(fid, dtype=blockHeaderDtype, count=1)[0]
+            items.append(int(blockHeader['items']))
+            offsets.append(blockPos + blockHeaderDtype.itemsize)
+            startTicks.append(int(blockHeader['start_time']))
+            blockPos = int(blockHeader['succ_block'])
+
+        channel.blockStartInds = np.concatenate(([0], np.cumsum(items))).astype(np.int64)
+        channel.blockOffsets = np.array(offsets, dtype=np.int64)
+        channel.blockStartTimes = np.array(startTicks, dtype=np.float64) * channel.timeBase
+
+    def __getstate__(self):
+
+        # the memory map would be pickled as a copy of the whole file; it is mapped again on first use instead
+        state = self.__dict__.copy()
+        state['fileMap'] = None
+        return state
+
+    def mappedFile(self):
+        '''
+        Read-only memory map of the whole SMR file, created on first use
+        :return: numpy.memmap of uint8
+        '''
+
+        if self.fileMap is None:
+            self.fileMap = np.memmap(self.smrFile, dtype=np.uint8, mode='r')
+        return self.fileMap
+
+    def blockView(self, channelIndex, blockInd):
+        '''
+        Raw, unscaled samples of a data block as a zero-copy view of the memory map of the file
+        :param channelIndex: int, see readSamples
+        :param blockInd: int, index of the block among those of the channel
+        :return: numpy.ndarray of the dtype of the channel, read-only
+        '''
+
+        channel = self.analogChannels[channelIndex]
+        nItems = int(channel.blockStartInds[blockInd + 1] - channel.blockStartInds[blockInd])
+        return np.ndarray(shape=(nItems,), dtype=channel.dtype, buffer=self.mappedFile(),
+                          offset=int(channel.blockOffsets[blockInd]))
+
+    def readSamples(self, channelIndex, startInd, endInd):
+        '''
+        Read and scale the samples with indices in [startInd, endInd) of a waveform channel
+        :param channelIndex: int, index of the channel among the waveform channels, i.e., the same as the index of
+        the corresponding neo.AnalogSignal in segment.analogsignals of neo.Spike2IO
+        :param startInd: int
+        :param endInd: int
+        :return: numpy.ndarray of float32
+        '''
+
+        channel = self.analogChannels[channelIndex]
+        startInd = max(0, startInd)
+        endInd = min(channel.nSamples, endInd)
+        samples = np.empty(max(0, endInd - startInd), dtype=np.float32)
+        if not samples.shape[0]:
+            return samples
+
+        firstBlock = int(np.searchsorted(channel.blockStartInds, startInd, side='right')) - 1
+        for blockInd in range(firstBlock, channel.blockOffsets.shape[0]):
+            blockFirst = int(channel.blockStartInds[blockInd])
+            if blockFirst >= endInd:
+                break
+            lo = max(startInd, blockFirst)
+            hi = min(endInd, int(channel.blockStartInds[blockInd + 1]))
+            samples[lo - startInd: hi - startInd] = self.blockView(channelIndex, blockInd)[lo - blockFirst:
+                                                                                           hi - blockFirst]
+
+        if channel.dtype.kind == 'i':
+            samples *= channel.scale / 6553.6
+            samples += channel.offset
+
+        return samples
+
+    def readAnalogSignal(self, channelIndex, startTime=None, endTime=None):
+        '''
+        Read the samples of a waveform channel between two times into a dimensionless neo.AnalogSignal
+        :param channelIndex: int, see readSamples
+        :param startTime: float, in s. If None, from the start of the channel
+        :param endTime: float, in s. If None, till the end of the channel. The sample at endTime is included.
+        :return: neo.AnalogSignal
+        '''
+
+        channel = self.analogChannels[channelIndex]
+        startInd = 0 if startTime is None else max(0, channel.time2Index(startTime))
+        endInd = channel.nSamples if endTime is None else channel.time2Index(endTime) + 1
+
+        analogSignal = AnalogSignal(signal=self.readSamples(channelIndex, startInd, endInd),
+                                    units=qu.dimensionless,
+                                    sampling_period=channel.samplingPeriod * qu.s,
+                                    t_start=(channel.tStart + startInd * channel.samplingPeriod) * qu.s)
+        analogSignal.name = channel.title
+        return analogSignal
+
+#***********************************************************************************************************************
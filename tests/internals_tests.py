@@ -1,6 +1,37 @@
-from rawDataImport import RawDataViewer
+from rawDataImport import RawDataViewer, CalibrationPlan, ExclusionPlan, parseCalibStr, ProcessingStringError, \
+    reportStage, prefixStages, LoadCancelled, viewerSignalAttrs, readSignal, openLazySignals, detectSpikes, \
+    epochYLims, plotMaxBins, inMemoryNBytes
+import instrumentation
+from smrReader import SMRReader, blockIndexPath, fileStat
+from viewerSession import ViewerSession
+from signalCache import SignalCache
+from epochPrefetcher import EpochPrefetcher, epochTracesNBytes
+from batchExport import readCalibTable, batchExport, exportSMR2NIX
+from neoNIXIO import addAnalogSignal2Block, addMultiTag, addTag, createExtDA, tag2AnalogSignal, multiTag2Snippets, \
+    dataArray2AnalogSignal
+import nixio as nix
+from neo import AnalogSignal, SpikeTrain, Spike2IO
+from minMaxPyramid import minMaxEnvelope
+from NEOFuncs import decimateSamples, detectSpikeInds, sliceAnalogSignal, getSpikesIn, getSpikeRateIn, getSpikeIndRangesIn, \
+    getSpikeCountsIn, getSpikeRatesIn, getSpikeAmps
 from matplotlib import pyplot as plt
 import quantities as qu
+import numpy as np
+import tempfile
+import time
+import shutil
+import os
+from tests.syntheticSMR import writeSyntheticSMR
+
+
+def syntheticSMRFile(duration=2., samplingRate=2000., nChannels=3):
+    """
+    Write a synthetic SMR file into a new temporary directory, to be removed with shutil.rmtree(os.path.dirname(...))
+    """
+
+    smrFile = os.path.join(tempfile.mkdtemp(), 'synthetic.smr')
+    writeSyntheticSMR(smrFile, duration, samplingRate, nChannels)
+    return smrFile
 
 
 def test_load_basic():
@@ -23,4 +54,757 @@ def test_load_basic():
 
     fig, ax = plt.subplots(figsize=(14, 11.2))
     rdi.plotVibEpoch(ax=ax, epochTimes=[tStart, tStart + epochWidth])
-    assert True
\ No newline at end of file
+    assert True
+
+def test_minMaxEnvelope():
+    """
+    Testing the min/max envelope used for drawing long windows
+    """
+
+    samples = np.array([0, 5, -1, 2, 7, 3, -4])
+    mins, maxs = minMaxEnvelope(samples, 3)
+    assert np.array_equal(mins, [-1, 2, -4])
+    assert np.array_equal(maxs, [5, 7, -4])
+
+
+def test_calibrationPlan():
+    """
+    Testing that overlapping calibration segments multiply and that the plan can be applied chunk-wise
+    """
+
+    calibPlan = CalibrationPlan('0-1, 10;0.5-2, 3;2.5-maxtime, 20', 'mV', tStart=0., samplingRate=10., nSamples=30)
+    gains = calibPlan.gainVector()
+    assert np.allclose(gains[[0, 7, 12, 22, 29]], [10, 30, 3, 1, 20])
+
+    samples = np.ones(30)
+    for chunkStart in range(0, 30, 7):
+        calibPlan.apply(samples[chunkStart: chunkStart + 7], chunkStart)
+    assert np.allclose(samples, gains)
+
+
+def test_parseCalibStr():
+    """
+    Testing that calibration strings are parsed into segments and that improper ones are reported with the position
+    of the error
+    """
+
+    assert parseCalibStr('20') == ((None, None, 20.),)
+    assert parseCalibStr('0-100s, 20;100-maxtime, 25') == ((0., 100., 20.), (100., None, 25.))
+
+    try:
+        parseCalibStr('0-100, 20;100-maxtime 25')
+        assert False, 'no ProcessingStringError raised'
+    except ProcessingStringError as e:
+        assert e.position == 22
+
+
+def test_instrumentation():
+    """
+    Testing that stages reach the instrumentation sinks with their prefixes, also without a progress callback, and
+    that nothing is recorded without sinks
+    """
+
+    assert prefixStages(None, 'MembranePotential') is None
+
+    sink = instrumentation.MemorySink()
+    instrumentation.addSink(sink)
+    try:
+        reportStage(prefixStages(None, 'MembranePotential'), 'calibrate', 0., nBytes=8, nSamples=2)
+    finally:
+        instrumentation.removeSink(sink)
+    reportStage(None, 'calibrate', 0.)
+
+    assert [(x['stage'], x['nBytes'], x['nSamples']) for x in sink.records] == \
+        [('MembranePotential: calibrate', 8, 2)]
+
+
+def test_smrReader():
+    """
+    Testing that SMRReader reads the same samples, start times and sampling rates as neo.Spike2IO, whole and in
+    windows
+    """
+
+    smrFile = syntheticSMRFile()
+    try:
+        spike2Signals = Spike2IO(smrFile).read()[0].segments[0].analogsignals
+        # one signal per channel, or, in newer versions of neo, one signal per group of channels
+        spike2Channels = [(x, channelInd) for x in spike2Signals for channelInd in range(x.shape[1])]
+
+        reader = SMRReader(smrFile, indexDir=None)
+        assert len(reader.analogChannels) == len(spike2Channels) == 3
+        for channelIndex, (spike2Signal, column) in enumerate(spike2Channels):
+            spike2Samples = spike2Signal.magnitude[:, column]
+            analogSignal = reader.readAnalogSignal(channelIndex)
+            assert np.array_equal(analogSignal.magnitude.ravel(), spike2Samples)
+            assert float(analogSignal.t_start.rescale(qu.s)) == float(spike2Signal.t_start.rescale(qu.s))
+            assert np.isclose(float(analogSignal.sampling_rate.rescale(qu.Hz)),
+                              float(spike2Signal.sampling_rate.rescale(qu.Hz)))
+            assert np.array_equal(reader.readSamples(channelIndex, 1234, 3210), spike2Samples[1234: 3210])
+
+            window = reader.readAnalogSignal(channelIndex, 0.5, 1.25)
+            assert np.array_equal(window.magnitude.ravel(), spike2Samples[1000: 2501])
+            assert float(window.t_start.rescale(qu.s)) == 0.5
+    finally:
+        shutil.rmtree(os.path.dirname(smrFile))
+
+
+def test_blockIndexSidecar():
+    """
+    Testing that the block index loaded from the sidecar equals the one built by walking the blocks and that the
+    sidecar is rebuilt when the SMR file changes or the sidecar cannot be read
+    """
+
+    smrFile = syntheticSMRFile()
+    indexDir = os.path.join(os.path.dirname(smrFile), 'blockIndex')
+
+    def sidecarFileStat():
+        sidecar = np.load(blockIndexPath(smrFile, indexDir))
+        try:
+            return sidecar['fileStat'].tolist()
+        finally:
+            sidecar.close()
+
+    try:
+        walked = SMRReader(smrFile, indexDir=None)
+        SMRReader(smrFile, indexDir=indexDir)
+        indexed = SMRReader(smrFile, indexDir=indexDir)
+        for walkedChannel, indexedChannel in zip(walked.analogChannels, indexed.analogChannels):
+            assert np.array_equal(walkedChannel.blockStartInds, indexedChannel.blockStartInds)
+            assert np.array_equal(walkedChannel.blockOffsets, indexedChannel.blockOffsets)
+            assert np.array_equal(walkedChannel.blockStartTimes, indexedChannel.blockStartTimes)
+
+        # a changed modification time, as after the file was rewritten
+        stat = os.stat(smrFile)
+        os.utime(smrFile, (stat.st_atime, stat.st_mtime - 10))
+        assert sidecarFileStat() != fileStat(smrFile)
+        SMRReader(smrFile, indexDir=indexDir)
+        assert sidecarFileStat() == fileStat(smrFile)
+
+        # a changed size, as while a recording is still being written
+        with open(smrFile, 'ab') as fle:
+            fle.write(b'\0' * 16)
+        SMRReader(smrFile, indexDir=indexDir)
+        assert sidecarFileStat() == fileStat(smrFile)
+
+        with open(blockIndexPath(smrFile, indexDir), 'wb') as fle:
+            fle.write(b'stale')
+        reindexed = SMRReader(smrFile, indexDir=indexDir)
+        assert reindexed.analogChannels[0].nSamples == walked.analogChannels[0].nSamples
+        assert sidecarFileStat() == fileStat(smrFile)
+    finally:
+        shutil.rmtree(os.path.dirname(smrFile))
+
+
+def test_viewerSession():
+    """
+    Testing that the least recently viewed viewers are dropped when the viewers hold more than the budget, but never
+    the one being viewed
+    """
+
+    class Viewer(object):
+        def __init__(self, nbytes):
+            self.nbytes = nbytes
+
+    session = ViewerSession(maxBytes=100)
+    session.add('a', Viewer(40))
+    session.add('b', Viewer(40))
+    assert session.get('a')[0].nbytes == 40
+    session.add('c', Viewer(40))
+    assert session.keys() == ['c', 'a']
+
+    session.setViewState('a', 'epoch')
+    assert session.get('a')[1] == 'epoch'
+    session.add('d', Viewer(150))
+    assert session.keys() == ['d']
+
+
+def assertSameViewers(rdi, otherRdi):
+    """
+    Assert that two RawDataViewers hold the same downsampled signals and envelopes
+    """
+
+    for signalAttr in viewerSignalAttrs:
+        signal, otherSignal = getattr(rdi, signalAttr), getattr(otherRdi, signalAttr)
+        assert signal.shape[0] == otherSignal.shape[0]
+        assert np.isclose(float(signal.t_start.rescale(qu.s)), float(otherSignal.t_start.rescale(qu.s)))
+        assert signal.units == otherSignal.units
+        assert np.allclose(signal.magnitude.ravel(), otherSignal.magnitude.ravel(), atol=1e-4)
+
+        mins, maxs = rdi.pyramids[signalAttr].levels[0]
+        otherMins, otherMaxs = otherRdi.pyramids[signalAttr].levels[0]
+        assert mins.shape == otherMins.shape
+        assert np.allclose(mins, otherMins, atol=1e-4) and np.allclose(maxs, otherMaxs, atol=1e-4)
+
+
+def test_streamingLoad():
+    """
+    Testing that streaming gives the same signals and envelopes as loading eagerly, with both decimation modes and
+    whatever the chunk size
+    """
+
+    smrFile = syntheticSMRFile(duration=1., samplingRate=20000.)
+    try:
+        loadPars = dict(voltageCalibStr='0-0.5, 20;0.5-maxtime, 25', ints2Exclude='0.2-0.3', forceUnits=True)
+        calibStrings = {'voltageCalibStr': loadPars['voltageCalibStr'], 'vibrationCalibStr': '27.1',
+                        'currentCalibStr': '10'}
+        for decimationMode in ('stride', 'fir'):
+            eagerRdi = RawDataViewer(smrFile, decimationMode=decimationMode, **loadPars)
+            assertSameViewers(RawDataViewer(smrFile, streaming=True, decimationMode=decimationMode, **loadPars),
+                              eagerRdi)
+
+            lazySignals = openLazySignals(smrFile, calibStrings, 700 * qu.Hz, loadPars['ints2Exclude'], True,
+                                          decimationMode)
+            for signalAttr, lazySignal in zip(viewerSignalAttrs, lazySignals):
+                assert lazySignal.downSampleFactor > 1
+                expectedMins, expectedMaxs = eagerRdi.pyramids[signalAttr].levels[0]
+                for chunkSize in (1000, 37 * lazySignal.downSampleFactor + 5, 2 ** 20):
+                    envelope = (np.empty(lazySignal.nSamples), np.empty(lazySignal.nSamples))
+                    samples = lazySignal.stream(envelopeOut=envelope, chunkSize=chunkSize)
+                    assert np.allclose(samples, getattr(eagerRdi, signalAttr).magnitude.ravel(), atol=1e-4)
+                    assert np.allclose(envelope[0], expectedMins, atol=1e-4)
+                    assert np.allclose(envelope[1], expectedMaxs, atol=1e-4)
+    finally:
+        shutil.rmtree(os.path.dirname(smrFile))
+
+
+def test_parallelLoad():
+    """
+    Testing that loading on a process pool gives the same signals and envelopes as loading eagerly and streaming,
+    that its memory-mapped arrays are not counted as held in memory and that its files are removed when loading is
+    cancelled
+    """
+
+    smrFile = syntheticSMRFile()
+    tempDir = tempfile.tempdir
+    try:
+        loadPars = dict(voltageCalibStr='0-1, 20;1-maxtime, 25', ints2Exclude='0.5-0.7', forceUnits=True)
+        eagerRdi = RawDataViewer(smrFile, **loadPars)
+        assertSameViewers(RawDataViewer(smrFile, streaming=True, **loadPars), eagerRdi)
+        parallelRdi = RawDataViewer(smrFile, parallel=True, **loadPars)
+        assertSameViewers(parallelRdi, eagerRdi)
+
+        # the signals and the base levels of their envelopes are mapped from files, the other levels are in memory
+        for signalAttr in viewerSignalAttrs:
+            assert inMemoryNBytes(getattr(parallelRdi, signalAttr)) == 0
+        assert parallelRdi.nbytes == sum(mins.nbytes + maxs.nbytes for pyramid in parallelRdi.pyramids.values()
+                                         for mins, maxs in pyramid.levels[1:])
+        assert eagerRdi.nbytes == sum(pyramid.nbytes for pyramid in eagerRdi.pyramids.values()) + \
+            sum(getattr(eagerRdi, x).nbytes for x in viewerSignalAttrs)
+
+        def cancel(stage, duration):
+            raise LoadCancelled()
+
+        tempfile.tempdir = os.path.join(os.path.dirname(smrFile), 'memmaps')
+        os.mkdir(tempfile.tempdir)
+        try:
+            RawDataViewer(smrFile, parallel=True, progressCallback=cancel, **loadPars)
+            assert False, 'loading was not cancelled'
+        except LoadCancelled:
+            pass
+        assert os.listdir(tempfile.tempdir) == []
+    finally:
+        tempfile.tempdir = tempDir
+        shutil.rmtree(os.path.dirname(smrFile))
+
+
+def test_loadCancelled():
+    """
+    Testing that raising LoadCancelled from the progress callback stops eager loads at the end of the current stage
+    and streaming loads and spike detection after the current chunk
+    """
+
+    smrFile = syntheticSMRFile()
+    try:
+        for loadKwargs, cancelAt in ((dict(), 'MembranePotential: read'),
+                                     (dict(streaming=True), 'MembranePotential: stream')):
+            calls = []
+
+            def cancel(stage, duration):
+                calls.append((stage, duration))
+                if stage == cancelAt:
+                    raise LoadCancelled()
+
+            try:
+                RawDataViewer(smrFile, voltageCalibStr='20', progressCallback=cancel, **loadKwargs)
+                assert False, 'loading was not cancelled'
+            except LoadCancelled:
+                pass
+            assert calls[-1][0] == cancelAt and all(stage != cancelAt for stage, duration in calls[:-1])
+            if loadKwargs.get('streaming'):
+                assert calls[-1][1] is None
+
+        voltageSignal = openLazySignals(smrFile, {'voltageCalibStr': '20', 'vibrationCalibStr': '27.1',
+                                                  'currentCalibStr': '10'})[0]
+        calls = []
+
+        def cancelFirstChunk(stage, duration):
+            calls.append((stage, duration))
+            raise LoadCancelled()
+
+        try:
+            detectSpikes(voltageSignal, chunkSize=100, progressCallback=cancelFirstChunk)
+            assert False, 'spike detection was not cancelled'
+        except LoadCancelled:
+            pass
+        assert calls == [('detect spikes', None)]
+    finally:
+        shutil.rmtree(os.path.dirname(smrFile))
+
+
+def test_signalCache():
+    """
+    Testing that viewers are loaded from the signal cache only with the calibration they were stored with and that
+    the least recently used entries are removed when the cache holds more than maxBytes, but never the one just stored
+    """
+
+    smrFile = syntheticSMRFile()
+    try:
+        signalCache = SignalCache(os.path.join(os.path.dirname(smrFile), 'viewerCache'))
+        stages = []
+        rdi = RawDataViewer(smrFile, voltageCalibStr='20', signalCache=signalCache)
+        cachedRdi = RawDataViewer(smrFile, voltageCalibStr='20', signalCache=signalCache,
+                                  progressCallback=lambda stage, duration: stages.append(stage))
+        assert cachedRdi.cacheKey == rdi.cacheKey and 'cache store' not in stages
+        assertSameViewers(cachedRdi, rdi)
+
+        recalibratedRdi = RawDataViewer(smrFile, voltageCalibStr='25', signalCache=signalCache)
+        assert recalibratedRdi.cacheKey != rdi.cacheKey
+        assert np.allclose(recalibratedRdi.voltageSignal.magnitude, 1.25 * rdi.voltageSignal.magnitude, atol=1e-3)
+
+        signalCache = SignalCache(os.path.join(os.path.dirname(smrFile), 'cache'))
+        signals = [AnalogSignal(np.arange(1000.), units='mV', sampling_rate=1 * qu.kHz, name='signal')]
+        keys = [signalCache.key(smrFile, entry=x) for x in range(4)]
+        for ind, key in enumerate(keys[:2]):
+            signalCache.store(key, signals)
+            os.utime(signalCache.entryPath(key), (1000 * (ind + 1), 1000 * (ind + 1)))
+        entrySize = os.path.getsize(signalCache.entryPath(keys[0]))
+
+        assert signalCache.load(keys[0]) is not None
+        signalCache.maxBytes = int(2.5 * entrySize)
+        signalCache.store(keys[2], signals)
+        assert [os.path.isfile(signalCache.entryPath(x)) for x in keys] == [True, False, True, False]
+
+        signalCache.maxBytes = entrySize // 2
+        signalCache.store(keys[3], signals)
+        assert [os.path.isfile(signalCache.entryPath(x)) for x in keys] == [False, False, False, True]
+        assert np.array_equal(signalCache.load(keys[3])['signal'].magnitude.ravel(), np.arange(1000.))
+    finally:
+        shutil.rmtree(os.path.dirname(smrFile))
+
+
+def test_epochPrefetcher():
+    """
+    Testing that the prefetcher prepares the epochs around the one being viewed within maxBytes, drops the epochs
+    that are not around it any more and waits for the epoch being prepared when it is asked for
+    """
+
+    smrFile = syntheticSMRFile()
+    try:
+        rdi = RawDataViewer(smrFile, voltageCalibStr='20')
+        epochWidth = 0.2 * qu.s
+        epochStarts = [rdi.voltageSignal.t_start + x * epochWidth for x in range(9)]
+        epochKeys = [EpochPrefetcher.epochKey(x, epochWidth, 100) for x in epochStarts]
+
+        def waitForPrefetcher(prefetcher, timeout=10.):
+            startTime = time.time()
+            while prefetcher.pending and time.time() - startTime < timeout:
+                time.sleep(0.01)
+            prefetcher.stop()
+            prefetcher.thread.join(timeout)
+            assert not prefetcher.pending and not prefetcher.thread.is_alive()
+
+        prefetcher = EpochPrefetcher(rdi, nEpochs=2)
+        try:
+            prefetcher.prefetch(epochStarts[2], epochWidth, 100)
+            startTime = time.time()
+            while len(prefetcher.epochTraces) < 5 and time.time() - startTime < 10:
+                time.sleep(0.01)
+            assert set(prefetcher.epochTraces) == set(epochKeys[:5])
+
+            prefetcher.prefetch(epochStarts[6], epochWidth, 100)
+            assert set(prefetcher.epochTraces) <= set(epochKeys[4:])
+        finally:
+            waitForPrefetcher(prefetcher)
+        assert set(prefetcher.epochTraces) == set(epochKeys[4:])
+        epochTraces = prefetcher.get(epochStarts[6], epochWidth, 100)
+        for (signalAttr, times, values), (expectedAttr, expectedTimes, expectedValues) in \
+                zip(epochTraces, rdi.getEpochTraces([epochStarts[6], epochStarts[7]], 100)):
+            assert signalAttr == expectedAttr
+            assert np.array_equal(times, expectedTimes) and np.array_equal(values, expectedValues)
+
+        maxBytes = int(2.5 * epochTracesNBytes(epochTraces))
+        prefetcher = EpochPrefetcher(rdi, nEpochs=2, maxBytes=maxBytes)
+        try:
+            prefetcher.prefetch(epochStarts[4], epochWidth, 100)
+        finally:
+            waitForPrefetcher(prefetcher)
+        assert 0 < len(prefetcher.epochTraces) < 5
+        assert sum(epochTracesNBytes(x) for x in prefetcher.epochTraces.values()) <= maxBytes
+        assert list(prefetcher.epochTraces)[0] == epochKeys[4]
+        # epochs computed by get are not kept beyond maxBytes either
+        assert prefetcher.get(epochStarts[0], epochWidth, 100)
+        assert epochKeys[0] not in prefetcher.epochTraces
+        assert sum(epochTracesNBytes(x) for x in prefetcher.epochTraces.values()) <= maxBytes
+
+        slicedKeys = []
+
+        class SlowViewer(object):
+            voltageSignal = rdi.voltageSignal
+
+            def getEpochTraces(self, epochTimes, maxBins):
+                slicedKeys.append(EpochPrefetcher.epochKey(epochTimes[0], epochTimes[1] - epochTimes[0], maxBins))
+                time.sleep(0.2)
+                return rdi.getEpochTraces(epochTimes, maxBins)
+
+        # get waits for the epoch being prepared instead of slicing it again
+        prefetcher = EpochPrefetcher(SlowViewer(), nEpochs=0)
+        try:
+            prefetcher.prefetch(epochStarts[3], epochWidth, 100)
+            startTime = time.time()
+            while prefetcher.inFlightKey != epochKeys[3] and time.time() - startTime < 10:
+                time.sleep(0.001)
+            assert prefetcher.get(epochStarts[3], epochWidth, 100) is prefetcher.epochTraces[epochKeys[3]]
+        finally:
+            waitForPrefetcher(prefetcher)
+        assert slicedKeys == [epochKeys[3]]
+    finally:
+        shutil.rmtree(os.path.dirname(smrFile))
+
+
+def test_updateVibEpoch():
+    """
+    Testing that paging through epochs keeps the y limits, so that only the lines and the x axis need to be redrawn,
+    that the lines show the traces of each epoch at their absolute times, and that the y limits are fitted to the
+    epoch again after an epoch with a large artifact
+    """
+
+    smrFile = syntheticSMRFile()
+    try:
+        rdi = RawDataViewer(smrFile, voltageCalibStr='20')
+        epochWidth = 0.2 * qu.s
+        fig, ax = plt.subplots()
+        epochs = [[rdi.voltageSignal.t_start + x * epochWidth, rdi.voltageSignal.t_start + (x + 1) * epochWidth]
+                  for x in range(9)]
+        limitsChanged = []
+        for epochTimes in epochs:
+            artists, changed = rdi.updateVibEpoch(ax, epochTimes)
+            limitsChanged.append(changed)
+            assert ax.xaxis in artists
+            assert ax.get_xlim()[0] <= float(epochTimes[0].magnitude) < float(epochTimes[1].magnitude) <= \
+                ax.get_xlim()[1]
+
+            for signalAttr, traceTimes, traceValues in rdi.getEpochTraces(epochTimes, plotMaxBins(ax)):
+                line = rdi.epochLines[signalAttr]
+                assert line in artists
+                assert np.allclose(np.asarray(line.get_xdata()), traceTimes.magnitude)
+                assert np.array_equal(np.asarray(line.get_ydata()), traceValues.magnitude)
+        assert limitsChanged[0] and sum(limitsChanged) <= 2
+
+        epochTraces = rdi.getEpochTraces(epochs[0], plotMaxBins(ax))
+        artifactTraces = [(signalAttr, traceTimes, 20 * traceValues)
+                          for signalAttr, traceTimes, traceValues in epochTraces]
+        assert rdi.updateVibEpoch(ax, epochs[0], artifactTraces)[1]
+        assert ax.get_ylim()[1] - ax.get_ylim()[0] > 1000
+        assert rdi.updateVibEpoch(ax, epochs[1])[1]
+        assert np.allclose(ax.get_ylim(), epochYLims(rdi.getEpochTraces(epochs[1], plotMaxBins(ax))))
+        plt.close(fig)
+    finally:
+        shutil.rmtree(os.path.dirname(smrFile))
+
+
+def test_windowedNIXReads():
+    """
+    Testing that reading a window of a data array or the snippet of a tag gives the same samples and start time as
+    slicing the whole data array, also for windows reaching beyond the array and for empty windows
+    """
+
+    tempDir = tempfile.mkdtemp()
+    nixFile = nix.File.open(os.path.join(tempDir, 'windows.h5'), nix.FileMode.Overwrite)
+    try:
+        blk = nixFile.create_block('signals', 'test')
+        # sampling period, offset and window bounds are exact in binary, so that expected indices are too
+        signal = AnalogSignal(np.arange(80.), units='mV', sampling_period=0.125 * qu.s, t_start=0.5 * qu.s)
+        signal.name = 'signal'
+        dataArray = addAnalogSignal2Block(blk, signal)
+        fullSignal = dataArray2AnalogSignal(dataArray)
+        fullSamples = fullSignal.magnitude.ravel()
+        assert np.array_equal(fullSamples, np.arange(80.))
+
+        for startTime, endTime, startInd, endInd in [(2 * qu.s, 4 * qu.s, 12, 29),
+                                                     (2000 * qu.ms, 4000 * qu.ms, 12, 29),
+                                                     (0 * qu.s, 3 * qu.s, 0, 21),
+                                                     (9 * qu.s, 20 * qu.s, 68, 80),
+                                                     (20 * qu.s, 30 * qu.s, 80, 80),
+                                                     (0 * qu.s, 0.25 * qu.s, 0, 0),
+                                                     (4 * qu.s, 2 * qu.s, 28, 28),
+                                                     (None, None, 0, 80)]:
+            window = dataArray2AnalogSignal(dataArray, startTime, endTime)
+            assert np.array_equal(window.magnitude.ravel(), fullSamples[startInd: endInd])
+            assert float(window.t_start.rescale(qu.s)) == 0.5 + startInd * 0.125
+            if startInd < endInd and (startTime is None or startTime >= fullSignal.t_start) \
+                    and (endTime is None or endTime <= fullSignal.t_stop):
+                assert np.array_equal(window.magnitude.ravel(),
+                                      sliceAnalogSignal(fullSignal, startTime, endTime).magnitude.ravel())
+
+        for tagInd, (position, extent, startInd, endInd) in enumerate([(2., 1., 12, 21), (10., 2., 76, 80),
+                                                                        (0., 1., 0, 9)]):
+            addTag('tag{}'.format(tagInd), 'test', position, blk, [dataArray], extent=extent)
+            snippet = tag2AnalogSignal(blk.tags['tag{}'.format(tagInd)], 0)
+            assert np.array_equal(snippet.magnitude.ravel(), fullSamples[startInd: endInd])
+            assert float(snippet.t_start.rescale(qu.s)) == 0.5 + startInd * 0.125
+    finally:
+        nixFile.close()
+        shutil.rmtree(tempDir)
+
+
+def test_multiTag2Snippets():
+    """
+    Testing that the snippets of a multi_tag, also overlapping ones and ones beyond the ends of the reference, equal
+    the traces of single tags, whatever the grouping of reads
+    """
+
+    tempDir = tempfile.mkdtemp()
+    nixFile = nix.File.open(os.path.join(tempDir, 'snippets.h5'), nix.FileMode.Overwrite)
+    try:
+        blk = nixFile.create_block('signals', 'test')
+        signal = AnalogSignal(np.arange(1000.), units='mV', sampling_period=1 * qu.ms, t_start=0.5 * qu.s)
+        signal.name = 'signal'
+        ref = addAnalogSignal2Block(blk, signal)
+
+        positions = np.array([0.6, 0.6005, 0.601, 0.62, 0.9, 1.48, 0.45, 1.6])
+        extent = 0.02
+        addMultiTag('snippets', 'test', positions * qu.s, blk, [ref],
+                    extents=createExtDA('snippets_ext', np.full(positions.shape, extent), blk))
+        multiTag = blk.multi_tags['snippets']
+
+        snippets, snippetStartTimes = multiTag2Snippets(multiTag, 0)
+        assert snippets.shape == (8, 21)
+        for maxReadSamples in (21, 50):
+            assert np.array_equal(multiTag2Snippets(multiTag, 0, maxReadSamples=maxReadSamples)[0], snippets,
+                                  equal_nan=True)
+
+        # as in tag2AnalogSignal
+        startInds = np.floor((positions - 0.5) / 1e-3).astype(int)
+        for positionInd, (position, startInd) in enumerate(zip(positions, startInds)):
+            if 0 <= startInd < 1000:
+                addTag('tag{}'.format(positionInd), 'test', position, blk, [ref], extent=extent)
+                trace = tag2AnalogSignal(blk.tags['tag{}'.format(positionInd)], 0).magnitude
+                assert np.array_equal(snippets[positionInd, :trace.shape[0]], trace)
+                assert np.isnan(snippets[positionInd, trace.shape[0]:]).all()
+            else:
+                assert np.isnan(snippets[positionInd]).all() if startInd >= 1000 else \
+                    np.isnan(snippets[positionInd, :-startInd]).all()
+        assert np.allclose(snippetStartTimes.rescale(qu.s).magnitude, 0.5 + startInds * 1e-3)
+    finally:
+        nixFile.close()
+        shutil.rmtree(tempDir)
+
+
+def test_batchSpikeQueries():
+    """
+    Testing that the batch spike queries agree with getSpikesIn and getSpikeRateIn, also for spikes at the bounds of
+    intervals and for intervals without spikes, and that getSpikeAmps picks the samples at the spike times
+    """
+
+    spikeTrain = SpikeTrain([100., 250., 500., 500., 1250., 1900.], units='ms', t_start=0 * qu.ms, t_stop=2 * qu.s)
+    intervalStarts = qu.Quantity([0., 0.25, 0.5, 0.6, 1.25, 1.9, 0.3], 's')
+    intervalEnds = qu.Quantity([0.25, 0.5, 0.6, 1.25, 2., 2., 0.4], 's')
+
+    startInds, endInds = getSpikeIndRangesIn(spikeTrain.times, intervalStarts, intervalEnds)
+    counts = getSpikeCountsIn(spikeTrain.times, intervalStarts, intervalEnds)
+    rates = getSpikeRatesIn(spikeTrain, intervalStarts, intervalEnds)
+    for intervalInd, (intervalStart, intervalEnd) in enumerate(zip(intervalStarts, intervalEnds)):
+        intervalSpikes = getSpikesIn(spikeTrain.times, intervalStart, intervalEnd)
+        assert np.array_equal(spikeTrain.times[startInds[intervalInd]: endInds[intervalInd]].magnitude,
+                              intervalSpikes.magnitude)
+        assert counts[intervalInd] == intervalSpikes.shape[0]
+        assert np.isclose(rates[intervalInd], getSpikeRateIn(spikeTrain, intervalStart, intervalEnd))
+    assert np.array_equal(counts, [1, 1, 2, 0, 2, 1, 0])
+
+    resp = AnalogSignal(np.arange(2000.), units='mV', sampling_rate=1 * qu.kHz, t_start=0 * qu.s)
+    spikeInds = [int(float(((x - resp.t_start) * resp.sampling_rate).simplified)) for x in spikeTrain.times]
+    spikeAmps = getSpikeAmps(resp, spikeTrain.times)
+    assert spikeAmps.units == qu.mV
+    assert np.array_equal(spikeAmps.magnitude.ravel(), resp.magnitude.ravel()[spikeInds])
+
+
+def test_readCalibTable():
+    """
+    Testing that CSV and JSON calibration tables give the same entries, with defaults for missing strings, and that
+    improper entries are reported
+    """
+
+    tempDir = tempfile.mkdtemp()
+    try:
+        csvFile = os.path.join(tempDir, 'calib.csv')
+        with open(csvFile, 'w') as fle:
+            fle.write('smrFile,voltageCalibStr,vibrationCalibStr,currentCalibStr,ints2Exclude\n'
+                      'a/first.smr,20,,,0-5;100-maxtime\n'
+                      'second.smr,"0-10s, 20;10-maxtime, 25",30,,\n')
+        jsonFile = os.path.join(tempDir, 'calib.json')
+        with open(jsonFile, 'w') as fle:
+            fle.write('{"a/first.smr": {"voltageCalibStr": "20", "ints2Exclude": "0-5;100-maxtime"},'
+                      ' "second.smr": {"voltageCalibStr": "0-10s, 20;10-maxtime, 25", "vibrationCalibStr": "30"}}')
+
+        calibTable = readCalibTable(csvFile)
+        assert calibTable == readCalibTable(jsonFile)
+        assert calibTable['first.smr'] == {'voltageCalibStr': '20', 'vibrationCalibStr': '27.1',
+                                           'currentCalibStr': '10', 'ints2Exclude': '0-5;100-maxtime'}
+        assert calibTable['second.smr']['vibrationCalibStr'] == '30'
+        assert calibTable['second.smr']['ints2Exclude'] is None
+
+        for improperRow in ('third.smr,,,,', 'third.smr,20 mV,,,', 'third.smr,20,,,5-'):
+            with open(csvFile, 'w') as fle:
+                fle.write('smrFile,voltageCalibStr,vibrationCalibStr,currentCalibStr,ints2Exclude\n' + improperRow)
+            try:
+                readCalibTable(csvFile)
+                assert False, 'no error raised for {}'.format(improperRow)
+            except ValueError:
+                pass
+    finally:
+        shutil.rmtree(tempDir)
+
+
+def test_batchExportResume():
+    """
+    Testing that a batch export converts the files of the calibration table, skips them when run again and converts
+    again the files whose entry changed
+    """
+
+    smrFile = syntheticSMRFile(duration=1.)
+    tempDir = os.path.dirname(smrFile)
+    outDir = os.path.join(tempDir, 'nix')
+    calibTableFile = os.path.join(tempDir, 'calib.json')
+    try:
+        for voltageCalibStr, expectConverted in (('20', True), ('20', False), ('25', True)):
+            with open(calibTableFile, 'w') as fle:
+                fle.write('{{"synthetic.smr": {{"voltageCalibStr": "{}"}}}}'.format(voltageCalibStr))
+            progress = batchExport(tempDir, calibTableFile, outDir, nWorkers=1)
+            assert progress['synthetic.smr']['status'] == 'done', progress['synthetic.smr']['error']
+            assert progress['synthetic.smr']['calibEntry']['voltageCalibStr'] == voltageCalibStr
+            nixFileMTime = os.path.getmtime(os.path.join(outDir, 'synthetic.h5'))
+            if expectConverted:
+                convertedMTime = nixFileMTime
+            else:
+                assert nixFileMTime == convertedMTime
+    finally:
+        shutil.rmtree(tempDir)
+
+
+def test_exportSMR2NIX():
+    """
+    Testing that the signals exported to NIX equal those cleaned and calibrated with readSignal and that the
+    processing parameters are stored with them
+    """
+
+    smrFile = syntheticSMRFile()
+    nixFile = os.path.join(os.path.dirname(smrFile), 'synthetic.h5')
+    calibEntry = {'voltageCalibStr': '0-1, 20;1-maxtime, 25', 'vibrationCalibStr': '27.1', 'currentCalibStr': '10',
+                  'ints2Exclude': '0.5-0.7'}
+    try:
+        exportSMR2NIX(smrFile, nixFile, calibEntry, forceUnits=True)
+
+        reader = SMRReader(smrFile)
+        nixFileObj = nix.File.open(nixFile, nix.FileMode.ReadOnly)
+        try:
+            blk = nixFileObj.blocks['synthetic']
+            assert blk.metadata['SMRFile'] == 'synthetic.smr'
+            assert blk.metadata['voltageCalibStr'] == calibEntry['voltageCalibStr']
+            for channelIndex, (name, calibStrKey, calibUnitStr, ints2Exclude) in enumerate([
+                    ('MembranePotential', 'voltageCalibStr', 'mV', calibEntry['ints2Exclude']),
+                    ('VibrationStimulus', 'vibrationCalibStr', 'um', calibEntry['ints2Exclude']),
+                    ('CurrentInput', 'currentCalibStr', 'nA', None)]):
+                rawSignal = reader.readAnalogSignal(channelIndex)
+                expected = readSignal(rawSignal, calibEntry[calibStrKey], calibUnitStr,
+                                      [rawSignal.t_start, rawSignal.t_stop], qu.Quantity(1, calibUnitStr).units,
+                                      ints2Exclude)
+                exported = dataArray2AnalogSignal(blk.data_arrays[name])
+                assert exported.shape[0] == expected.shape[0]
+                assert exported.units == expected.units
+                assert np.isclose(float(exported.t_start.rescale(qu.s)), float(expected.t_start.rescale(qu.s)))
+                assert np.isclose(float(exported.sampling_period.rescale(qu.s)),
+                                  float(expected.sampling_period.rescale(qu.s)))
+                assert np.allclose(exported.magnitude.ravel(), expected.magnitude.ravel(), atol=1e-4)
+        finally:
+            nixFileObj.close()
+    finally:
+        shutil.rmtree(os.path.dirname(smrFile))
+
+
+def test_exclusionPlan():
+    """
+    Testing that overlapping intervals are merged, intervals outside the signal dropped and that the plan can be
+    applied chunk-wise
+    """
+
+    exclusionPlan = ExclusionPlan('0.5-1;0.8-1.5;5-6', tStart=0., samplingRate=10., nSamples=30)
+    assert np.array_equal(exclusionPlan.stInds, [5])
+    assert np.array_equal(exclusionPlan.endInds, [15])
+
+    samples = np.arange(30.) ** 2
+    exclusionPlan.setEdgeValues(samples[exclusionPlan.stInds], samples[exclusionPlan.endInds])
+    for chunkStart in range(0, 30, 7):
+        exclusionPlan.apply(samples[chunkStart: chunkStart + 7], chunkStart)
+    assert np.allclose(samples[5: 16], np.linspace(25, 225, 11))
+    assert np.allclose(samples[16:], np.arange(16., 30.) ** 2)
+
+
+def test_firDecimation():
+    """
+    Testing that the anti-aliased decimation removes frequencies above the new Nyquist frequency
+    """
+
+    times = np.arange(20000) / 20000.
+    samples = np.sin(2 * np.pi * 5 * times) + np.sin(2 * np.pi * 3000 * times)
+    expected = np.sin(2 * np.pi * 5 * times[::28])
+    assert np.abs(decimateSamples(samples, 28, 'stride') - expected).max() > 0.5
+    assert np.abs(decimateSamples(samples, 28, 'fir', chunkSize=1000) - expected)[20: -20].max() < 0.01
+
+
+def test_detectSpikeInds():
+    """
+    Testing that spike peaks are found after upward threshold crossings and that the refractory period is respected
+    """
+
+    samples = np.zeros(100)
+    samples[[10, 11, 12]] = [5, 8, 6]
+    samples[[14, 15]] = [7, 9]
+    samples[[50, 51]] = [9, 4]
+    crossingInds, peakInds = detectSpikeInds(samples, 3, peakWindow=3, refractory=10)
+    assert np.array_equal(crossingInds, [10, 50])
+    assert np.array_equal(peakInds, [11, 50])
+
+
+def test_detectSpikes():
+    """
+    Testing that detecting spikes chunk by chunk finds the spikes found in the whole signal at once and that the
+    spikes do not depend on the chunk size, also for chunks ending at threshold crossings and within peak windows
+    """
+
+    smrFile = syntheticSMRFile(duration=2., samplingRate=20000.)
+    try:
+        voltageSignal = openLazySignals(smrFile, {'voltageCalibStr': '20', 'vibrationCalibStr': '27.1',
+                                                  'currentCalibStr': '10'})[0]
+        samples = voltageSignal.stream()
+        threshold = -40 * qu.mV
+        peakWindow = refractory = 40
+        crossingInds, peakInds = detectSpikeInds(samples, float(threshold.rescale(voltageSignal.units).magnitude),
+                                                 peakWindow, refractory)
+        assert crossingInds.shape[0] > 10
+        expected = voltageSignal.t_start.rescale(qu.s).magnitude + peakInds / 20000.
+
+        chunkSizes = [997, 4096, samples.shape[0]] + [crossingInds[ind] + offset
+                                                      for ind in (2, 5) for offset in (0, 1, peakWindow // 2)]
+        for thresholdWindowDuration in (0.1 * qu.s, 0.5 * qu.s, 10 * qu.s):
+            for chunkSize in chunkSizes:
+                spikeTrain = detectSpikes(voltageSignal, threshold, chunkSize=chunkSize,
+                                          thresholdWindowDuration=thresholdWindowDuration)
+                assert np.allclose(spikeTrain.times.rescale(qu.s).magnitude, expected)
+
+        spikeTrains = [detectSpikes(voltageSignal, chunkSize=chunkSize, thresholdWindowDuration=0.5 * qu.s)
+                       for chunkSize in chunkSizes]
+        assert spikeTrains[0].shape[0] > 10
+        for spikeTrain in spikeTrains[1:]:
+            assert np.array_equal(spikeTrain.times, spikeTrains[0].times)
+    finally:
+        shutil.rmtree(os.path.dirname(smrFile))
@@ -0,0 +1,147 @@
+'''
+Writes synthetic SMR files shaped like the recordings viewed with GJEMSRDViewer: a membrane potential channel with
+spikes, a vibration stimulus channel with sine bursts and, optionally, a current injection channel with steps. The
+samples are generated and written chunk by chunk, so that files of several hours can be written with little memory.
+
+Usage: python tests/syntheticSMR.py <SMR file> <duration in s> [<sampling rate in Hz>] [<number of channels>]
+'''
+from __future__ import print_function
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from smrReader import fileHeaderDtype, channelHeaderDtype, blockHeaderDtype, channelHeadersStart, \
+    channelHeaderSize
+
+# samples per data block, as written by Spike2 for Adc channels
+blockItems = 8000
+
+# Adc samples are scaled by scale / 6553.6, so that the int16 range covers about +-5 units with a scale of 1
+adcScale = 6553.6
+
+channelTitles = ['Vm', 'Vib', 'Iinj']
+
+
+def pascalString(text, size):
+
+    encoded = text.encode('ascii')[:size - 1]
+    return bytes(bytearray([len(encoded)])) + encoded
+
+
+def syntheticSamples(channelInd, startInd, nSamples, samplingRate, seed=0):
+    '''
+    Samples of a synthetic channel, in the units of the raw channels of the recordings, i.e., before calibration.
+    Each chunk is generated from its own random state, so that any chunk can be regenerated on its own.
+    :param channelInd: int, 0 for the membrane potential, 1 for the vibration and 2 for the current
+    :param startInd: int, index of the first sample
+    :param nSamples: int
+    :param samplingRate: float, in Hz
+    :param seed: int
+    :return: numpy.ndarray of float64
+    '''
+
+    randomState = np.random.RandomState([seed, channelInd, startInd % (2 ** 31)])
+    times = (startInd + np.arange(nSamples)) / samplingRate
+
+    if channelInd == 0:
+        # resting potential with noise and spikes of 1 ms at about 10 Hz; calibrated with '20', -60 mV and 40 mV
+        samples = -3 + 0.05 * randomState.standard_normal(nSamples)
+        spikeInds = np.flatnonzero(randomState.uniform(size=nSamples) < 10. / samplingRate)
+        spikeLength = max(1, int(1e-3 * samplingRate))
+        spikeShape = 5 * np.sin(np.pi * np.arange(spikeLength) / spikeLength)
+        for spikeInd in spikeInds:
+            spikeEnd = min(nSamples, spikeInd + spikeLength)
+            samples[spikeInd: spikeEnd] += spikeShape[:spikeEnd - spikeInd]
+    elif channelInd == 1:
+        # 1 s bursts of 200 Hz every 2 s
+        samples = 0.5 * np.sin(2 * np.pi * 200 * times) * (np.floor(times) % 2 == 0)
+        samples += 0.01 * randomState.standard_normal(nSamples)
+    else:
+        # current steps of 0.5 s every 5 s
+        samples = 0.2 * ((times % 5) < 0.5) + 0.01 * randomState.standard_normal(nSamples)
+
+    return samples
+
+
+def writeSyntheticSMR(smrFile, duration, samplingRate=20000., nChannels=3, seed=0, chunkSize=2 ** 22):
+    '''
+    Write a synthetic SMR file with nChannels Adc channels of the same sampling rate, starting at 0 s
+    :param smrFile: str, path of the file to write, overwritten if it exists
+    :param duration: float, in s
+    :param samplingRate: float, in Hz
+    :param nChannels: int, 2 or 3
+    :param seed: int, seed of the noise and spike times
+    :param chunkSize: int, number of samples generated at a time, a multiple of blockItems
+    '''
+
+    assert nChannels in (2, 3), 'nChannels must be 2 or 3'
+    chunkSize = max(1, chunkSize // blockItems) * blockItems
+
+    nSamples = int(duration * samplingRate)
+    nBlocks = (nSamples + blockItems - 1) // blockItems
+    blockHeaderSize = blockHeaderDtype.itemsize
+    dataStart = channelHeadersStart + channelHeaderSize * nChannels
+    # blocks of each channel are contiguous and all but the last hold blockItems samples
+    channelBytes = nBlocks * blockHeaderSize + nSamples * 2
+
+    def blockOffset(channelInd, blockInd):
+        return dataStart + channelInd * channelBytes + blockInd * (blockHeaderSize + 2 * blockItems)
+
+    # one tick of the time base per sample, so that block times of long recordings fit into int32
+    fileHeader = np.zeros(1, dtype=fileHeaderDtype)
+    fileHeader['system_id'] = 6
+    fileHeader['us_per_time'] = 1
+    fileHeader['time_per_adc'] = 1
+    fileHeader['channels'] = nChannels
+    fileHeader['first_data'] = dataStart
+    fileHeader['max_ftime'] = nSamples
+    fileHeader['dtime_base'] = 1. / samplingRate
+
+    with open(smrFile, 'wb') as fid:
+        fid.write(fileHeader.tobytes())
+        fid.write(b'\0' * (channelHeadersStart - fileHeaderDtype.itemsize))
+
+        for channelInd in range(nChannels):
+            channelHeader = np.zeros(1, dtype=channelHeaderDtype)
+            channelHeader['firstblock'] = blockOffset(channelInd, 0)
+            channelHeader['lastblock'] = blockOffset(channelInd, nBlocks - 1)
+            channelHeader['blocks'] = min(nBlocks, 2 ** 15 - 1)
+            channelHeader['max_chan_time'] = nSamples - 1
+            channelHeader['l_chan_dvd'] = 1
+            channelHeader['phy_chan'] = channelInd
+            channelHeader['title'] = pascalString(channelTitles[channelInd], 10)
+            channelHeader['ideal_rate'] = samplingRate
+            channelHeader['kind'] = 1
+            channelHeader['scale'] = 1.
+            channelHeader['unit'] = pascalString('V', 6)
+            channelHeader['divide'] = 1
+            fid.write(channelHeader.tobytes())
+            fid.write(b'\0' * (channelHeaderSize - channelHeaderDtype.itemsize))
+
+        for channelInd in range(nChannels):
+            for chunkStartInd in range(0, nSamples, chunkSize):
+                chunk = syntheticSamples(channelInd, chunkStartInd, min(chunkSize, nSamples - chunkStartInd),
+                                         samplingRate, seed)
+                chunk = np.clip(np.round(chunk * adcScale), -2 ** 15, 2 ** 15 - 1).astype('<i2')
+
+                for blockStart in range(0, chunk.shape[0], blockItems):
+                    blockInd = (chunkStartInd + blockStart) // blockItems
+                    block = chunk[blockStart: blockStart + blockItems]
+                    blockHeader = np.zeros(1, dtype=blockHeaderDtype)
+                    blockHeader['pred_block'] = -1 if blockInd == 0 else blockOffset(channelInd, blockInd - 1)
+                    blockHeader['succ_block'] = -1 if blockInd == nBlocks - 1 else blockOffset(channelInd,
+                                                                                               blockInd + 1)
+                    blockHeader['start_time'] = chunkStartInd + blockStart
+                    blockHeader['end_time'] = chunkStartInd + blockStart + block.shape[0] - 1
+                    blockHeader['channel_num'] = channelInd
+                    blockHeader['items'] = block.shape[0]
+                    fid.write(blockHeader.tobytes())
+                    fid.write(block.tobytes())
+
+
+if __name__ == '__main__':
+
+    writeSyntheticSMR(sys.argv[1], float(sys.argv[2]),
+                      float(sys.argv[3]) if len(sys.argv) > 3 else 20000.,
+                      int(sys.argv[4]) if len(sys.argv) > 4 else 3)
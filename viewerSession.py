@@ -0,0 +1,106 @@
+import os
+from collections import OrderedDict
+from smrReader import fileStat
+
+#***********************************************************************************************************************
+
+
+class ViewerSession(object):
+    '''
+    The RawDataViewers of the recordings opened in a session, so that switching back to a recording viewed recently
+    needs no loading. Each viewer is kept with the state of its view, e.g., the epoch last viewed, as long as the
+    memory held by the arrays of all viewers (see RawDataViewer.nbytes) is at most maxBytes; beyond, the least
+    recently viewed ones are dropped.
+    '''
+
+    def __init__(self, maxBytes=1024 ** 3):
+        '''
+        :param maxBytes: int, bound on the memory held by the viewers. The viewer being viewed is kept even if it
+        alone holds more.
+        '''
+
+        self.maxBytes = maxBytes
+        # (rdi, viewState) by key, least recently viewed first
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def key(smrFile, **loadPars):
+        '''
+        Key of the viewer of an SMR file loaded with loadPars. It changes with the size and modification time of the
+        file, so that a recording modified since it was loaded is loaded again.
+        :param smrFile: str, path of the SMR file, which must exist
+        :param loadPars: hashable values, e.g., calibration strings and intervals to exclude
+        :return: tuple
+        '''
+
+        return os.path.abspath(smrFile), tuple(fileStat(smrFile)), tuple(sorted(loadPars.items()))
+
+    def __contains__(self, key):
+
+        return key in self.entries
+
+    def __len__(self):
+
+        return len(self.entries)
+
+    def keys(self):
+        '''
+        :return: list of keys, most recently viewed first
+        '''
+
+        return list(reversed(self.entries))
+
+    def get(self, key):
+        '''
+        Viewer and view state of a key, which become the most recently viewed
+        :param key: tuple, see ViewerSession.key
+        :return: (rawDataImport.RawDataViewer, view state), or None if there is no viewer for key
+        '''
+
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+            self.evict(keep=key)
+        return entry
+
+    def add(self, key, rdi, viewState=None):
+        '''
+        Keep a viewer as the most recently viewed and drop others if the viewers hold more than maxBytes
+        :param key: tuple, see ViewerSession.key
+        :param rdi: rawDataImport.RawDataViewer
+        :param viewState: any, returned with rdi by get
+        '''
+
+        self.entries.pop(key, None)
+        self.entries[key] = (rdi, viewState)
+        self.evict(keep=key)
+
+    def setViewState(self, key, viewState):
+
+        if key in self.entries:
+            self.entries[key] = (self.entries[key][0], viewState)
+
+    @property
+    def nbytes(self):
+        '''
+        Memory held by the arrays of the viewers, in bytes. Measured on every call, as viewers grow when spikes are
+        detected or envelopes computed. Arrays mapped from files and lazily loaded signals are not counted, see
+        RawDataViewer.nbytes.
+        '''
+
+        return sum(rdi.nbytes for rdi, viewState in self.entries.values())
+
+    def evict(self, keep=None):
+        '''
+        Drop least recently viewed viewers until the viewers hold at most maxBytes
+        :param keep: tuple, key of a viewer that must not be dropped
+        '''
+
+        nBytes = self.nbytes
+        for key in list(self.entries):
+            if nBytes <= self.maxBytes:
+                break
+            if key != keep:
+                nBytes -= self.entries.pop(key)[0].nbytes
+
+#***********************************************************************************************************************